@@ -0,0 +1,717 @@
+from util import Utilities
+from text import TextUtils
+from wordprob import WordProb
+from wordprob import WordGenerator
+from wordprob import FREEZE_EVERY
+import word_predictor
+import snapshot
+import tracemalloc
+import itertools
+import platform
+import subprocess
+import argparse
+import resource
+import tempfile
+import threading
+import timeit
+import random
+import time
+import json
+import sys
+import os
+import re
+
+# Some constants. If testing materials are moved, reflect it here
+TST_DIR = "testing_docs/"
+TXT_FILE_TO_NGRAM = "test_file_to_ngram.txt"
+
+# The largest drop in ops/sec, as a fraction of the baseline, that
+# COMPARE_RESULTS doesn't count as a regression
+THRESHOLD = 0.2
+
+# The beam widths timed by BENCH_BEAM, each mapped to the 99th percentile
+# latency, in milliseconds, it should stay within when completing
+# BEAM_LENGTH words, so that it can serve as you type autocompletion
+BEAM_TARGETS = {5: 20.0, 20: 100.0}
+BEAM_LENGTH = 50
+
+# The 99th percentile latency, in milliseconds, that completing a partly
+# typed word should stay within (see BENCH_COMPLETION)
+COMPLETION_TARGET = 5.0
+
+# The number of ngrams in the delta that BENCH_CORPUS merges into its
+# trained model, as appending a little text or publishing a snapshot would
+DELTA_NGRAMS = 100
+
+# The number of chunks BENCH_CORPUS packs its training ngrams in for
+# train_chunked, and the most memory, as a fraction of the peak traced when
+# training packs every ngram at the end, that it should allocate at once
+TRAIN_CHUNKS = 8
+TRAIN_MEMORY_TARGET = 0.8
+
+# The command lines timed by BENCH_STARTUP: a list of (mode, script,
+# arguments), where MODEL in the arguments stands for the model file
+MODEL = object()
+STARTUP_MODES = [
+    ('help', 'word_predictor.py', ['--help']),
+    ('predict', 'word_predictor.py', ['-m', MODEL, '-s', 'the', '-l', '5']),
+    ('evaluate', 'evaluate.py', ['-m', MODEL, '-s', 'the']),
+]
+
+
+# The character by character version of TextUtils.normalize_line that was
+# used before it was rewritten around str.translate. Kept as a reference for
+# checking that the output is unchanged and for measuring the speedup
+def legacy_normalize_line(line):
+    line = line.lower()
+
+    buffer = []
+    for c in line:
+        if c.isalpha() or c.isspace():
+            buffer.append(c)
+        else:
+            buffer.append(' ')
+
+    line = "".join(buffer)
+    line = re.sub(r"\s+", " ", line)
+    line = line.rstrip().lstrip()
+    return line.split()
+
+# The version of word_predictor.predict_words that re-normalized the whole
+# generated string before predicting each word. Kept as a reference for
+# checking that the output is unchanged and for measuring the speedup
+def legacy_predict_words(predictor, seed_str, max_predicted_words):
+    cleaned_string = TextUtils.normalize_line(seed_str)
+    seed_str = ' '.join(cleaned_string)
+    for i in range(max_predicted_words):
+        seeds = TextUtils.normalize_line(seed_str)
+        candidates = predictor.get_next_words(seeds, num_to_return = 1)
+        if candidates == None:
+            break
+        word_prob_pair = random.choice(candidates)
+        next_word = word_prob_pair[0]
+        seed_str += ' '
+        seed_str += next_word
+    return seed_str
+
+# Trains a WordGenerator on NG, an iterable of ngrams, the way
+# WordProb.add_ngram_observations did before shorter contexts were suffixes:
+# the shorter contexts of each ngram were its prefixes, which predict the
+# last word from words further back than backing off expects
+def legacy_prefix_word_gen(ng):
+    word_gen = WordGenerator([])
+    word_probs = word_gen.word_probs
+    add = word_probs.vocab.add
+    for ng_tuple in ng:
+        ids = tuple(map(add, ng_tuple))
+        for i in range(len(ids) - 1):
+            counts = word_probs.pending.setdefault(ids[0:i + 1], dict())
+            counts[ids[-1]] = counts.get(ids[-1], 0) + 1
+    word_probs.freeze()
+    return word_gen
+
+# The backoff WordGenerator.find_context did before the store was a trie:
+# drop words from the front of WORDS and look the rest up from scratch,
+# until something matches
+def legacy_find_context(word_gen, words, min_preceding_match = -1):
+    found = None
+    while min_preceding_match <= len(words):
+        found = word_gen.word_probs.find_context(words)
+        if found != None:
+            break
+        words = words[1:]
+        if len(words) == 0:
+            break
+    return found
+
+# Completes the partly typed word PREFIX after the list of words WORDS the
+# way it had to be done before there was a prefix index: by looking at every
+# successor of the longest matching context. Kept as a reference for
+# checking the results and for measuring the speedup
+def legacy_complete_word(predictor, words, prefix, num_to_return):
+    found = predictor.find_context(words)
+    if found == None:
+        return None
+    completions = [(word, probability) for word, probability in
+        predictor.word_probs.get_ranked_range(*found)
+        if word.startswith(prefix)]
+    return completions[0:num_to_return] or None
+
+# Times normalizing every line of the file at FILE_PATH with the legacy
+# function, TextUtils.normalize_line, and TextUtils.normalize_lines. Each is
+# run REPEAT times and the best time is kept. Returns a dictionary mapping
+# each name to its lines per second
+def bench_normalize(file_path = TST_DIR + TXT_FILE_TO_NGRAM, repeat = 5):
+    lines = list(Utilities.open_file(file_path))
+    functions = [
+        ('legacy_normalize_line',
+            lambda: [legacy_normalize_line(line) for line in lines]),
+        ('normalize_line',
+            lambda: [TextUtils.normalize_line(line) for line in lines]),
+        ('normalize_lines', lambda: TextUtils.normalize_lines(lines)),
+    ]
+    results = dict()
+    for name, function in functions:
+        seconds = min(timeit.repeat(function, number = 1, repeat = repeat))
+        results[name] = len(lines) / seconds
+    return results
+
+# Times generating each of LENGTHS words from a model trained on the file at
+# FILE_PATH, with legacy_predict_words and word_predictor.predict_words.
+# Returns a dictionary mapping (name, length) to words per second
+def bench_predict(file_path = TST_DIR + TXT_FILE_TO_NGRAM,
+    lengths = (20, 80, 320), repeat = 3):
+    word_gen = word_predictor.train_on_plain_text(3, [file_path])
+    functions = [('legacy_predict_words', legacy_predict_words),
+        ('predict_words', word_predictor.predict_words)]
+    results = dict()
+    for length in lengths:
+        for name, function in functions:
+            seconds = min(timeit.repeat(
+                lambda: function(word_gen, 'the', length), number = 1,
+                repeat = repeat))
+            results[(name, length)] = length / seconds
+    return results
+
+# Times drawing from contexts with each number of successors in
+# SUCCESSOR_COUNTS, after their alias tables have been built, with
+# WordGenerator.sample_next_words. Returns a dictionary mapping the number of
+# successors to samples per second
+def bench_sampling(successor_counts = (10, 1000, 100000), num_samples = 20000,
+    repeat = 3):
+    rng = random.Random(0)
+    results = dict()
+    for num_successors in successor_counts:
+        ng = [('ctx', 'w%d' % rng.randint(0, num_successors))
+            for i in range(num_successors * 3)]
+        word_gen = WordGenerator(ng)
+        word_gen.sample_next_words(['ctx'], 1, rng)
+        seconds = min(timeit.repeat(
+            lambda: word_gen.sample_next_words(['ctx'], num_samples, rng),
+            number = 1, repeat = repeat))
+        results[num_successors] = num_samples / seconds
+    return results
+
+# Trains models of ngrams of ORDER words on the first 80% of the lines of
+# the file at FILE_PATH and predicts the last word of every ngram in the
+# rest. Compares the old prefix statistics with dropping words from the
+# front, the suffix statistics with the same backoff, and the suffix
+# statistics with the trie walk. Returns a dictionary mapping each name to a
+# tuple (fraction of last words predicted, lookups per second)
+def bench_backoff(file_path = TST_DIR + TXT_FILE_TO_NGRAM, order = 3,
+    repeat = 3):
+    lines = list(Utilities.open_file(file_path))
+    split = len(lines) * 4 // 5
+    training = [word for words in TextUtils.normalize_lines(lines[0:split])
+        for word in words]
+    held_out = [word for words in TextUtils.normalize_lines(lines[split:])
+        for word in words]
+    tests = list(TextUtils.iter_ngrams(held_out, order))
+
+    legacy = legacy_prefix_word_gen(TextUtils.iter_ngrams(training, order))
+    suffix = WordGenerator(TextUtils.iter_ngrams(training, order))
+    suffix.freeze()
+    functions = [('legacy_prefix_backoff', legacy, legacy_find_context),
+        ('suffix_backoff', suffix, legacy_find_context),
+        ('suffix_trie', suffix, lambda word_gen, words:
+            word_gen.find_context(words))]
+    results = dict()
+    for name, word_gen, find in functions:
+        store = word_gen.word_probs.store
+        vocab = word_gen.word_probs.vocab
+        hits = 0
+        for ng_tuple in tests:
+            found = find(word_gen, list(ng_tuple[0:-1]))
+            if found != None and \
+                store.successors[found[0]] == vocab.get_id(ng_tuple[-1]):
+                hits += 1
+        contexts = [list(ng_tuple[0:-1]) for ng_tuple in tests]
+        seconds = min(timeit.repeat(
+            lambda: [find(word_gen, words) for words in contexts],
+            number = 1, repeat = repeat))
+        results[name] = (hits / max(len(tests), 1), len(tests) / seconds)
+    return results
+
+# Returns a word made of letters for the number I, since normalizing text
+# would drop digits
+def letter_word(i):
+    letters = []
+    while True:
+        letters.append(chr(ord('a') + i % 26))
+        i //= 26
+        if i == 0:
+            return ''.join(letters)
+
+# Writes a synthetic corpus of NUM_WORDS words to the file at FILE_PATH,
+# LINE_LENGTH words per line. Words are drawn from a vocabulary of
+# VOCAB_SIZE words with Zipf's law, the i-th most frequent word being drawn
+# in proportion to 1 / i ** EXPONENT, like the words of natural text. The
+# same SEED always writes the same file
+def write_zipf_corpus(file_path, num_words, vocab_size, exponent = 1.1,
+    line_length = 12, seed = 0):
+    rng = random.Random(seed)
+    words = [letter_word(i) for i in range(vocab_size)]
+    weights = list(itertools.accumulate(1.0 / (i + 1) ** exponent
+        for i in range(vocab_size)))
+    with open(file_path, 'w') as file:
+        for start in range(0, num_words, line_length):
+            count = min(line_length, num_words - start)
+            file.write(' '.join(rng.choices(words, cum_weights = weights,
+                k = count)) + '\n')
+
+# Returns the largest resident set size of this process so far, in bytes
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+# Times FUNCTION, which performs OPS operations each time it is called, and
+# returns a dictionary with the best 'ops_per_sec' of REPEAT runs, the
+# 'seconds' of that run, the 'peak_rss' of the process afterwards, and the
+# 'alloc_peak_bytes' and 'alloc_blocks' traced by tracemalloc during one
+# more, untimed, run: the most memory allocated at once and the number of
+# blocks still allocated at the end
+def measure(function, ops, repeat = 3):
+    seconds = min(timeit.repeat(function, number = 1, repeat = repeat))
+    tracemalloc.start()
+    try:
+        result = function()
+        current, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in
+            tracemalloc.take_snapshot().statistics('filename'))
+    finally:
+        tracemalloc.stop()
+    del result
+    return {'ops': ops, 'seconds': seconds,
+        'ops_per_sec': ops / max(seconds, 1e-9), 'peak_rss': peak_rss(),
+        'alloc_peak_bytes': peak, 'alloc_blocks': blocks}
+
+# Returns the value FRACTION of the way through the sorted list VALUES
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+# Same as MEASURE, for FUNCTION called on every one of INPUTS, counting
+# calls. The result also has the 'p50_ms' and 'p99_ms' latency of a call
+# over REPEAT runs, and the 'target_ms' the latter should stay within if
+# TARGET is not None
+def measure_latency(function, inputs, target = None, repeat = 3):
+    result = measure(lambda: [function(value) for value in inputs],
+        len(inputs), repeat)
+    latencies = sorted(timeit.timeit(lambda: function(value), number = 1)
+        for i in range(repeat) for value in inputs)
+    result['p50_ms'] = percentile(latencies, 0.5) * 1e3
+    result['p99_ms'] = percentile(latencies, 0.99) * 1e3
+    if target != None:
+        result['target_ms'] = target
+    return result
+
+# Times word_predictor.beam_search completing LENGTH words after each of
+# SEEDS with PREDICTOR, at every beam width in TARGETS, a dictionary like
+# BEAM_TARGETS. Returns a dictionary mapping 'beam_search_<width>' to the
+# dictionary returned by MEASURE_LATENCY, counting searches
+def bench_beam(predictor, seeds, targets = BEAM_TARGETS,
+    length = BEAM_LENGTH, repeat = 3):
+    results = dict()
+    for width, target in sorted(targets.items()):
+        results['beam_search_%d' % width] = measure_latency(
+            lambda seed: word_predictor.beam_search(predictor, seed, length,
+            width), seeds, target, repeat)
+    return results
+
+# Returns NUM_QUERIES (words, prefix) tuples for completing a partly typed
+# word with WORD_GEN: the words are a context of the longest length in its
+# model and the prefix is the first 1 to 3 letters of one of the context's
+# successors. Contexts are drawn as often as they were seen and successors
+# uniformly, so that frequent contexts with many successors come up as
+# often as they would while typing, with a random.Random seeded with SEED
+def completion_queries(word_gen, num_queries, seed = 0):
+    rng = random.Random(seed)
+    store = word_gen.word_probs.store
+    get_word = word_gen.word_probs.vocab.get_word
+    longest = store.max_context_length()
+    contexts = [(context, start, end, total) for context, start, end, total
+        in store.iter_contexts() if len(context) == longest]
+    weights = list(itertools.accumulate(total for context, start, end, total
+        in contexts))
+    queries = []
+    for context, start, end, total in rng.choices(contexts,
+        cum_weights = weights, k = num_queries):
+        word = get_word(store.successors[rng.randrange(start, end)])
+        queries.append(([get_word(word_id) for word_id in context],
+            word[0:rng.randint(1, 3)]))
+    return queries
+
+# Times completing each of QUERIES, made by COMPLETION_QUERIES, with
+# WordGenerator.get_completions and legacy_complete_word, returning the
+# NUM_TO_RETURN most likely words. Returns a dictionary mapping each name to
+# the dictionary returned by MEASURE_LATENCY, counting completions
+def bench_completion(word_gen, queries, num_to_return = 5, repeat = 3):
+    word_gen.word_probs.get_prefix_index()
+    return {
+        'complete_word': measure_latency(lambda query:
+            word_gen.get_completions(query[0], query[1], num_to_return),
+            queries, COMPLETION_TARGET, repeat),
+        'legacy_complete_word': measure_latency(lambda query:
+            legacy_complete_word(word_gen, query[0], query[1],
+            num_to_return), queries, repeat = repeat),
+    }
+
+# Stress tests reading a snapshot.VersionedModel while it is written to.
+# NUM_READERS threads look up contexts of the ngrams of ORDER words of the
+# file at FILE_PATH in the latest snapshot, over and over, while this thread
+# adds those ngrams in NUM_BATCHES batches, published at most once every
+# PUBLISH_INTERVAL seconds. Every read checks that the snapshot is
+# consistent: the total of the context found matches the counts of its
+# successors, and a reader never sees an older version after a newer one.
+# Returns a dictionary with the number of 'reads', 'reads_per_sec' over all
+# the readers, the number of 'publishes', the 'publish' latency summary of
+# util.Histogram, the number of 'inconsistent' reads, which should be 0, the
+# 'store_bytes' of the last snapshot and the 'publish_peak_bytes' allocated
+# at most while publishing one more batch on top of it
+def bench_snapshots(file_path = TST_DIR + TXT_FILE_TO_NGRAM, num_readers = 4,
+    num_batches = 20, order = 3, seed = 0,
+    publish_interval = snapshot.PUBLISH_INTERVAL):
+    ng = list(TextUtils.file_to_ngram(file_path, order))
+    rng = random.Random(seed)
+    contexts = [list(rng.choice(ng)[0:-1]) for i in range(100)]
+    batch_size = max(-(-len(ng) // num_batches), 1)
+    model = snapshot.VersionedModel(publish_interval = publish_interval)
+    done = threading.Event()
+    reads = [0] * num_readers
+    inconsistent = [0] * num_readers
+
+    def read(reader):
+        last = 0
+        while not done.is_set():
+            current = model.snapshot()
+            if current.version < last:
+                inconsistent[reader] += 1
+            last = current.version
+            word_gen = current.word_gen()
+            counts = current.store.counts
+            for words in contexts:
+                found = word_gen.find_context(words)
+                if found != None:
+                    start, end, total = found
+                    if sum(counts[start:end]) != total:
+                        inconsistent[reader] += 1
+                word_gen.get_next_words(words)
+            reads[reader] += len(contexts)
+
+    threads = [threading.Thread(target = read, args = (reader,))
+        for reader in range(num_readers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for first in range(0, len(ng), batch_size):
+        model.add_list_of_ngrams(ng[first:first + batch_size])
+    model.publish()
+    done.set()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    publishes = model.snapshot().version - 1
+    latency = model.publish_latency.summary()
+
+    # the new store is built while the old one is still held
+    tracemalloc.start()
+    model.update(lambda word_probs: word_probs.add_ngram_observations(
+        ng[0:batch_size]))
+    model.publish()
+    publish_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'readers': num_readers, 'reads': sum(reads),
+        'reads_per_sec': sum(reads) / seconds, 'publishes': publishes,
+        'publish': latency, 'inconsistent': sum(inconsistent),
+        'store_bytes': model.snapshot().store.num_bytes(),
+        'publish_peak_bytes': publish_peak}
+
+# Runs every benchmark of the suite on the plain text file at FILE_PATH,
+# training models of ngrams of ORDER words. The model is saved in DIRECTORY.
+# Returns a dictionary mapping each benchmark's name to the dictionary
+# returned by MEASURE. The operations counted are lines for normalize_line,
+# ngrams for file_to_ngram and add_ngram_observations (which includes
+# freezing the counts), calls for save_word_gen and load_word_gen, lookups
+# for get_next_words, words for predict_words, merges of DELTA_NGRAMS ngrams
+# into the trained model for merge_small_delta, searches for the beam
+# searches of BENCH_BEAM and completions for those of BENCH_COMPLETION
+def bench_corpus(file_path, directory, order = 3, repeat = 3,
+    num_lookups = 10000, num_predicted = 200):
+    lines = list(Utilities.open_file(file_path))
+    ng = list(TextUtils.file_to_ngram(file_path, order))
+    rng = random.Random(0)
+    contexts = [list(rng.choice(ng)[1:]) for i in range(num_lookups)]
+    seeds = [' '.join(rng.choice(ng)[1:]) for i in range(num_predicted // 20)]
+
+    def train(freeze_every = FREEZE_EVERY):
+        word_probs = WordProb()
+        word_probs.freeze_every = freeze_every
+        word_probs.add_ngram_observations(ng)
+        word_probs.freeze()
+        return word_probs
+    word_gen = WordGenerator.from_word_probs(train())
+    model_name = os.path.join(directory, 'bench_model.bin')
+    word_predictor.save_word_gen(model_name, word_gen)
+    loaded = word_predictor.load_word_gen(model_name)
+    # the delta only has words the model has, so its vocabulary is shared
+    delta = WordProb()
+    delta.vocab = word_gen.word_probs.vocab
+    delta.freeze_every = 0
+    delta.add_ngram_observations(rng.sample(ng, min(DELTA_NGRAMS, len(ng))))
+
+    benchmarks = [
+        ('normalize_line', len(lines),
+            lambda: [TextUtils.normalize_line(line) for line in lines]),
+        ('file_to_ngram', len(ng),
+            lambda: sum(1 for ng_tuple in TextUtils.file_to_ngram(file_path,
+                order))),
+        ('add_ngram_observations', len(ng), train),
+        ('train_unchunked', len(ng), lambda: train(0)),
+        ('train_chunked', len(ng),
+            lambda: train(max(len(ng) // TRAIN_CHUNKS, 1))),
+        ('save_word_gen', 1,
+            lambda: word_predictor.save_word_gen(model_name, word_gen)),
+        ('load_word_gen', 1,
+            lambda: word_predictor.load_word_gen(model_name)),
+        ('merge_small_delta', 1,
+            lambda: word_gen.word_probs.store.merge(delta.pending)),
+        ('get_next_words', len(contexts),
+            lambda: [loaded.get_next_words(words) for words in contexts]),
+        ('predict_words', len(seeds) * 20,
+            lambda: [word_predictor.predict_words(loaded, seed, 20)
+                for seed in seeds]),
+    ]
+    results = dict()
+    for name, ops, function in benchmarks:
+        random.seed(0)
+        results[name] = measure(function, ops, repeat)
+    results['train_chunked']['alloc_target_bytes'] = \
+        results['train_unchunked']['alloc_peak_bytes'] * TRAIN_MEMORY_TARGET
+    results.update(bench_beam(loaded, seeds, repeat = repeat))
+    results.update(bench_completion(loaded, completion_queries(loaded,
+        num_predicted * 5), repeat = repeat))
+    return results
+
+# Times every mode in STARTUP_MODES as a fresh process, from starting the
+# interpreter to exiting, with the model file MODEL_NAME. Most of a single
+# prediction is spent importing modules, so this catches imports creeping
+# back into the paths that don't need them. Returns a dictionary mapping
+# each mode to the dictionary returned by MEASURE, counting process runs
+def bench_startup(model_name, repeat = 3):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = dict()
+    for mode, script, arguments in STARTUP_MODES:
+        command = [sys.executable, os.path.join(directory, script)] + \
+            [model_name if argument is MODEL else argument
+                for argument in arguments]
+        results[mode] = measure(lambda: subprocess.run(command,
+            stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL,
+            check = True), 1, repeat)
+    return results
+
+# Runs the suite on a Zipf corpus of NUM_WORDS words from a vocabulary of
+# VOCAB_SIZE words, and on the file at FILE_PATH, and times starting each
+# CLI mode with the model of the file. Returns a dictionary with the
+# 'config' the suite was run with and the 'results' of every benchmark,
+# named '<corpus>/<benchmark>' or 'startup/<mode>', ready to be written as
+# JSON
+def run_suite(file_path = TST_DIR + TXT_FILE_TO_NGRAM, num_words = 200000,
+    vocab_size = 20000, order = 3, repeat = 3):
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        zipf_path = os.path.join(directory, 'zipf.txt')
+        write_zipf_corpus(zipf_path, num_words, vocab_size)
+        for corpus, path in (('zipf', zipf_path), ('file', file_path)):
+            for name, result in bench_corpus(path, directory, order,
+                repeat).items():
+                results[corpus + '/' + name] = result
+        for mode, result in bench_startup(os.path.join(directory,
+            'bench_model.bin'), repeat).items():
+            results['startup/' + mode] = result
+    config = {'file': file_path, 'num_words': num_words,
+        'vocab_size': vocab_size, 'order': order, 'repeat': repeat,
+        'python': platform.python_version(), 'machine': platform.machine()}
+    return {'config': config, 'results': results}
+
+# Compares RESULTS with BASELINE, both made by RUN_SUITE. Returns a list of
+# (name, baseline ops/sec, ops/sec) tuples for every benchmark in both whose
+# ops/sec dropped by more than THRESHOLD, as a fraction of the baseline
+def compare_results(results, baseline, threshold = THRESHOLD):
+    regressions = []
+    for name, old in sorted(baseline['results'].items()):
+        new = results['results'].get(name)
+        if new == None:
+            continue
+        if new['ops_per_sec'] < old['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, old['ops_per_sec'],
+                new['ops_per_sec']))
+    return regressions
+
+# Returns a list of (name, p99 ms, target ms) tuples for every benchmark in
+# RESULTS, made by RUN_SUITE, whose 99th percentile latency is over its
+# target
+def missed_targets(results):
+    return [(name, result['p99_ms'], result['target_ms'])
+        for name, result in sorted(results['results'].items())
+        if 'target_ms' in result and result['p99_ms'] > result['target_ms']]
+
+# Returns a list of (name, peak bytes, target bytes) tuples for every
+# benchmark in RESULTS, made by RUN_SUITE, that allocated more at once than
+# its target
+def missed_memory_targets(results):
+    return [(name, result['alloc_peak_bytes'], result['alloc_target_bytes'])
+        for name, result in sorted(results['results'].items())
+        if 'alloc_target_bytes' in result and
+        result['alloc_peak_bytes'] > result['alloc_target_bytes']]
+
+# Prints the results of RUN_SUITE as a table, with the change from BASELINE
+# if it is not None
+def print_suite(results, baseline = None):
+    for name, result in sorted(results['results'].items()):
+        change = ''
+        if baseline != None and name in baseline['results']:
+            change = '%+7.1f%%' % ((result['ops_per_sec'] /
+                baseline['results'][name]['ops_per_sec'] - 1) * 100)
+        latency = ''
+        if 'p99_ms' in result:
+            latency = ' %8.1f ms p99' % result['p99_ms']
+        print("%-32s %14.0f ops/sec %8s %8.1f MB peak alloc%s" % (name,
+            result['ops_per_sec'], change, result['alloc_peak_bytes'] / 1e6,
+            latency))
+    print("peak RSS %.1f MB" % (max(result['peak_rss'] for result in
+        results['results'].values()) / 1e6))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file",
+                    default = TST_DIR + TXT_FILE_TO_NGRAM,
+                    help="the text file to normalize",
+                    action="store")
+    parser.add_argument("-r", "--repeat",
+                    type = int,
+                    default = 5,
+                    help="number of timed runs, the best is kept (default = 5)",
+                    action="store")
+    parser.add_argument("--suite",
+                    help="run the benchmark suite on a synthetic corpus and "
+                        "the file instead of the comparisons with the legacy "
+                        "code",
+                    action="store_true")
+    parser.add_argument("--completion",
+                    metavar = "MODEL",
+                    help="time completing partly typed words with a saved "
+                        "model, such as one retrained on the brown and abc "
+                        "corpora, instead of the comparisons with the legacy "
+                        "code",
+                    action="store")
+    parser.add_argument("--snapshots",
+                    type = int,
+                    metavar = "READERS",
+                    help="stress test this many threads reading snapshots "
+                        "of a model while the file is added to it in "
+                        "batches, instead of the comparisons with the legacy "
+                        "code",
+                    action="store")
+    parser.add_argument("--words",
+                    type = int,
+                    default = 200000,
+                    help="with --suite, the number of words in the synthetic "
+                        "corpus (default = 200000)",
+                    action="store")
+    parser.add_argument("--vocab",
+                    type = int,
+                    default = 20000,
+                    help="with --suite, the vocabulary size of the synthetic "
+                        "corpus (default = 20000)",
+                    action="store")
+    parser.add_argument("-o", "--output",
+                    help="with --suite, write the results to this JSON file",
+                    action="store")
+    parser.add_argument("-b", "--baseline",
+                    help="with --suite, compare the results with this JSON "
+                        "file written by --output, and fail on regressions",
+                    action="store")
+    parser.add_argument("--threshold",
+                    type = float,
+                    default = THRESHOLD,
+                    help="with --baseline, the largest drop in ops/sec "
+                        "allowed, as a fraction (default = %g)" % THRESHOLD,
+                    action="store")
+    args = parser.parse_args()
+
+    if args.suite:
+        baseline = None
+        if args.baseline != None:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        results = run_suite(args.file, args.words, args.vocab,
+            repeat = args.repeat)
+        print_suite(results, baseline)
+        if args.output != None:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent = 2, sort_keys = True)
+        # latency targets depend on the machine, so missing them is only
+        # reported
+        for name, p99, target in missed_targets(results):
+            print("SLOW: %s p99 %.1f ms, target %.1f ms" % (name, p99,
+                target))
+        for name, peak, target in missed_memory_targets(results):
+            print("MEMORY: %s %.1f MB peak alloc, target %.1f MB" % (name,
+                peak / 1e6, target / 1e6))
+        if baseline != None:
+            regressions = compare_results(results, baseline, args.threshold)
+            for name, old, new in regressions:
+                print("REGRESSION: %s %.0f -> %.0f ops/sec (%+.1f%%)" % (name,
+                    old, new, (new / old - 1) * 100))
+            if len(regressions) > 0:
+                sys.exit("Fatal Error: %d benchmarks regressed by more than "
+                    "%g%%" % (len(regressions), args.threshold * 100))
+        sys.exit()
+
+    if args.snapshots != None:
+        result = bench_snapshots(args.file, args.snapshots)
+        print("%d readers: %d reads, %.0f reads/sec" % (result['readers'],
+            result['reads'], result['reads_per_sec']))
+        print("%d publishes: %.3f ms p50 %.3f ms p99 %.3f ms max" % (
+            result['publishes'], result['publish']['p50_ms'],
+            result['publish']['p99_ms'], result['publish']['max_ms']))
+        print("%.1f MB store, %.1f MB peak alloc publishing one more batch" % (
+            result['store_bytes'] / 1e6, result['publish_peak_bytes'] / 1e6))
+        if result['inconsistent'] > 0:
+            sys.exit("Fatal Error: %d inconsistent reads"
+                % result['inconsistent'])
+        sys.exit()
+
+    if args.completion != None:
+        word_gen = word_predictor.load_word_gen(args.completion)
+        results = bench_completion(word_gen, completion_queries(word_gen,
+            2000), repeat = args.repeat)
+        for name, result in sorted(results.items()):
+            print("%-24s %12.0f completions/sec %8.3f ms p50 %8.3f ms p99" % (
+                name, result['ops_per_sec'], result['p50_ms'],
+                result['p99_ms']))
+        for name, p99, target in missed_targets({'results': results}):
+            print("SLOW: %s p99 %.1f ms, target %.1f ms" % (name, p99,
+                target))
+        sys.exit()
+
+    results = bench_normalize(args.file, args.repeat)
+    baseline = results['legacy_normalize_line']
+    for name, rate in results.items():
+        print("%-24s %12.0f lines/sec %8.1fx" % (name, rate, rate / baseline))
+
+    results = bench_predict(args.file, repeat = args.repeat)
+    for (name, length), rate in results.items():
+        baseline = results[('legacy_predict_words', length)]
+        print("%-24s %12.0f words/sec %8.1fx (%d words)" % (name, rate,
+            rate / baseline, length))
+
+    for name, (accuracy, rate) in bench_backoff(args.file,
+        repeat = args.repeat).items():
+        print("%-24s %12.0f lookups/sec %6.1f%% of next words predicted" % (
+            name, rate, accuracy * 100))
+
+    for num_successors, rate in bench_sampling(repeat = args.repeat).items():
+        print("%-24s %12.0f samples/sec (%d successors)" % (
+            'sample_next_words', rate, num_successors))
@@ -0,0 +1,193 @@
+from collections import OrderedDict
+import array
+import bisect
+import heapq
+
+# The number of context indexes a PrefixIndex keeps before dropping the least
+# recently used one
+MAX_INDEXES = 100000
+
+# Contexts with at most this many successors are scanned in ranked order
+# rather than indexed, since the scan is about as fast as a binary search
+SCAN_LIMIT = 64
+
+
+# Returns the smallest string greater than every string starting with the
+# non-empty string PREFIX
+def prefix_end(prefix):
+    last = ord(prefix[-1])
+    if last == 0x10ffff:
+        return prefix_end(prefix[0:-1]) if len(prefix) > 1 else None
+    return prefix[0:-1] + chr(last + 1)
+
+
+# Finds the most frequent successors of a context that start with a given
+# prefix, for completing a word as it is typed. Every word gets its rank in
+# the sorted vocabulary, so the words starting with a prefix are the ranks
+# from LO to HI. The successors of each context are stored most frequent
+# first, and for contexts with many of them an index of their positions
+# sorted by rank is built the first time they are completed: two binary
+# searches then find the run of successors with the prefix, and the most
+# frequent of those are the ones at the lowest positions. The positions are
+# kept in a segment tree holding the lowest position under each node, so
+# the lowest ones in a run are found one at a time, without looking at the
+# rest of the run
+class PrefixIndex:
+
+    # Class Members:
+    #   self.store: The NgramStore being completed from
+    #   self.vocab: The Vocabulary or MappedVocabulary of self.store's ids
+    #   self.sorted_ids: An array of word ids, sorted by word
+    #   self.ranks: An array mapping every word id to its position in
+    #       self.sorted_ids
+    #   self.indexes: An OrderedDict of (ranks, tree) array tuples, least
+    #       recently used first, keyed by the start of a context's
+    #       successors. The ranks of the context's successors are sorted.
+    #       The tree has 2 * size entries, where size is the first power of
+    #       2 not less than the number of successors: entry size + i is the
+    #       store position of the successor with the i-th rank, and every
+    #       entry below size is the lower of the two entries 2 * i and
+    #       2 * i + 1. Entries past the last successor hold the end of the
+    #       context's successors
+    #   self.max_indexes: The number of indexes kept at most
+
+    def __init__(self, store, vocab, max_indexes = MAX_INDEXES):
+        self.store = store
+        self.vocab = vocab
+        # model files already hold the sorted ids (see modelfile.py)
+        sorted_ids = getattr(vocab, 'sorted_ids', None)
+        if sorted_ids == None:
+            sorted_ids = array.array('i', sorted(range(len(vocab)),
+                key=vocab.get_word))
+        self.sorted_ids = sorted_ids
+        self.ranks = array.array('i', bytes(4 * len(sorted_ids)))
+        for rank, word_id in enumerate(sorted_ids):
+            self.ranks[word_id] = rank
+        self.indexes = OrderedDict()
+        self.max_indexes = max_indexes
+
+    # Returns a PrefixIndex over the same store and vocabulary that shares
+    # this one's word ranks, which are only ever read, but keeps its own
+    # context indexes, so that another thread can use it without a lock
+    def copy(self):
+        index = PrefixIndex.__new__(PrefixIndex)
+        index.store = self.store
+        index.vocab = self.vocab
+        index.sorted_ids = self.sorted_ids
+        index.ranks = self.ranks
+        index.indexes = OrderedDict()
+        index.max_indexes = self.max_indexes
+        return index
+
+    # Returns the rank of the first word that is not less than WORD
+    def lower_bound(self, word):
+        get_word = self.vocab.get_word
+        sorted_ids = self.sorted_ids
+        lo = 0
+        hi = len(sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get_word(sorted_ids[mid]) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Returns a tuple (lo, hi), where the words starting with PREFIX are the
+    # ones ranked from LO to HI
+    def rank_range(self, prefix):
+        if prefix == '':
+            return (0, len(self.sorted_ids))
+        end = prefix_end(prefix)
+        hi = len(self.sorted_ids)
+        if end != None:
+            hi = self.lower_bound(end)
+        return (self.lower_bound(prefix), hi)
+
+    # Returns a list of the positions of the NUM_TO_RETURN most frequent
+    # successors ranked from LO to HI in the range START to END, which holds
+    # the successors of one context, most frequent first. Ties are broken by
+    # the order of the successors in the store. When the matches are dense
+    # enough, scanning the successors in ranked order finds them sooner than
+    # the index does
+    def complete(self, start, end, lo, hi, num_to_return):
+        if end - start <= SCAN_LIMIT:
+            return self.scan(start, end, lo, hi, num_to_return)
+        ranks, tree = self.get_index(start, end)
+        first = bisect.bisect_left(ranks, lo)
+        matches = bisect.bisect_left(ranks, hi, first) - first
+        if matches == 0:
+            return []
+        # the scan looks at about (END - START) / MATCHES successors for
+        # every match it returns, and the index at about one node for every
+        # level of the tree
+        if end - start < matches * (end - start).bit_length():
+            return self.scan(start, end, lo, hi, num_to_return)
+        return self.lowest(tree, first, first + matches, num_to_return)
+
+    # Returns a sorted list of the NUM_TO_RETURN lowest positions held by
+    # the leaves FIRST to LAST of TREE, an index's tree. The nodes covering
+    # exactly those leaves go in a heap by the lowest position under them,
+    # and the lowest node is replaced by its two children until leaves are
+    # at the top, so only the branches holding the answer are visited
+    def lowest(self, tree, first, last, num_to_return):
+        size = len(tree) // 2
+        heap = []
+        left = first + size
+        right = last + size
+        while left < right:
+            if left & 1:
+                heap.append((tree[left], left))
+                left += 1
+            if right & 1:
+                right -= 1
+                heap.append((tree[right], right))
+            left >>= 1
+            right >>= 1
+        heapq.heapify(heap)
+        found = []
+        while len(heap) > 0 and len(found) < num_to_return:
+            position, node = heapq.heappop(heap)
+            if node >= size:
+                found.append(position)
+            else:
+                heapq.heappush(heap, (tree[2 * node], 2 * node))
+                heapq.heappush(heap, (tree[2 * node + 1], 2 * node + 1))
+        return found
+
+    # Same as COMPLETE, by looking at every successor in ranked order
+    def scan(self, start, end, lo, hi, num_to_return):
+        ranks = self.ranks
+        successors = self.store.successors
+        found = []
+        for position in range(start, end):
+            if lo <= ranks[successors[position]] < hi:
+                found.append(position)
+                if len(found) == num_to_return:
+                    break
+        return found
+
+    # Returns the index of the context whose successors are from START to
+    # END, building it if it isn't kept
+    def get_index(self, start, end):
+        index = self.indexes.get(start)
+        if index == None:
+            ranks = self.ranks
+            successors = self.store.successors
+            positions = sorted(range(start, end),
+                key=lambda position: ranks[successors[position]])
+            size = 1
+            while size < len(positions):
+                size *= 2
+            tree = array.array('q', [end]) * (2 * size)
+            tree[size:size + len(positions)] = array.array('q', positions)
+            for node in range(size - 1, 0, -1):
+                tree[node] = min(tree[2 * node], tree[2 * node + 1])
+            index = (array.array('i', [ranks[successors[position]]
+                for position in positions]), tree)
+            self.indexes[start] = index
+            if len(self.indexes) > self.max_indexes:
+                self.indexes.popitem(last = False)
+        else:
+            self.indexes.move_to_end(start)
+        return index
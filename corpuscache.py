@@ -0,0 +1,172 @@
+from util import Utilities
+from store import Vocabulary
+from text import TextUtils
+from text import NORMALIZER_VERSION
+import modelfile
+import hashlib
+import array
+import sys
+import os
+import re
+
+# The directory corpus tokens are cached in by default
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'word_predictor')
+
+# Token cache files start with this magic string, followed by the version of
+# the format. Bump FORMAT_VERSION whenever the layout below changes
+MAGIC = b'NGRAMTOK'
+FORMAT_VERSION = 1
+
+# The number of tokens read from a cache file between two throughput updates
+BATCH_SIZE = 1 << 16
+
+# Reading a corpus through nltk parses every file and normalizing its words
+# takes longer still, so the normalized tokens of each corpus are cached
+# the first time it is trained on. A cache file holds the corpus's tokens as
+# an array of integer ids plus the vocabulary they index, in the layout of
+# model files (see modelfile.py) with its own magic string:
+#   vocab_offsets, vocab_data, vocab_sorted: the vocabulary, as in a model
+#   tokens: the id of every token of the corpus, in order
+#
+# The name of a cache file holds the corpus's name and a fingerprint of the
+# names, sizes and modification times of its files, the normalizer version
+# and the format version, so a corpus whose files change, or a change to
+# the normalizer, is simply a cache miss. Finding the cache file only takes
+# a stat of every file; a fingerprint of the files' contents can be asked
+# for instead, for files whose times can't be trusted. Stale files are
+# never read again and can be deleted at any time.
+
+
+# Returns a name for CORPUS that can be part of a file name: its name in
+# nltk.corpus, or else the last part of its root directory
+def corpus_name(corpus):
+    name = getattr(corpus, '__name__', None)
+    if name == None:
+        # nltk's corpus readers have a path pointer as their root
+        root = getattr(corpus, 'root', 'corpus')
+        name = os.path.basename(os.path.normpath(str(getattr(root, 'path',
+            root))))
+    return re.sub(r'\W', '_', name)
+
+# Returns bytes identifying the version of the corpus file at POINTER, a
+# path pointer from a corpus's abspath: its size and modification time in
+# nanoseconds, or the digest of its raw bytes if HASH_CONTENTS is true or it
+# isn't a plain file, such as one inside a zip file
+def file_stamp(pointer, hash_contents = False):
+    path = getattr(pointer, 'path', None)
+    if not hash_contents and path != None and os.path.isfile(path):
+        stat = os.stat(path)
+        return b'%d %d' % (stat.st_size, stat.st_mtime_ns)
+    digest = hashlib.sha256()
+    with pointer.open() as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+# Returns the hex digest of the name and FILE_STAMP of every file of
+# CORPUS, along with the versions that change the cached tokens.
+# HASH_CONTENTS is as for FILE_STAMP
+def fingerprint(corpus, hash_contents = False):
+    digest = hashlib.sha256()
+    digest.update(b'%d %d' % (NORMALIZER_VERSION, FORMAT_VERSION))
+    for fileid in corpus.fileids():
+        digest.update(b'\0' + fileid.encode('utf-8') + b'\0')
+        digest.update(file_stamp(corpus.abspath(fileid), hash_contents))
+    return digest.hexdigest()
+
+# Returns the path of the cache file for CORPUS in the directory CACHE_DIR.
+# HASH_CONTENTS is as for FILE_STAMP. This stats or reads every file of the
+# corpus, so callers should find the path once and pass it along
+def cache_path(corpus, cache_dir = CACHE_DIR, hash_contents = False):
+    return os.path.join(cache_dir, '%s.%s.n%d.tokens' % (corpus_name(corpus),
+        fingerprint(corpus, hash_contents)[0:32], NORMALIZER_VERSION))
+
+# Writes the cache file PATH holding the array of token ids IDS, which
+# index the Vocabulary VOCAB. The file is renamed into place once it is
+# complete, so a cache file is never seen half written
+def write_cache(path, vocab, ids):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    modelfile.write_sections(path, modelfile.vocab_sections(vocab) +
+        [('tokens', ids)], MAGIC, FORMAT_VERSION)
+
+# Maps the cache file PATH into memory. Returns a tuple (words, ids), where
+# words is a list of the vocabulary and ids is the array of token ids.
+# Raises IOError or ValueError if the file can't be read
+def read_cache(path):
+    version, sections = modelfile.read_sections(path, MAGIC)
+    if version != FORMAT_VERSION:
+        raise ValueError("'%s' has format version %d, expected %d" % (path,
+            version, FORMAT_VERSION))
+    vocab = modelfile.read_vocab(sections)
+    words = [vocab.get_word(word_id) for word_id in range(len(vocab))]
+    return (words, sections['tokens'])
+
+# Yields the tokens of the cache file PATH from the START-th token up to
+# the END-th, or to the last if END is None. An optional THROUGHPUT object
+# is updated as they are read
+def iter_cached_tokens(path, start = 0, end = None, throughput = None):
+    words, ids = read_cache(path)
+    yield from iter_words(words, ids, start, end, throughput)
+
+# Yields WORDS[id] for every id in IDS from START up to END, as for
+# ITER_CACHED_TOKENS
+def iter_words(words, ids, start = 0, end = None, throughput = None):
+    if end == None:
+        end = len(ids)
+    for position in range(start, end, BATCH_SIZE):
+        stop = min(position + BATCH_SIZE, end)
+        yield from map(words.__getitem__, ids[position:stop])
+        if throughput != None:
+            throughput.update(stop - position,
+                (stop - start) * ids.itemsize)
+
+# Yields the normalized tokens of CORPUS, a corpus from nltk.corpus, from
+# its cache file in CACHE_DIR if there is one. Otherwise the corpus is read
+# through nltk as TextUtils.iter_word_tokens does, and once every token has
+# been yielded its cache file is written for next time. A cache that can't
+# be written is only logged. An optional THROUGHPUT object is updated as
+# the tokens are read. HASH_CONTENTS is as for CACHE_PATH
+def iter_corpus_tokens(corpus, cache_dir = CACHE_DIR, throughput = None,
+    hash_contents = False):
+    return read_through(corpus, cache_path(corpus, cache_dir,
+        hash_contents), throughput)
+
+# Same as ITER_CORPUS_TOKENS, with the cache file at PATH
+def read_through(corpus, path, throughput = None):
+    if Utilities.is_file(path):
+        try:
+            words, ids = read_cache(path)
+        except (IOError, ValueError) as e:
+            Utilities.log("Ignoring token cache '%s': %s", (path, e),
+                sys.stderr)
+        else:
+            yield from iter_words(words, ids, throughput = throughput)
+            return
+
+    vocab = Vocabulary()
+    ids = array.array('i')
+    add = vocab.add
+    for token in TextUtils.iter_word_tokens(corpus.words(),
+        throughput = throughput):
+        ids.append(add(token))
+        yield token
+    try:
+        write_cache(path, vocab, ids)
+    except IOError as e:
+        Utilities.log("Cannot write token cache '%s': %s", (path, e),
+            sys.stderr)
+
+# Returns PATH, the path of the cache file of CORPUS (see CACHE_PATH),
+# reading the corpus through nltk and writing the file first if it isn't
+# cached yet. Returns None if the file can't be written
+def build_cache(corpus, path):
+    if not Utilities.is_file(path):
+        for token in read_through(corpus, path):
+            pass
+        if not Utilities.is_file(path):
+            return None
+    return path
+
+# Returns the number of tokens in the cache file PATH
+def num_tokens(path):
+    return len(modelfile.read_sections(path, MAGIC)[1]['tokens'])
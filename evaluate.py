@@ -0,0 +1,303 @@
+from util import Utilities
+from util import Throughput
+from util import LRUCache
+from text import TextUtils
+from collections import deque
+import word_predictor
+import scorers
+import multiprocessing
+import itertools
+import argparse
+import json
+import math
+import time
+import sys
+import os
+
+# The most contexts whose trie nodes are kept by an Evaluator at once
+CACHE_SIZE = 1 << 16
+
+
+# Scores text with a WordProb: the probability of every token given the
+# tokens before it, as given by a scorer from scorers.py. Log probabilities
+# and surprisals are in bits (log base 2).
+#
+# Tokens that are not in the vocabulary are counted as 'oov' and tokens the
+# scorer gives no probability to are counted as 'zero'. Neither is included
+# in the log probability or the perplexity, but both are still used as
+# context for the tokens after them, which then back off to the words after
+# the unknown one.
+#
+# The trie nodes matched by each context are cached, since consecutive
+# ngrams in a text repeat the same frequent contexts over and over
+class Evaluator:
+
+    # Class Members:
+    #   self.word_probs: The WordProb being evaluated
+    #   self.scorer: The Scorer giving the probability of each token
+    #   self.max_context: The number of preceding tokens used as context,
+    #       at most MAX_ORDER - 1 if MAX_ORDER is more than 0 (see
+    #       Scorer.set_max_order)
+    #   self.cache: An LRUCache mapping a tuple of context ids, most recent
+    #       first, to the list of (k, i) trie nodes it matches
+
+    def __init__(self, word_probs, scorer = None, cache_size = CACHE_SIZE,
+        max_order = 0):
+        if scorer == None:
+            scorer = scorers.KneserNey(word_probs)
+        self.word_probs = word_probs
+        self.scorer = scorer
+        if max_order > 0:
+            scorer.set_max_order(max_order)
+        scorer.prepare()
+        self.max_context = scorer.max_context_length()
+        self.cache = LRUCache(cache_size)
+
+    # Returns the trie nodes matched by REVERSED_IDS, a tuple of the ids of
+    # the preceding tokens, most recent first
+    def find_nodes(self, reversed_ids):
+        nodes = self.cache.get(reversed_ids)
+        if nodes == None:
+            nodes = list(self.scorer.store.walk(reversed_ids))
+            self.cache.put(reversed_ids, nodes)
+        return nodes
+
+    # Yields a tuple (token, bits) for every token in the iterable TOKENS,
+    # where bits is the surprisal of the token given the ones before it, or
+    # None if it is out of the vocabulary or has no probability. HISTORY is
+    # a list of the tokens before TOKENS, if any
+    def iter_surprisals(self, tokens, history = ()):
+        self.scorer.prepare()
+        get_id = self.word_probs.vocab.get_id
+        score_nodes = self.scorer.score_nodes
+        log2 = math.log2
+        context = deque(maxlen = self.max_context)
+        for token in history:
+            context.appendleft(get_id(token))
+        for token in tokens:
+            word_id = get_id(token)
+            bits = None
+            if word_id != None:
+                probability = score_nodes(self.find_nodes(tuple(context)),
+                    word_id)
+                if probability > 0:
+                    bits = -log2(probability)
+            if self.max_context > 0:
+                context.appendleft(word_id)
+            yield (token, bits)
+
+    # Adds the surprisal of every token in the iterable TOKENS to TOTALS, a
+    # dictionary made by NEW_TOTALS, and returns it. The first SKIP tokens
+    # are only used as context
+    def add_totals(self, tokens, totals, skip = 0):
+        tokens = iter(tokens)
+        history = list(itertools.islice(tokens, skip))
+        for token, bits in self.iter_surprisals(tokens, history):
+            self.count(totals, token, bits)
+        return totals
+
+    # Adds TOKEN, whose surprisal is BITS, to TOTALS
+    def count(self, totals, token, bits):
+        if bits != None:
+            totals['tokens'] += 1
+            totals['log_prob'] -= bits
+        elif self.word_probs.vocab.get_id(token) == None:
+            totals['oov'] += 1
+        else:
+            totals['zero'] += 1
+
+    # Returns a dictionary scoring the string SENTENCE after normalizing it:
+    # 'log_prob' is its log probability in bits, 'surprisal' is a list of
+    # (token, bits) for every token, and 'perplexity' is the perplexity of
+    # the tokens that have a probability
+    def score_sentence(self, sentence):
+        totals = new_totals()
+        surprisal = list(self.iter_surprisals(
+            TextUtils.normalize_line(sentence)))
+        for token, bits in surprisal:
+            self.count(totals, token, bits)
+        return {'log_prob': totals['log_prob'], 'surprisal': surprisal,
+            'perplexity': perplexity(totals)}
+
+    # Returns a dictionary with the cache's hits, misses and entries. See
+    # LRUCache.stats
+    def cache_stats(self):
+        return self.cache.stats()
+
+
+# Returns a new dictionary of evaluation totals: the number of 'tokens'
+# scored, their summed 'log_prob' in bits, and the number of 'oov' and
+# 'zero' probability tokens that were skipped
+def new_totals():
+    return {'tokens': 0, 'log_prob': 0.0, 'oov': 0, 'zero': 0}
+
+# Adds the totals in OTHER to TOTALS and returns TOTALS
+def add_totals(totals, other):
+    for key in totals.keys():
+        totals[key] += other[key]
+    return totals
+
+# Returns the perplexity of TOTALS, 2 to the power of the mean surprisal,
+# or None if no tokens were scored
+def perplexity(totals):
+    if totals['tokens'] == 0:
+        return None
+    return 2 ** (-totals['log_prob'] / totals['tokens'])
+
+# Returns the totals for the plain text file FILE_PATH, streamed in chunks
+# and scored by EVALUATOR. An optional THROUGHPUT object is updated as the
+# file is read
+def evaluate_file(evaluator, file_path, throughput = None):
+    if Utilities.is_file(file_path) == False:
+        sys.exit("Fatal Error: file '%s' cannot be opened" % file_path)
+    tokens = TextUtils.iter_file_tokens(file_path, throughput = throughput)
+    totals = evaluator.add_totals(tokens, new_totals())
+    if throughput != None:
+        throughput.next_source()
+    return totals
+
+# Splits the files in FILES into shards for EVALUATE_SHARD, at most
+# PROCESSES per file. Each shard is a tuple (file, start, end, first), where
+# start and end are byte offsets at the start of a line and first is True
+# for the first shard of a file
+def file_shards(files, processes):
+    shards = []
+    for file in files:
+        if Utilities.is_file(file) == False:
+            sys.exit("Fatal Error: file '%s' cannot be opened" % file)
+        num_parts = min(processes,
+            os.path.getsize(file) // word_predictor.MIN_SHARD_BYTES + 1)
+        for start, end in TextUtils.split_file(file, num_parts):
+            shards.append((file, start, end, start == 0))
+    return shards
+
+# Returns the totals for SHARD, made by FILE_SHARDS. Every shard but the
+# first of a file uses its first tokens only as context, and every shard
+# scores as many tokens past its end, so each token of the file is scored
+# exactly once with the same context it would have in one pass
+def evaluate_shard(evaluator, shard):
+    file, start, end, first = shard
+    skip = evaluator.max_context
+    if first:
+        skip = 0
+    tokens = itertools.chain(TextUtils.iter_file_range_tokens(file, start,
+        end), itertools.islice(TextUtils.iter_file_range_tokens(file, end,
+        None), evaluator.max_context))
+    return evaluator.add_totals(tokens, new_totals(), skip)
+
+# The Evaluator of a worker process, made by INIT_WORKER
+worker_evaluator = None
+
+# Loads the model in the file MODEL_NAME for a worker process, scored with
+# the scorer named SCORER_NAME using ngrams of up to MAX_ORDER words, or all
+# of them if it is 0
+def init_worker(model_name, scorer_name, max_order = 0):
+    global worker_evaluator
+    word_gen = word_predictor.load_word_gen(model_name)
+    if word_gen == None:
+        sys.exit("Fatal Error: model '%s' cannot be loaded" % model_name)
+    worker_evaluator = Evaluator(word_gen.word_probs,
+        scorers.SCORERS[scorer_name](word_gen.word_probs),
+        max_order = max_order)
+
+# Scores SHARD with the worker's Evaluator. Returns a tuple (totals, cache
+# stats, number of bytes)
+def evaluate_worker_shard(shard):
+    cache = worker_evaluator.cache
+    hits = cache.hits
+    misses = cache.misses
+    totals = evaluate_shard(worker_evaluator, shard)
+    stats = {'hits': cache.hits - hits, 'misses': cache.misses - misses}
+    return (totals, stats, shard[2] - shard[1])
+
+# Evaluates the model in the file MODEL_NAME on the plain text files FILES,
+# with the scorer named SCORER_NAME. With more than one of PROCESSES, the
+# files are split into shards scored by a pool of worker processes, each
+# with its own copy of the model mapped from MODEL_NAME. Only ngrams of up
+# to MAX_ORDER words are used, or all of them if it is 0, so that each
+# order of a model trained with every order can be evaluated on its own.
+# Returns a dictionary with the totals, the perplexity, the cache hits and
+# misses, and the tokens scored per second. An optional THROUGHPUT object
+# is updated as files or shards are finished
+def evaluate_files(model_name, files, scorer_name = 'kneser_ney',
+    processes = 1, throughput = None, max_order = 0):
+    totals = new_totals()
+    cache = {'hits': 0, 'misses': 0}
+    start_time = time.time()
+    if processes > 1:
+        shards = file_shards(files, processes)
+        with multiprocessing.Pool(processes, init_worker,
+            (model_name, scorer_name, max_order)) as pool:
+            for shard_totals, stats, num_bytes in pool.imap(
+                evaluate_worker_shard, shards):
+                add_totals(totals, shard_totals)
+                add_totals(cache, stats)
+                if throughput != None:
+                    throughput.update(sum(shard_totals[key] for key in
+                        ('tokens', 'oov', 'zero')), num_bytes)
+                    throughput.next_source()
+    else:
+        init_worker(model_name, scorer_name, max_order)
+        for file in files:
+            add_totals(totals, evaluate_file(worker_evaluator, file,
+                throughput))
+        cache = {'hits': worker_evaluator.cache.hits,
+            'misses': worker_evaluator.cache.misses}
+    elapsed = max(time.time() - start_time, 1e-9)
+    if throughput != None:
+        throughput.log()
+    scored = totals['tokens'] + totals['oov'] + totals['zero']
+    return dict(totals, perplexity = perplexity(totals), cache = cache,
+        seconds = elapsed, tokens_per_sec = scored / elapsed)
+
+# Scores held out text with a trained model
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files",
+                    nargs = '*',
+                    help="plain text files to report the perplexity of",
+                    action="store")
+    parser.add_argument("-m", "--model",
+                    default = word_predictor.NGRAM_MODEL_NAME,
+                    help="the model file to evaluate (default = %s)"
+                        % word_predictor.NGRAM_MODEL_NAME,
+                    action="store")
+    parser.add_argument("--scorer",
+                    default = 'kneser_ney',
+                    choices = sorted(scorers.SCORERS.keys()),
+                    help="the smoothed scorer giving each token's "
+                        "probability (default = kneser_ney)",
+                    action="store")
+    parser.add_argument("-s", "--sentence",
+                    help="print the surprisal of every word of this sentence",
+                    action="append")
+    parser.add_argument("-j", "--processes",
+                    type = int,
+                    default = 1,
+                    help="number of processes scoring the files; large files "
+                        "are split between them (default = 1)",
+                    action="store")
+    parser.add_argument("--max_order",
+                    type = int,
+                    default = 0,
+                    help="score with ngrams of at most this size (default = "
+                        "0, the model's largest)",
+                    action="store")
+    parser.add_argument("--progress",
+                    help="log the tokens scored per second while evaluating",
+                    action="store_true")
+    args = parser.parse_args()
+    if not args.files and not args.sentence:
+        parser.error('at least one file or --sentence required')
+
+    if args.sentence:
+        init_worker(args.model, args.scorer, args.max_order)
+    for sentence in args.sentence or []:
+        print(json.dumps(worker_evaluator.score_sentence(sentence)))
+    if args.files:
+        throughput = None
+        if args.progress:
+            throughput = Throughput('evaluate')
+        report = evaluate_files(args.model, args.files, args.scorer,
+            max(args.processes, 1), throughput, args.max_order)
+        print(json.dumps(report, indent = 2, sort_keys = True))
@@ -0,0 +1,240 @@
+from wordprob import WordProb
+from util import Utilities
+import modelfile
+import subprocess
+import argparse
+import sys
+import os
+
+# --append starts compacting the journal in the background once it holds
+# this many segments
+COMPACT_SEGMENTS = 8
+# How many times LOAD_WORD_PROBS starts over when a compaction replaces the
+# files it is reading
+LOAD_ATTEMPTS = 5
+
+# A model file can have a journal: a directory of segments next to it, each
+# a model file of its own holding only the counts of the data appended in
+# one go. Appending new data writes one small segment instead of rewriting
+# the whole model, and loading the model merges the segments into it.
+# Compacting folds the segments into the model file and deletes them.
+#
+# Segments are numbered in the order they were appended, and every model
+# file records the number of the last segment already counted in it, its
+# journal position. Loading only merges the segments after that position,
+# so a model is read consistently even while a compaction is replacing it.
+
+
+# Returns the directory holding the journal of the model file MODEL_NAME
+def journal_dir(model_name):
+    return model_name + '.journal'
+
+# Returns the path of the segment numbered NUMBER in MODEL_NAME's journal
+def segment_path(model_name, number):
+    return os.path.join(journal_dir(model_name), 'segment.%08d.bin' % number)
+
+# Returns a sorted list of (number, path) tuples for every segment in the
+# journal of MODEL_NAME
+def list_segments(model_name):
+    directory = journal_dir(model_name)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    segments = []
+    for name in names:
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] == 'segment' and parts[2] == 'bin' \
+            and parts[1].isdigit():
+            segments.append((int(parts[1]), os.path.join(directory, name)))
+    return sorted(segments)
+
+# Maps the model file FILENAME into a WordProb, without its journal.
+# Returns a tuple (WordProb, journal position)
+def read_word_probs(filename):
+    vocab, store, position = modelfile.read_model(filename)
+    word_probs = WordProb()
+    word_probs.vocab = vocab
+    word_probs.store = store
+    return (word_probs, position)
+
+# Returns the number of the last segment that is either counted in the
+# model file MODEL_NAME or waiting in its journal, or 0 if there is none. A
+# model file that can't be read, such as one written with an older format
+# version, counts no segments, since it is about to be rewritten from scratch
+def last_position(model_name):
+    position = 0
+    if modelfile.is_model_file(model_name):
+        try:
+            position = read_word_probs(model_name)[1]
+        except ValueError:
+            pass
+    for number, path in list_segments(model_name):
+        position = max(position, number)
+    return position
+
+# Merges every segment of MODEL_NAME's journal after POSITION into one
+# WordProb. Returns a tuple (WordProb, number of the last segment merged),
+# or (None, POSITION) if there are none. Raises FileNotFoundError if the
+# segments after POSITION are not all there, which means a compaction has
+# folded them into a newer model file
+def read_segments(model_name, position):
+    segments = [(number, path) for number, path in
+        list_segments(model_name) if number > position]
+    if len(segments) == 0:
+        return (None, position)
+    for i in range(len(segments)):
+        if segments[i][0] != position + i + 1:
+            raise FileNotFoundError("segment %d of '%s' is missing" % (
+                position + i + 1, model_name))
+    delta = WordProb()
+    for number, path in segments:
+        delta.merge(read_word_probs(path)[0])
+    return (delta, segments[-1][0])
+
+# Loads the model file MODEL_NAME with every segment of its journal that
+# is not yet counted in it. The segments are merged together first, so the
+# model is only merged with them once. Returns a tuple (WordProb, journal
+# position). Raises IOError or ValueError if the files can't be read.
+#
+# A compaction replaces the model file before deleting any segment, so if
+# the model file is the same one after the segments have been listed, no
+# segment it needs can have been deleted yet
+def load_word_probs(model_name):
+    for attempt in range(LOAD_ATTEMPTS):
+        before = os.stat(model_name)
+        word_probs, position = read_word_probs(model_name)
+        try:
+            delta, position = read_segments(model_name, position)
+        except FileNotFoundError:
+            # compacted while being read, so the model file has them now
+            continue
+        if not os.path.samestat(before, os.stat(model_name)):
+            continue
+        if delta != None:
+            word_probs.merge(delta)
+        return (word_probs, position)
+    raise IOError("'%s' kept changing while it was read" % model_name)
+
+# Writes the counts of WORD_PROBS as the next segment of the journal of
+# MODEL_NAME, without touching the model file. The segment is written under
+# a temporary name and then linked to its final name, so readers never see
+# part of a segment and two writers never take the same number. Returns the
+# segment's number
+def append_segment(model_name, word_probs):
+    word_probs.freeze()
+    directory = journal_dir(model_name)
+    os.makedirs(directory, exist_ok = True)
+    temp_name = os.path.join(directory, 'tmp.%d.bin' % os.getpid())
+    modelfile.write_model(temp_name, word_probs.vocab, word_probs.store)
+    number = last_position(model_name) + 1
+    try:
+        while True:
+            try:
+                os.link(temp_name, segment_path(model_name, number))
+                return number
+            except FileExistsError:
+                number += 1
+    finally:
+        os.remove(temp_name)
+
+# Deletes every segment of MODEL_NAME's journal numbered POSITION or less
+def remove_segments(model_name, position):
+    for number, path in list_segments(model_name):
+        if number <= position:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# Writes WORD_PROBS to the model file MODEL_NAME, replacing the model and
+# everything in its journal
+def save_word_probs(model_name, word_probs):
+    word_probs.freeze()
+    position = last_position(model_name)
+    modelfile.write_model(model_name, word_probs.vocab, word_probs.store,
+        position)
+    remove_segments(model_name, position)
+
+# Returns True if the process that wrote the lock file at PATH is running
+def lock_is_held(path):
+    try:
+        with open(path) as file:
+            pid = int(file.read() or 0)
+    except (IOError, ValueError):
+        return False
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Takes the lock that allows one compaction of MODEL_NAME at a time. A
+# lock left by a compaction that died is taken over. Returns the path of
+# the lock file, or None if another compaction is running
+def acquire_lock(model_name):
+    path = os.path.join(journal_dir(model_name), 'compact.lock')
+    for attempt in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if lock_is_held(path):
+                return None
+            os.remove(path)
+            continue
+        with os.fdopen(fd, 'w') as file:
+            file.write(str(os.getpid()))
+        return path
+    return None
+
+# Folds every segment of MODEL_NAME's journal into the model file and
+# deletes them. The new model file replaces the old one atomically, and
+# records the last segment it counts, so that readers never count a
+# segment twice. Segments appended while compacting are left for next
+# time. Returns the number of segments folded, or None if another
+# compaction is already running
+def compact(model_name):
+    if not os.path.isdir(journal_dir(model_name)):
+        return 0
+    lock = acquire_lock(model_name)
+    if lock == None:
+        return None
+    try:
+        base_position = read_word_probs(model_name)[1]
+        word_probs, position = load_word_probs(model_name)
+        if position > base_position:
+            word_probs.freeze()
+            modelfile.write_model(model_name, word_probs.vocab,
+                word_probs.store, position)
+        remove_segments(model_name, position)
+        return position - base_position
+    finally:
+        os.remove(lock)
+
+# Starts compacting MODEL_NAME's journal in a separate process that keeps
+# running after this one exits. Returns the subprocess.Popen object
+def compact_in_background(model_name):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+        model_name], start_new_session = True)
+
+# Compacts the journal of a model file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model",
+                    help="the model file whose journal is compacted",
+                    action="store")
+    args = parser.parse_args()
+    try:
+        folded = compact(args.model)
+    except (IOError, ValueError) as e:
+        sys.exit("Fatal Error: cannot compact '%s': %s" % (args.model, e))
+    if folded == None:
+        Utilities.log("'%s' is already being compacted", (args.model),
+            sys.stderr)
+    else:
+        Utilities.log("Compacted %d journal segments into '%s'", (folded,
+            args.model), sys.stderr)
@@ -0,0 +1,127 @@
+from util import Histogram
+import argparse
+import asyncio
+import random
+import json
+import time
+
+# Seeds used when no seed file is given
+DEFAULT_SEEDS = ["the", "it was", "one of the", "in the", "he said",
+    "there is no", "we", "after the"]
+
+
+# Opens a connection to the server on the Unix socket at SOCKET_PATH, or on
+# HOST and PORT if SOCKET_PATH is None. Returns a (reader, writer) pair
+async def connect(socket_path = None, host = '127.0.0.1', port = 8765):
+    if socket_path != None:
+        return await asyncio.open_unix_connection(socket_path)
+    return await asyncio.open_connection(host, port)
+
+# Sends each request in the list REQUESTS over one connection, waiting for
+# each response before sending the next request. Returns the list of
+# responses, and adds the round trip time of each request to HISTOGRAM if it
+# is not None
+async def send_requests(requests, socket_path = None, host = '127.0.0.1',
+    port = 8765, histogram = None):
+    reader, writer = await connect(socket_path, host, port)
+    responses = []
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            writer.write((json.dumps(request) + '\n').encode('utf-8'))
+            await writer.drain()
+            line = await reader.readline()
+            if histogram != None:
+                histogram.add(time.perf_counter() - start)
+            responses.append(json.loads(line))
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return responses
+
+# Runs CLIENTS connections at once, each sending NUM_REQUESTS requests built
+# from REQUEST by filling in a seed drawn at random from SEEDS. Returns a
+# dictionary with the number of requests and errors, the requests per
+# second, the latency seen by the clients and the server's own stats
+async def run_load(seeds, request, clients, num_requests, socket_path = None,
+    host = '127.0.0.1', port = 8765, rng = random):
+    histogram = Histogram()
+    batches = []
+    for i in range(clients):
+        batch = []
+        for j in range(num_requests):
+            batch.append(dict(request, seed = rng.choice(seeds),
+                id = i * num_requests + j))
+        batches.append(batch)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[send_requests(batch, socket_path, host,
+        port, histogram) for batch in batches])
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    responses = [response for result in results for response in result]
+    errors = sum(1 for response in responses if 'error' in response)
+    stats = await send_requests([{'op': 'stats'}], socket_path, host, port)
+    return {'requests': len(responses), 'errors': errors,
+        'requests_per_sec': len(responses) / elapsed,
+        'latency': histogram.summary(), 'server': stats[0]}
+
+# Measures the throughput and latency of a running server.py
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--socket",
+                    help="connect to a Unix socket at this path",
+                    action="store")
+    parser.add_argument("--host",
+                    default = '127.0.0.1',
+                    help="the address of the server (default = 127.0.0.1)",
+                    action="store")
+    parser.add_argument("-p", "--port",
+                    type = int,
+                    default = 8765,
+                    help="the TCP port of the server (default = 8765)",
+                    action="store")
+    parser.add_argument("-c", "--clients",
+                    type = int,
+                    default = 32,
+                    help="the number of concurrent connections (default = 32)",
+                    action="store")
+    parser.add_argument("-r", "--requests",
+                    type = int,
+                    default = 100,
+                    help="the number of requests sent by each connection "
+                        "(default = 100)",
+                    action="store")
+    parser.add_argument("-o", "--op",
+                    default = 'generate',
+                    choices = ['generate', 'next'],
+                    help="the kind of request to send (default = generate)",
+                    action="store")
+    parser.add_argument("-n",
+                    type = int,
+                    default = 20,
+                    help="the number of words to generate, or to return for "
+                        "next (default = 20)",
+                    action="store")
+    parser.add_argument("--sample",
+                    help="sample generated words rather than taking the most "
+                        "likely",
+                    action="store_true")
+    parser.add_argument("-sf", "--seed_file",
+                    help="a file with one seed per line to draw seeds from",
+                    action="store")
+    args = parser.parse_args()
+
+    seeds = DEFAULT_SEEDS
+    if args.seed_file != None:
+        with open(args.seed_file) as file:
+            seeds = [line.rstrip('\n') for line in file]
+    if args.op == 'generate':
+        request = {'op': 'generate', 'max_words': args.n,
+            'sample': args.sample}
+    else:
+        request = {'op': 'next', 'num': args.n}
+
+    report = asyncio.run(run_load(seeds, request, args.clients,
+        args.requests, args.socket, args.host, args.port))
+    print(json.dumps(report, indent = 2, sort_keys = True))
@@ -0,0 +1,253 @@
+from store import NgramStore
+import array
+import mmap
+import os
+import tempfile
+import struct
+import sys
+
+# Binary model files start with this magic string, followed by the version of
+# the format. Bump FORMAT_VERSION whenever the layout below changes
+MAGIC = b'NGRAMMDL'
+FORMAT_VERSION = 2
+
+# Layout of a model file:
+#   header: MAGIC, format version, number of sections, byte order flag
+#   section table: one entry per section, holding a name, an array typecode,
+#       the byte offset of the section and the number of items in it
+#   sections: raw array data, each starting on an 8 byte boundary
+#
+# Sections:
+#   vocab_offsets: byte offsets of each word in vocab_data (one extra entry)
+#   vocab_data: the utf-8 encoded words, back to back
+#   vocab_sorted: word ids, sorted by word, for binary searching a word's id
+#   contexts.K, offsets.K, totals.K: the NgramStore tables for length K
+#   children.K: the NgramStore trie links from length K to K + 1, for every
+#       K but the longest
+#   successors, counts: the NgramStore successor arrays. Counts are read
+#       with the typecode they were written with, so files with 32 bit counts
+#       still load
+#   journal_position: the number of the last journal segment whose counts
+#       are included in the model (see journal.py). Files written before
+#       journals existed don't have it, and are at position 0
+HEADER = struct.Struct('<8sIIB7x')
+SECTION = struct.Struct('<16scQQ')
+ALIGNMENT = 8
+
+
+# A read only vocabulary backed by the sections of a mapped model file.
+# Nothing is decoded up front; words are decoded the first time they are
+# looked up, so loading stays fast no matter how big the vocabulary is
+class MappedVocabulary:
+
+    # Class Members:
+    #   self.offsets: The vocab_offsets section
+    #   self.data: The vocab_data section
+    #   self.sorted_ids: The vocab_sorted section
+    #   self.decoded: A dictionary caching every word decoded so far
+
+    def __init__(self, offsets, data, sorted_ids):
+        self.offsets = offsets
+        self.data = data
+        self.sorted_ids = sorted_ids
+        self.decoded = dict()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Returns the word with the id WORD_ID
+    def get_word(self, word_id):
+        word = self.decoded.get(word_id)
+        if word == None:
+            start = self.offsets[word_id]
+            end = self.offsets[word_id + 1]
+            word = bytes(self.data[start:end]).decode('utf-8')
+            self.decoded[word_id] = word
+        return word
+
+    # Returns the id of WORD, or None if it hasn't been seen. Words are
+    # sorted by their utf-8 encoding, which orders them the same way as
+    # comparing the strings
+    def get_id(self, word):
+        sorted_ids = self.sorted_ids
+        lo = 0
+        hi = len(sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_word(sorted_ids[mid]) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(sorted_ids) and self.get_word(sorted_ids[lo]) == word:
+            return sorted_ids[lo]
+        return None
+
+    # Converts the list of strings in WORDS into a tuple of ids. Returns None
+    # if any of the words hasn't been seen
+    def get_ids(self, words):
+        context = []
+        for word in words:
+            word_id = self.get_id(word)
+            if word_id == None:
+                return None
+            context.append(word_id)
+        return tuple(context)
+
+    # Returns a mutable Vocabulary holding the same words and ids
+    def thaw(self):
+        from store import Vocabulary
+        vocab = Vocabulary()
+        for word_id in range(len(self)):
+            vocab.add(self.get_word(word_id))
+        return vocab
+
+
+# Returns the sections holding the Vocabulary VOCAB, as a list of (name,
+# array) tuples
+def vocab_sections(vocab):
+    encoded = [vocab.get_word(i).encode('utf-8') for i in range(len(vocab))]
+    vocab_offsets = array.array('q', [0])
+    for word in encoded:
+        vocab_offsets.append(vocab_offsets[-1] + len(word))
+    vocab_data = array.array('B', b''.join(encoded))
+    vocab_sorted = array.array('i', sorted(range(len(encoded)),
+        key=encoded.__getitem__))
+    return [('vocab_offsets', vocab_offsets),
+        ('vocab_data', vocab_data),
+        ('vocab_sorted', vocab_sorted)]
+
+# Returns a MappedVocabulary over the vocabulary sections in SECTIONS, a
+# dictionary returned by READ_SECTIONS
+def read_vocab(sections):
+    return MappedVocabulary(sections['vocab_offsets'],
+        sections['vocab_data'], sections['vocab_sorted'])
+
+# Writes the Vocabulary VOCAB and the NgramStore STORE to FILENAME. The file is
+# written next to its destination and then renamed over it, so processes that
+# have the old file mapped keep a consistent view. JOURNAL_POSITION is the
+# number of the last journal segment already counted in STORE
+def write_model(filename, vocab, store, journal_position = 0):
+    sections = vocab_sections(vocab)
+    for k in sorted(store.contexts.keys()):
+        sections.append(('contexts.%d' % k, store.contexts[k]))
+        sections.append(('offsets.%d' % k, store.offsets[k]))
+        sections.append(('totals.%d' % k, store.totals[k]))
+        if k in store.children:
+            sections.append(('children.%d' % k, store.children[k]))
+    sections.append(('successors', store.successors))
+    sections.append(('counts', store.counts))
+    sections.append(('journal_position', array.array('q',
+        [journal_position])))
+    write_sections(filename, sections)
+
+# The process's umask, read once, since reading it means setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Writes SECTIONS, a list of (name, array) tuples, to FILENAME in the layout
+# described above, starting with MAGIC and VERSION. The file is written
+# under a unique temporary name next to its destination, so writers racing
+# for the same file never share one, and then renamed over it
+def write_sections(filename, sections, magic = MAGIC,
+    version = FORMAT_VERSION):
+    position = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, values in sections:
+        position = _align(position)
+        table.append(SECTION.pack(name.encode('ascii'),
+            values.typecode.encode('ascii'), position, len(values)))
+        position += len(values) * values.itemsize
+
+    descriptor, temp_name = tempfile.mkstemp(suffix = '.tmp',
+        prefix = os.path.basename(filename) + '.',
+        dir = os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(HEADER.pack(magic, version, len(sections),
+                sys.byteorder == 'little'))
+            for entry in table:
+                file.write(entry)
+            for name, values in sections:
+                file.write(b'\0' * (_align(file.tell()) - file.tell()))
+                file.write(_as_bytes(values))
+        # mkstemp only lets the owner read the file
+        os.chmod(temp_name, 0o666 & ~_UMASK)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+# Maps the model file FILENAME into memory. Returns a tuple (vocab, store,
+# journal position) whose arrays are views into the mapping, so pages are
+# only read from disk when a lookup touches them and are shared by every
+# process that maps the same file. Raises ValueError if the file is not a
+# model of this version
+def read_model(filename):
+    version, sections = read_sections(filename)
+    if version != FORMAT_VERSION:
+        raise ValueError("'%s' has format version %d, expected %d; please "
+            "re-train the model" % (filename, version, FORMAT_VERSION))
+
+    vocab = read_vocab(sections)
+    store = NgramStore()
+    for name, values in sections.items():
+        if name.startswith('contexts.'):
+            k = int(name.split('.')[1])
+            store.contexts[k] = values
+            store.offsets[k] = sections['offsets.%d' % k]
+            store.totals[k] = sections['totals.%d' % k]
+            if 'children.%d' % k in sections:
+                store.children[k] = sections['children.%d' % k]
+    store.successors = sections['successors']
+    store.counts = sections['counts']
+    journal_position = 0
+    if 'journal_position' in sections:
+        journal_position = sections['journal_position'][0]
+    return (vocab, store, journal_position)
+
+# Maps the file FILENAME, written by WRITE_SECTIONS with MAGIC, into memory.
+# Returns a tuple (format version, sections), where sections is a
+# dictionary mapping each section's name to a memoryview of its items.
+# Raises ValueError if the file doesn't start with MAGIC or was written
+# with a different byte order
+def read_sections(filename, magic = MAGIC):
+    with open(filename, 'rb') as file:
+        mapping = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+    view = memoryview(mapping)
+
+    if len(mapping) < HEADER.size:
+        raise ValueError("'%s' is not a model file" % filename)
+    found, version, num_sections, little = HEADER.unpack_from(mapping, 0)
+    if found != magic:
+        raise ValueError("'%s' is not a model file" % filename)
+    if bool(little) != (sys.byteorder == 'little'):
+        raise ValueError("'%s' was written on a machine with a different "
+            "byte order" % filename)
+
+    sections = dict()
+    for i in range(num_sections):
+        name, typecode, offset, length = SECTION.unpack_from(mapping,
+            HEADER.size + i * SECTION.size)
+        typecode = typecode.decode('ascii')
+        size = array.array(typecode).itemsize
+        name = name.rstrip(b'\0').decode('ascii')
+        sections[name] = view[offset:offset + length * size].cast(typecode)
+    return (version, sections)
+
+# Returns True if FILENAME starts with the magic string of a model file
+def is_model_file(filename):
+    try:
+        with open(filename, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+# Rounds POSITION up to the next multiple of ALIGNMENT
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+# Returns the raw bytes of VALUES, which is an array or a memoryview
+def _as_bytes(values):
+    if isinstance(values, memoryview):
+        return values.cast('B')
+    return values.tobytes()
@@ -0,0 +1,312 @@
+from util import Utilities
+import threading
+import functools
+import atexit
+import time
+import sys
+import os
+
+# True while the stages below are instrumented
+ENABLED = False
+
+# The time between two samples of the stack sampler, in seconds
+SAMPLE_INTERVAL = 0.001
+
+# The total calls and seconds spent in every stage, keyed by stage name. A
+# stage that calls another includes the time of the inner one
+timers = dict()
+# Named counters, such as the number of lookups
+counters = dict()
+# Named observations, such as the length of every successor list: a list
+# [count, total, max] for each name
+values = dict()
+# Scratch space for hooks that pass a value from an inner stage to an outer
+# one, such as the context length matched by a lookup
+state = dict()
+# A list of (owner, attribute name, original value) for every attribute
+# replaced by ENABLE, so that DISABLE can put them back
+originals = []
+
+
+# Adds AMOUNT to the counter NAME
+def count(name, amount = 1):
+    counters[name] = counters.get(name, 0) + amount
+
+# Records one observation of VALUE for NAME
+def observe(name, value):
+    found = values.get(name)
+    if found == None:
+        values[name] = [1, value, value]
+        return
+    found[0] += 1
+    found[1] += value
+    if value > found[2]:
+        found[2] = value
+
+# Returns FUNCTION wrapped so that every call is timed as STAGE. BEFORE, if
+# given, is called with the arguments before the call, and AFTER, if given,
+# with the arguments, the result and whatever BEFORE returned once the call
+# is done. Neither is included in the stage's time
+def timed(stage, function, before = None, after = None):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        saved = None
+        if before != None:
+            saved = before(args)
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        timer = timers.get(stage)
+        if timer == None:
+            timers[stage] = [1, elapsed]
+        else:
+            timer[0] += 1
+            timer[1] += elapsed
+        if after != None:
+            after(args, result, saved)
+        return result
+    return wrapper
+
+# The code of every wrapper made by TIMED
+WRAPPER_CODE = timed(None, len).__code__
+
+# The BEFORE and AFTER hooks of the stages below. The hooks of a lookup
+# record the context length matched by the trie walk, how far that is from
+# the longest context that could have matched, and the number of
+# successors found
+def after_find_suffix(args, result, saved):
+    matched = 0
+    if result != None:
+        matched = result[3]
+    observe('matched_length', matched)
+    state['matched_length'] = matched
+
+def after_find_longest_context(args, result, saved):
+    word_probs, words = args[0:2]
+    count('lookups')
+    if result == None:
+        count('lookup_misses')
+    else:
+        observe('successors', result[1] - result[0])
+    wanted = min(len(words), word_probs.store.max_context_length())
+    observe('backoff_depth', max(wanted - state.get('matched_length', 0), 0))
+
+def after_get_next_words(args, result, saved):
+    if result != None:
+        observe('candidates', len(result))
+
+def before_cache_get(args):
+    return args[0].hits
+
+def after_cache_get(args, result, saved):
+    if args[0].hits > saved:
+        count('cache_hits')
+    else:
+        count('cache_misses')
+
+# The stages instrumented by ENABLE: a list of (module name, class name or
+# None for a module function, attribute name, stage name, BEFORE, AFTER)
+STAGES = [
+    ('text', 'TextUtils', 'normalize_line', 'normalize', None, None),
+    ('text', 'TextUtils', 'normalize_lines', 'normalize', None, None),
+    ('text', 'TextUtils', 'iter_chunk_tokens', 'read_tokens', None, None),
+    ('wordprob', 'WordProb', 'add_ngram_observations', 'train', None, None),
+    ('wordprob', 'WordProb', 'freeze', 'freeze', None, None),
+    ('wordprob', 'WordProb', 'find_longest_context', 'lookup', None,
+        after_find_longest_context),
+    ('wordprob', 'WordProb', 'get_ranked_range', 'rank', None, None),
+    ('wordprob', 'WordGenerator', 'get_next_words', 'next_words', None,
+        after_get_next_words),
+    ('wordprob', 'WordGenerator', 'sample_next_words', 'sample', None, None),
+    ('wordprob', 'WordGenerator', 'get_completions', 'complete_word', None,
+        None),
+    ('store', 'NgramStore', 'find_suffix', 'trie_walk', None,
+        after_find_suffix),
+    ('store', 'NgramStore', 'merge', 'store_merge', None, None),
+    ('scorers', 'Scorer', 'prepare', 'scorer_prepare', None, None),
+    ('scorers', 'Scorer', 'get_next_words', 'smoothed_next_words', None,
+        after_get_next_words),
+    ('evaluate', 'Evaluator', 'find_nodes', 'context_lookup', None, None),
+    ('util', 'LRUCache', 'get', 'cache_get', before_cache_get,
+        after_cache_get),
+    ('word_predictor', None, 'predict_words', 'predict', None, None),
+    ('word_predictor', None, 'predict_many', 'predict_many', None, None),
+    ('word_predictor', None, 'beam_search', 'beam_search', None, None),
+    ('word_predictor', None, 'next_word_batch', 'choose', None, None),
+    ('word_predictor', None, 'load_word_gen', 'load', None, None),
+    ('word_predictor', None, 'save_word_gen', 'save', None, None),
+]
+
+# Instruments every stage in STAGES, so that calls to them are timed and
+# counted until DISABLE is called. Modules are found in MODULES, a
+# dictionary mapping module names to modules, and then among the modules
+# already imported; stages of modules that were never imported are skipped.
+# A script run as __main__ passes itself in MODULES. Nothing is
+# instrumented until this is called, so the stages cost nothing otherwise
+def enable(modules = None):
+    global ENABLED
+    if ENABLED:
+        return
+    if modules == None:
+        modules = dict()
+    for module_name, class_name, name, stage, before, after in STAGES:
+        module = modules.get(module_name, sys.modules.get(module_name))
+        if module == None:
+            continue
+        owner = module
+        if class_name != None:
+            owner = getattr(module, class_name)
+        original = owner.__dict__[name]
+        if isinstance(original, staticmethod):
+            replacement = staticmethod(timed(stage, original.__func__,
+                before, after))
+        else:
+            replacement = timed(stage, original, before, after)
+        originals.append((owner, name, original))
+        setattr(owner, name, replacement)
+    ENABLED = True
+
+# Puts back every stage instrumented by ENABLE. The stats are kept
+def disable():
+    global ENABLED
+    while len(originals) > 0:
+        owner, name, original = originals.pop()
+        setattr(owner, name, original)
+    ENABLED = False
+
+# Clears every timer, counter and value
+def reset():
+    timers.clear()
+    counters.clear()
+    values.clear()
+    state.clear()
+
+# Returns a dictionary of the stats so far: 'timers' maps every stage to
+# its 'calls', 'seconds' and 'mean_us', 'counters' maps every counter to
+# its value, and 'values' maps every observed name to its 'count', 'mean'
+# and 'max'
+def snapshot():
+    return {
+        'timers': dict((stage, {'calls': calls, 'seconds': seconds,
+            'mean_us': seconds / calls * 1e6})
+            for stage, (calls, seconds) in timers.items()),
+        'counters': dict(counters),
+        'values': dict((name, {'count': number, 'mean': total / number,
+            'max': largest})
+            for name, (number, total, largest) in values.items()),
+    }
+
+# Logs the stats so far to FILE, slowest stage first
+def log_snapshot(file = sys.stderr):
+    stats = snapshot()
+    for stage, timer in sorted(stats['timers'].items(),
+        key=lambda pair: -pair[1]['seconds']):
+        Utilities.log("profile: %-20s %10d calls %10.3f s %10.1f us/call",
+            (stage, timer['calls'], timer['seconds'], timer['mean_us']), file)
+    for name, value in sorted(stats['counters'].items()):
+        Utilities.log("profile: %-20s %10d", (name, value), file)
+    for name, value in sorted(stats['values'].items()):
+        Utilities.log("profile: %-20s %10.2f mean %10d max",
+            (name, value['mean'], value['max']), file)
+
+
+# Samples the stack of one thread every INTERVAL seconds from a background
+# thread, and counts how often each stack is seen. The counts are written
+# as collapsed stacks, one "outer;inner;innermost count" line per stack,
+# which is what flamegraph.pl and speedscope read
+class StackSampler:
+
+    # Class Members:
+    #   self.thread_id: The id of the thread being sampled
+    #   self.interval: The seconds between two samples
+    #   self.stacks: A dictionary mapping collapsed stacks to their counts
+    #   self.running: False once STOP has been called
+    #   self.thread: The background thread taking the samples
+
+    def __init__(self, thread_id = None, interval = SAMPLE_INTERVAL):
+        if thread_id == None:
+            thread_id = threading.get_ident()
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = dict()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame != None:
+                stack = self.collapse(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            del frame
+            time.sleep(self.interval)
+
+    # Returns the stack ending at FRAME as "outer;inner;innermost", naming
+    # each frame by its file and function. The wrappers added by ENABLE are
+    # left out
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame != None:
+            code = frame.f_code
+            frame = frame.f_back
+            if code is WRAPPER_CODE:
+                continue
+            names.append("%s:%s" % (os.path.basename(code.co_filename),
+                code.co_name))
+        names.reverse()
+        return ';'.join(names)
+
+    # Writes the collapsed stacks to the file at FILE_PATH
+    def write(self, file_path):
+        with open(file_path, 'w') as file:
+            for stack, samples in sorted(self.stacks.items()):
+                file.write("%s %d\n" % (stack, samples))
+
+
+# Profiles the rest of the program: every stage is instrumented as by
+# ENABLE, with MODULES, and when the program exits the stats are logged.
+# If PROFILE_PATH is given the program runs under cProfile, whose stats are
+# dumped there for pstats and the 20 slowest functions are logged. If
+# STACKS_PATH is given the stack sampler runs, and its collapsed stacks are
+# written there. cProfile and pstats are only imported here, since every
+# run of word_predictor.py imports this module
+def profile_until_exit(modules = None, profile_path = None,
+    stacks_path = None):
+    import cProfile
+    import pstats
+    enable(modules)
+    profile = None
+    if profile_path != None:
+        profile = cProfile.Profile()
+    sampler = None
+    if stacks_path != None:
+        sampler = StackSampler()
+
+    def finish():
+        if profile != None:
+            profile.disable()
+            profile.dump_stats(profile_path)
+            pstats.Stats(profile, stream = sys.stderr).sort_stats(
+                'cumulative').print_stats(20)
+        if sampler != None:
+            sampler.stop()
+            sampler.write(stacks_path)
+        log_snapshot()
+
+    atexit.register(finish)
+    if sampler != None:
+        sampler.start()
+    if profile != None:
+        profile.enable()
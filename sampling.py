@@ -0,0 +1,112 @@
+from collections import OrderedDict
+import array
+
+# The number of alias tables a Sampler keeps before dropping the least
+# recently used one
+MAX_TABLES = 100000
+
+
+# A Walker alias table for drawing from a fixed discrete distribution in
+# constant time, no matter how many outcomes it has. Building the table takes
+# time linear in the number of outcomes, so it is done once per distribution
+class AliasTable:
+
+    # Class Members:
+    #   self.prob: For each column i, the probability of returning i rather
+    #       than self.alias[i] once column i has been picked
+    #   self.alias: For each column, the outcome returned otherwise
+
+    # Builds a table for the list of non-negative WEIGHTS, which do not need
+    # to add up to 1. Uses Vose's method, which is numerically stable
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * n / total for weight in weights]
+        self.prob = array.array('d', [1.0]) * n
+        self.alias = array.array('i', range(n))
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while len(small) > 0 and len(large) > 0:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # anything left over is 1 up to rounding error, so keeps prob 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    # Returns a random outcome, as an index into the weights the table was
+    # built from. RNG is a random.Random object or the random module
+    def sample(self, rng):
+        column = int(rng.random() * len(self.prob))
+        if rng.random() < self.prob[column]:
+            return column
+        return self.alias[column]
+
+
+# Draws successors of a context from an NgramStore. Each distinct context and
+# set of options gets an AliasTable the first time it is sampled from, so
+# every later draw costs the same however many successors the context has
+class Sampler:
+
+    # Class Members:
+    #   self.store: The NgramStore being sampled from
+    #   self.tables: An OrderedDict of AliasTables, least recently used
+    #       first, keyed by (start, temperature, top_k, top_p)
+    #   self.max_tables: The number of tables kept at most
+
+    def __init__(self, store, max_tables = MAX_TABLES):
+        self.store = store
+        self.tables = OrderedDict()
+        self.max_tables = max_tables
+
+    # Returns the position in the store of a successor drawn at random from
+    # the range START to END, which holds the successors of one context. Each
+    # successor is drawn in proportion to count ** (1 / TEMPERATURE), after
+    # keeping only the TOP_K most frequent successors (if TOP_K > 0) and the
+    # fewest most frequent successors whose probability adds up to at least
+    # TOP_P (if TOP_P < 1). RNG is a random.Random object or the random
+    # module
+    def sample(self, start, end, rng, temperature = 1.0, top_k = 0,
+        top_p = 1.0):
+        key = (start, temperature, top_k, top_p)
+        table = self.tables.get(key)
+        if table == None:
+            table = self.build_table(start, end, temperature, top_k, top_p)
+            self.tables[key] = table
+            if len(self.tables) > self.max_tables:
+                self.tables.popitem(last = False)
+        else:
+            self.tables.move_to_end(key)
+        return start + table.sample(rng)
+
+    # Builds the AliasTable used by SAMPLE
+    def build_table(self, start, end, temperature, top_k, top_p):
+        if temperature <= 0:
+            raise ValueError("temperature must be greater than 0")
+        if top_k > 0:
+            end = min(end, start + top_k)
+        counts = self.store.counts
+        # successors are sorted by count, so dividing by the first keeps
+        # every weight at most 1 however small the temperature is
+        highest = float(counts[start])
+        exponent = 1.0 / temperature
+        weights = [(counts[i] / highest) ** exponent for i in range(start, end)]
+
+        if top_p < 1.0:
+            total = sum(weights)
+            needed = top_p * total
+            mass = 0.0
+            for i in range(len(weights)):
+                mass += weights[i]
+                if mass >= needed:
+                    weights = weights[0:i + 1]
+                    break
+        return AliasTable(weights)
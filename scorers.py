@@ -0,0 +1,475 @@
+import itertools
+import array
+import bisect
+import heapq
+
+
+# Scores next words with a smoothed model instead of the raw count / total
+# of the longest matched context. A Scorer is built over a WordProb and
+# precomputes everything it needs from the WordProb's store when it is made,
+# and again by PREPARE whenever the store has changed, which WordGenerator
+# calls every time it freezes new observations. Lookups only read the
+# tables, so scoring a word is a walk of the trie plus one binary search
+# and a few array reads per matched context.
+#
+# The base class scores a word by its relative frequency in the longest
+# matched context, like the store's own ranking, and by its relative
+# frequency as a successor of every context of one word when no context is
+# matched. Subclasses smooth this by overriding BUILD_WEIGHTS, SCORE_NODES
+# and BOUNDS.
+class Scorer:
+
+    # Class Members:
+    #   self.word_probs: The WordProb being scored
+    #   self.store: The NgramStore the tables below were built from. Lookups
+    #       use it rather than self.word_probs.store, so they always read
+    #       the store and the tables of the same version
+    #   self.num_words: The number of words in the vocabulary when the
+    #       tables were built
+    #   self.sorted_ids: An array laid out like store.successors, but with
+    #       the successors of each context sorted by id, so that a word can
+    #       be found in a context by binary search
+    #   self.weights: An array of floats parallel to self.sorted_ids, filled
+    #       in by BUILD_WEIGHTS
+    #   self.by_weight: An array laid out like self.sorted_ids, holding the
+    #       positions in self.sorted_ids of the successors of each context,
+    #       highest weight first, then lowest id
+    #   self.unigram: An array of the score of every word id when no context
+    #       is matched, filled in by BUILD_WEIGHTS
+    #   self.unigram_ranked: An array of every word id, highest unigram
+    #       score first, for ranking words when no context is matched
+    #   self.max_order: The largest order scored, or 0 for every order in
+    #       the store. See SET_MAX_ORDER
+
+    def __init__(self, word_probs):
+        self.word_probs = word_probs
+        self.store = None
+        self.num_words = 0
+        self.sorted_ids = None
+        self.weights = None
+        self.by_weight = None
+        self.unigram = None
+        self.unigram_ranked = None
+        self.max_order = 0
+        self.prepare()
+
+    # Only scores with orders up to MAX_ORDER, matching at most MAX_ORDER - 1
+    # words of context, or every order in the store if MAX_ORDER is 0. The
+    # tables are rebuilt, since the longest order scored is smoothed
+    # differently from the shorter ones
+    def set_max_order(self, max_order):
+        max_order = max(max_order, 0)
+        if max_order != self.max_order:
+            self.max_order = max_order
+            self.store = None
+            self.prepare()
+
+    # Returns the length of the longest context scored
+    def max_context_length(self):
+        length = self.store.max_context_length()
+        if self.max_order > 0:
+            length = min(length, self.max_order - 1)
+        return length
+
+    # Rebuilds the precomputed tables if the store of self.word_probs has
+    # changed since they were built. This takes time in proportion to the
+    # size of the store, so it is only called when observations have been
+    # frozen or the scorer is set up, never by a lookup
+    def prepare(self):
+        store = self.word_probs.store
+        if self.store is store:
+            return
+        self.sorted_ids = array.array('i')
+        positions = array.array('q')
+        successors = store.successors
+        for k in sorted(store.offsets.keys()):
+            offsets = store.offsets[k]
+            for i in range(len(offsets) - 1):
+                ranked = sorted(range(offsets[i], offsets[i + 1]),
+                    key=successors.__getitem__)
+                positions.extend(ranked)
+                self.sorted_ids.extend([successors[pos] for pos in ranked])
+        self.store = store
+        self.num_words = len(self.word_probs.vocab)
+        self.build_weights(positions)
+
+        weights = self.weights
+        sorted_ids = self.sorted_ids
+        self.by_weight = array.array('q')
+        for k in sorted(store.offsets.keys()):
+            offsets = store.offsets[k]
+            for i in range(len(offsets) - 1):
+                self.by_weight.extend(sorted(range(offsets[i],
+                    offsets[i + 1]), key=lambda pos: (-weights[pos],
+                    sorted_ids[pos])))
+        unigram = self.unigram
+        self.unigram_ranked = array.array('i', sorted(range(len(unigram)),
+            key=lambda word_id: (-unigram[word_id], word_id)))
+
+    # Fills in self.weights and self.unigram, and anything else the scorer
+    # needs. POSITIONS holds, for each entry of self.sorted_ids, its
+    # position in the store. By default each weight is the entry's count
+    # over its context's total, and the unigram score of a word is its
+    # share of the successors of the contexts of one word
+    def build_weights(self, positions):
+        store = self.store
+        counts = store.counts
+        self.weights = array.array('d', [0.0]) * len(positions)
+        unigram = array.array('d', [0.0]) * self.num_words
+        for k in sorted(store.offsets.keys()):
+            offsets = store.offsets[k]
+            totals = store.totals[k]
+            for i in range(len(totals)):
+                for pos in range(offsets[i], offsets[i + 1]):
+                    self.weights[pos] = counts[positions[pos]] / totals[i]
+                    if k == 1:
+                        unigram[self.sorted_ids[pos]] += counts[positions[pos]]
+        total = sum(unigram)
+        if total > 0:
+            for word_id in range(len(unigram)):
+                unigram[word_id] /= total
+        self.unigram = unigram
+
+    # Returns the position in self.sorted_ids of WORD_ID among the
+    # successors of the I-th context of length K, or -1 if it isn't one
+    def locate(self, k, i, word_id):
+        offsets = self.store.offsets[k]
+        start = offsets[i]
+        end = offsets[i + 1]
+        pos = bisect.bisect_left(self.sorted_ids, word_id, start, end)
+        if pos < end and self.sorted_ids[pos] == word_id:
+            return pos
+        return -1
+
+    # Returns the trie nodes matched by the end of WORDS, a list of strings,
+    # as a list of (k, i) tuples from the shortest context to the longest
+    def find_nodes(self, words):
+        reversed_ids = map(self.word_probs.vocab.get_id, reversed(words))
+        if self.max_order > 0:
+            reversed_ids = itertools.islice(reversed_ids, self.max_order - 1)
+        return list(self.store.walk(reversed_ids))
+
+    # Returns a list of the nodes in NODES, as returned by FIND_NODES, that
+    # have successors, longest first
+    def matched_nodes(self, nodes):
+        offsets = self.store.offsets
+        return [(k, i) for k, i in reversed(nodes)
+            if offsets[k][i] < offsets[k][i + 1]]
+
+    # Returns the score of WORD_ID after the contexts NODES, as returned by
+    # FIND_NODES
+    def score_nodes(self, nodes, word_id):
+        matched = self.matched_nodes(nodes)
+        if len(matched) == 0:
+            return self.unigram[word_id]
+        k, i = matched[0]
+        pos = self.locate(k, i, word_id)
+        if pos >= 0:
+            return self.weights[pos]
+        return 0.0
+
+    # Returns a tuple (terms, unigram factor) bounding the score of any word
+    # after the contexts NODES: the score of a word is at most the sum of
+    # factor * (its weight in the I-th context of length K) over the
+    # (factor, k, i) tuples in the list TERMS, plus the unigram factor times
+    # its unigram score. GET_NEXT_WORDS uses it to stop looking at words as
+    # soon as none of the rest can be ranked higher
+    def bounds(self, nodes):
+        matched = self.matched_nodes(nodes)
+        if len(matched) == 0:
+            return ([], 1.0)
+        k, i = matched[0]
+        return ([(1.0, k, i)], 0.0)
+
+    # Returns the score of the string WORD coming after the list of strings
+    # WORDS, or 0 if WORD has never been seen
+    def score(self, words, word):
+        nodes = self.find_nodes(words)
+        word_id = self.word_probs.vocab.get_id(word)
+        if word_id == None or word_id >= self.num_words:
+            return 0.0
+        return self.score_nodes(nodes, word_id)
+
+    # Same as WordGenerator.get_next_words, but the words are ranked by their
+    # smoothed score, which is returned in place of the probability. When no
+    # context is matched, words are ranked by their unigram scores alone, as
+    # long as the scored orders include unigrams only (see SET_MAX_ORDER) or
+    # the store has the empty context, which is when the store's own ranking
+    # falls back to unigrams.
+    #
+    # Every word that can be scored is considered, without scoring them all:
+    # the successors of each matched context are read highest weight first,
+    # along with the unigrams, one from each at a time, and each word read is
+    # scored. By BOUNDS, no word not read yet can score more than the sum of
+    # the last weights read times their factors, so reading stops once
+    # NUM_TO_RETURN words score more than that
+    def get_next_words(self, words, min_preceding_match = -1,
+        num_to_return = 1):
+        if num_to_return < 1:
+            num_to_return = 1
+        nodes = self.find_nodes(words)
+        offsets = self.store.offsets
+        matched = [k for k, i in nodes if offsets[k][i] < offsets[k][i + 1]]
+        if len(matched) == 0:
+            if min_preceding_match > 0 or len(self.unigram_ranked) == 0 or \
+                (self.max_context_length() > 0 and 0 not in offsets):
+                return None
+            return self.rank_unigrams(num_to_return)
+        if matched[-1] < min_preceding_match:
+            return None
+
+        terms, unigram_factor = self.bounds(nodes)
+        # each source is [factor, next position, end, ranked ids or None]
+        sources = [[factor, offsets[k][i], offsets[k][i + 1], None]
+            for factor, k, i in terms if factor > 0]
+        if unigram_factor > 0:
+            sources.append([unigram_factor, 0, len(self.unigram_ranked),
+                self.unigram_ranked])
+        by_weight = self.by_weight
+        sorted_ids = self.sorted_ids
+        weights = self.weights
+        unigram = self.unigram
+        scores = dict()
+        best = []
+        while True:
+            threshold = 0.0
+            read = False
+            for source in sources:
+                factor, pos, end, ranked = source
+                if pos == end:
+                    continue
+                source[1] = pos + 1
+                read = True
+                if ranked == None:
+                    word_id = sorted_ids[by_weight[pos]]
+                    threshold += factor * weights[by_weight[pos]]
+                else:
+                    word_id = ranked[pos]
+                    threshold += factor * unigram[word_id]
+                if word_id not in scores:
+                    score = self.score_nodes(nodes, word_id)
+                    scores[word_id] = score
+                    if len(best) < num_to_return:
+                        heapq.heappush(best, score)
+                    elif score > best[0]:
+                        heapq.heapreplace(best, score)
+            # the margin keeps rounding from cutting off a tie
+            if not read or (len(best) == num_to_return and
+                best[0] > threshold * (1 + 1e-9)):
+                break
+        scored = sorted([(score, word_id) for word_id, score in
+            scores.items() if score > 0], key=lambda pair: (-pair[0],
+            pair[1]))
+        if len(scored) == 0:
+            return None
+
+        # keep any words tied with the last one, as the store does
+        stop = min(num_to_return, len(scored))
+        while stop < len(scored) and scored[stop][0] == scored[stop - 1][0]:
+            stop += 1
+        get_word = self.word_probs.vocab.get_word
+        return [(get_word(word_id), score)
+            for score, word_id in scored[0:stop]]
+
+    # Returns the NUM_TO_RETURN words with the highest unigram scores, plus
+    # any tied with the last of them, as GET_NEXT_WORDS does
+    def rank_unigrams(self, num_to_return):
+        unigram = self.unigram
+        ranked = self.unigram_ranked
+        stop = min(num_to_return, len(ranked))
+        while stop < len(ranked) and \
+            unigram[ranked[stop]] == unigram[ranked[stop - 1]]:
+            stop += 1
+        get_word = self.word_probs.vocab.get_word
+        return [(get_word(word_id), unigram[word_id])
+            for word_id in ranked[0:stop]]
+
+
+# Stupid backoff (Brants et al., 2007): the relative frequency of the word in
+# the longest matched context that has it, times ALPHA for every word of
+# context dropped to get there. Scores are not probabilities, since they
+# don't add up to 1, but they are cheap and rank well on large corpora
+class StupidBackoff(Scorer):
+
+    # Class Members:
+    #   self.alpha: The factor applied for every word of context dropped
+    #
+    # self.weights holds count / total for every entry and self.unigram the
+    # relative frequency of every word id as a successor, as in Scorer
+
+    def __init__(self, word_probs, alpha = 0.4):
+        self.alpha = alpha
+        Scorer.__init__(self, word_probs)
+
+    # Nodes that were only ever seen as the suffix of a longer context have
+    # no successors, so passing them doesn't drop any information and costs
+    # no factor of alpha
+    def score_nodes(self, nodes, word_id):
+        factor = 1.0
+        offsets = self.store.offsets
+        for k, i in reversed(nodes):
+            if offsets[k][i] == offsets[k][i + 1]:
+                continue
+            pos = self.locate(k, i, word_id)
+            if pos >= 0:
+                return factor * self.weights[pos]
+            factor *= self.alpha
+        return factor * self.unigram[word_id]
+
+    # A word's score is its weight in one matched context times ALPHA for
+    # every longer context that has successors, or its unigram score times
+    # ALPHA for every one of them
+    def bounds(self, nodes):
+        terms = []
+        factor = 1.0
+        for k, i in self.matched_nodes(nodes):
+            terms.append((factor, k, i))
+            factor *= self.alpha
+        return (terms, factor)
+
+
+# Interpolated Kneser-Ney smoothing (Chen and Goodman, 1998). The longest
+# contexts use their counts and every shorter context uses continuation
+# counts, the number of distinct words seen before it with the same
+# successor, so a word that is frequent only after one context doesn't get
+# a high probability everywhere else. Each order is discounted by D and
+# interpolated with the next shorter one, down to continuation unigrams
+# interpolated with a uniform distribution over the vocabulary, so the
+# scores are probabilities that add up to 1 over the vocabulary.
+#
+# D is estimated for each context length as n1 / (n1 + 2 * n2), where n1 and
+# n2 are the number of entries with a count of 1 and 2, unless DISCOUNT is
+# given
+class KneserNey(Scorer):
+
+    # Class Members:
+    #   self.discount: The discount D for every order, or None to estimate
+    #       one per context length
+    #   self.discounts: A dictionary mapping a context length K to the D
+    #       used for it, with K = 0 for the unigrams
+    #   self.gammas: A dictionary mapping K to an array holding, for each
+    #       context of length K, the weight given to the next shorter
+    #       context: D * (number of successors) / (count total)
+    #
+    # self.weights holds max(count - D, 0) / total for every entry, where
+    # count and total are continuation counts below the longest length, and
+    # self.unigram the interpolated continuation probability of every word id
+
+    def __init__(self, word_probs, discount = None):
+        self.discount = discount
+        self.discounts = dict()
+        self.gammas = dict()
+        Scorer.__init__(self, word_probs)
+
+    # Returns D for the list of counts COUNTS
+    def estimate_discount(self, counts):
+        if self.discount != None:
+            return self.discount
+        n1 = 0
+        n2 = 0
+        for count in counts:
+            if count == 1:
+                n1 += 1
+            elif count == 2:
+                n2 += 1
+        if n1 == 0:
+            return 0.75
+        return n1 / (n1 + 2.0 * n2)
+
+    # Precomputes continuation counts, discounted weights and interpolation
+    # weights for every context, and the unigram distribution
+    def build_weights(self, positions):
+        store = self.store
+        top = self.max_context_length()
+        sorted_ids = self.sorted_ids
+        num_words = self.num_words
+        self.weights = array.array('d', [0.0]) * len(positions)
+        self.gammas = dict()
+        self.discounts = dict()
+
+        # raw counts for the longest contexts, continuation counts for the
+        # shorter ones: how many contexts one word longer have the successor
+        kn_counts = array.array('q', [0]) * len(positions)
+        unigram_counts = array.array('q', [0]) * num_words
+        for k in sorted(store.offsets.keys()):
+            offsets = store.offsets[k]
+            if k == top:
+                for pos in range(offsets[0], offsets[-1]):
+                    kn_counts[pos] = store.counts[positions[pos]]
+            if k == 1 and (top > 0 or 0 not in store.offsets):
+                for pos in range(offsets[0], offsets[-1]):
+                    unigram_counts[sorted_ids[pos]] += 1
+            elif k == 0 and top == 0:
+                # unigrams are the longest order, so they use raw counts
+                for pos in range(offsets[0], offsets[-1]):
+                    unigram_counts[sorted_ids[pos]] += \
+                        store.counts[positions[pos]]
+            children = store.children.get(k)
+            if k >= top or children == None:
+                continue
+            longer = store.offsets[k + 1]
+            for i in range(len(offsets) - 1):
+                for child in range(children[i], children[i + 1]):
+                    for pos in range(longer[child], longer[child + 1]):
+                        found = self.locate(k, i, sorted_ids[pos])
+                        if found >= 0:
+                            kn_counts[found] += 1
+
+        for k in sorted(store.offsets.keys()):
+            offsets = store.offsets[k]
+            discount = self.estimate_discount(
+                kn_counts[offsets[0]:offsets[-1]])
+            self.discounts[k] = discount
+            gammas = array.array('d', [1.0]) * (len(offsets) - 1)
+            for i in range(len(offsets) - 1):
+                start = offsets[i]
+                end = offsets[i + 1]
+                total = sum(kn_counts[start:end])
+                if total == 0:
+                    continue
+                seen = 0
+                for pos in range(start, end):
+                    if kn_counts[pos] > 0:
+                        seen += 1
+                        self.weights[pos] = max(kn_counts[pos] - discount,
+                            0) / total
+                gammas[i] = discount * seen / total
+            self.gammas[k] = gammas
+
+        discount = self.estimate_discount(unigram_counts)
+        self.discounts[0] = discount
+        total = sum(unigram_counts)
+        seen = sum(1 for count in unigram_counts if count > 0)
+        uniform = 1.0 / max(num_words, 1)
+        unigram = array.array('d', [uniform]) * num_words
+        if total > 0:
+            gamma = discount * seen / total
+            for word_id in range(num_words):
+                unigram[word_id] = max(unigram_counts[word_id] - discount,
+                    0) / total + gamma * uniform
+        self.unigram = unigram
+
+    def score_nodes(self, nodes, word_id):
+        probability = self.unigram[word_id]
+        for k, i in nodes:
+            pos = self.locate(k, i, word_id)
+            weight = 0.0
+            if pos >= 0:
+                weight = self.weights[pos]
+            probability = weight + self.gammas[k][i] * probability
+        return probability
+
+    # The weight of each context is scaled by the gammas of every longer
+    # one, and the unigram score by the gammas of them all
+    def bounds(self, nodes):
+        terms = []
+        factor = 1.0
+        for k, i in reversed(nodes):
+            terms.append((factor, k, i))
+            factor *= self.gammas[k][i]
+        return (terms, factor)
+
+
+# The scorers that can be chosen by name, such as with word_predictor's
+# --scorer flag. 'mle' is the store's own maximum likelihood ranking
+SCORERS = {'stupid_backoff': StupidBackoff, 'kneser_ney': KneserNey}
@@ -0,0 +1,468 @@
+from util import Utilities
+from util import Histogram
+from text import TextUtils
+import word_predictor
+import concurrent.futures
+import argparse
+import asyncio
+import json
+import signal
+import time
+import sys
+import os
+
+# How long the batcher waits for more requests after the first one arrives
+BATCH_WINDOW = 0.002
+# The most requests handled in one batch
+MAX_BATCH = 256
+# The most words a generate or complete request may ask to predict, the
+# most words or continuations any request may ask for, and the widest beam
+# a complete request may ask for. Larger values are lowered to these, so
+# that one request can't hold up the batches behind it
+MAX_WORDS = 200
+MAX_NUM = 100
+MAX_BEAM_WIDTH = 32
+
+
+# Serves predictions from one WordGenerator, loaded once, to any number of
+# clients. Clients send one JSON object per line and get one JSON object per
+# line back. Requests that arrive close together are handled as one batch,
+# so that generate requests share lookups through word_predictor.predict_many.
+#
+# Requests (the optional "id" is echoed back in the response):
+#   {"op": "generate", "seed": "...", "max_words": 20, "sample": false,
+#       "temperature": 1.0, "top_k": 0, "top_p": 1.0}
+#       -> {"text": "..."}
+#   {"op": "next", "seed": "...", "num": 1}
+#       -> {"words": [["word", probability], ...]} or {"words": null}
+#   {"op": "complete", "seed": "...", "max_words": 20, "beam_width": 5,
+#       "num": 5, "length_penalty": 1.0}
+#       -> {"continuations": [["text", log probability], ...]}, the most
+#       probable continuations found by word_predictor.beam_search
+#   {"op": "complete_word", "seed": "...", "num": 1}
+#       -> {"words": [["word", probability], ...]} or {"words": null}, the
+#       most likely completions of the seed's partly typed last word (see
+#       word_predictor.complete_word)
+#   {"op": "stats"}
+#       -> {"requests": ..., "batches": ..., "latency": {...}, ...}
+# Malformed requests get {"error": "..."}, and a line longer than the
+# stream's limit gets one before the connection is closed. "max_words",
+# "num" and "beam_width" are lowered to the server's limits
+class PredictionServer:
+
+    # Class Members:
+    #   self.word_gen: The WordGenerator predictions are made with
+    #   self.batch_window: Seconds to wait for more requests to batch
+    #   self.max_batch: The most requests handled in one batch
+    #   self.max_words: The most words a request may ask to predict
+    #   self.max_num: The most words or continuations a request may ask for
+    #   self.max_beam_width: The widest beam a complete request may ask for
+    #   self.listener: The asyncio server accepting connections, once
+    #       START has been called
+    #   self.queue: Requests waiting for the batcher, as (request, future,
+    #       arrival time) tuples
+    #   self.batcher: The task running RUN_BATCHER, once START has been
+    #       called
+    #   self.executor: The thread batches are answered on, so that the event
+    #       loop goes on reading and writing while a batch is predicted
+    #   self.latency: A dictionary of Histograms of the time from a
+    #       request's arrival to its response being ready, one per op
+    #   self.counters: A dictionary of request, batch and error counts
+    #   self.clients: The set of tasks serving connected clients
+
+    def __init__(self, word_gen, batch_window = BATCH_WINDOW,
+        max_batch = MAX_BATCH, max_words = MAX_WORDS, max_num = MAX_NUM,
+        max_beam_width = MAX_BEAM_WIDTH):
+        self.word_gen = word_gen
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_words = max_words
+        self.max_num = max_num
+        self.max_beam_width = max_beam_width
+        self.queue = None
+        self.listener = None
+        self.batcher = None
+        self.executor = None
+        self.clients = set()
+        self.latency = dict()
+        self.counters = {'requests': 0, 'batches': 0, 'batched_requests': 0,
+            'errors': 0, 'connections': 0}
+        self.start_time = time.time()
+
+    # Starts serving on the Unix socket at SOCKET_PATH, or on HOST and PORT
+    # if SOCKET_PATH is None. Returns the asyncio server once it is listening
+    async def start(self, socket_path = None, host = '127.0.0.1', port = 0):
+        if socket_path != None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.listener = await asyncio.start_unix_server(
+                self.handle_client, path = socket_path)
+        else:
+            self.listener = await asyncio.start_server(self.handle_client,
+                host, port)
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.batcher = asyncio.ensure_future(self.run_batcher())
+        return self.listener
+
+    # Stops accepting connections, waits for the connected clients to finish
+    # and stops the batcher
+    async def stop(self):
+        self.listener.close()
+        await self.listener.wait_closed()
+        if len(self.clients) > 0:
+            await asyncio.wait(list(self.clients))
+        self.batcher.cancel()
+        self.executor.shutdown(wait = False)
+
+    # Reads requests from one client until it disconnects. Each request is
+    # answered as soon as its batch is done, so a client may pipeline many
+    # requests and match responses up by their "id". A line too long to read
+    # is answered with an error, and ends the connection, since the rest of
+    # it can't be told apart from the next request
+    async def handle_client(self, reader, writer):
+        self.counters['connections'] += 1
+        self.clients.add(asyncio.current_task())
+        pending = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError as e:
+                    self.counters['errors'] += 1
+                    await self.write(writer, {'error':
+                        "request too long: %s" % e})
+                    break
+                except ConnectionResetError:
+                    break
+                if not line:
+                    break
+                task = asyncio.ensure_future(self.respond(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if len(pending) > 0:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+            self.clients.discard(asyncio.current_task())
+
+    # Answers the request in LINE, writing the response to WRITER
+    async def respond(self, line, writer):
+        arrival = time.perf_counter()
+        request = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request must be a JSON object")
+            op = request.get('op')
+            if op == 'stats':
+                response = self.stats()
+            elif op in ('generate', 'next', 'complete', 'complete_word'):
+                future = asyncio.get_running_loop().create_future()
+                await self.queue.put((request, future, arrival))
+                response = await future
+            else:
+                raise ValueError("unknown op %r" % op)
+        except (ValueError, TypeError, KeyError) as e:
+            self.counters['errors'] += 1
+            op = 'error'
+            response = {'error': str(e)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        self.counters['requests'] += 1
+        self.latency.setdefault(op, Histogram()).add(
+            time.perf_counter() - arrival)
+        await self.write(writer, response)
+
+    # Writes the dictionary RESPONSE to WRITER as one line of JSON
+    async def write(self, writer, response):
+        try:
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+            await writer.drain()
+        except ConnectionError:
+            # the client has gone, so nobody is waiting for the response
+            pass
+
+    # Takes requests off self.queue in batches and answers them on
+    # self.executor, forever
+    async def run_batcher(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.counters['batches'] += 1
+            self.counters['batched_requests'] += len(batch)
+            responses = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.answer_batch,
+                [request for request, future, arrival in batch])
+            for (request, future, arrival), response in zip(batch,
+                responses):
+                if 'error' in response:
+                    self.counters['errors'] += 1
+                # the future is cancelled if the client waiting on it has
+                # gone
+                if not future.done():
+                    future.set_result(response)
+
+    # Returns a list of the responses to every request in the list
+    # REQUESTS, in the same order. Generate requests with the same options
+    # are predicted together. A request that fails, for whatever reason,
+    # only fails itself, or the group of generate requests predicted with
+    # it, so the batcher goes on. This runs on self.executor, so it only
+    # reads self.word_gen and never touches the event loop
+    def answer_batch(self, requests):
+        groups = dict()
+        answered = dict()
+        responses = [None] * len(requests)
+        for index, request in enumerate(requests):
+            try:
+                if request['op'] == 'next':
+                    responses[index] = self.next_words(request, answered)
+                    continue
+                if request['op'] == 'complete':
+                    responses[index] = self.complete(request, answered)
+                    continue
+                if request['op'] == 'complete_word':
+                    responses[index] = self.complete_word(request, answered)
+                    continue
+                options = self.generate_options(request)
+                seed = request.get('seed', '')
+                if not isinstance(seed, str):
+                    raise TypeError("seed must be a string")
+            except Exception as e:
+                responses[index] = {'error': str(e)}
+                continue
+            groups.setdefault(options, []).append((seed, index))
+
+        for (max_words, sampling), members in groups.items():
+            if sampling != None:
+                sampling = dict(sampling)
+            seeds = [seed for seed, index in members]
+            try:
+                texts = word_predictor.predict_many(self.word_gen, seeds,
+                    max_words, sampling)
+            except Exception as e:
+                for seed, index in members:
+                    responses[index] = {'error': str(e)}
+                continue
+            for (seed, index), text in zip(members, texts):
+                responses[index] = {'text': text}
+        return responses
+
+    # Returns the integer NAME of REQUEST, or DEFAULT if it has none,
+    # lowered to LIMIT if it is more
+    def get_limited(self, request, name, default, limit):
+        return min(int(request.get(name, default)), limit)
+
+    # Returns the options of a generate REQUEST as a hashable tuple
+    # (max_words, sampling), where sampling is None or a tuple of items
+    def generate_options(self, request):
+        max_words = self.get_limited(request, 'max_words', 20,
+            self.max_words)
+        if not request.get('sample', False):
+            return (max_words, None)
+        temperature = float(request.get('temperature', 1.0))
+        if temperature <= 0:
+            raise ValueError("temperature must be greater than 0")
+        sampling = (('temperature', temperature),
+            ('top_k', int(request.get('top_k', 0))),
+            ('top_p', float(request.get('top_p', 1.0))))
+        return (max_words, sampling)
+
+    # Answers a next REQUEST with the most likely words after its seed.
+    # ANSWERED is a dictionary of the answers already given in this batch, so
+    # that repeated requests are only looked up once
+    def next_words(self, request, answered):
+        seed = request.get('seed', '')
+        if not isinstance(seed, str):
+            raise TypeError("seed must be a string")
+        key = (tuple(TextUtils.normalize_line(seed)),
+            self.get_limited(request, 'num', 1, self.max_num))
+        words = answered.get(key)
+        if words == None:
+            words = self.word_gen.get_next_words(list(key[0]),
+                num_to_return = key[1])
+            answered[key] = words
+        return {'words': words}
+
+    # Answers a complete REQUEST with the most probable continuations of its
+    # seed. ANSWERED is as for NEXT_WORDS
+    def complete(self, request, answered):
+        seed = request.get('seed', '')
+        if not isinstance(seed, str):
+            raise TypeError("seed must be a string")
+        beam_width = self.get_limited(request, 'beam_width',
+            word_predictor.BEAM_WIDTH, self.max_beam_width)
+        if beam_width <= 0:
+            raise ValueError("beam_width must be greater than 0")
+        key = ('complete', tuple(TextUtils.normalize_line(seed)),
+            self.get_limited(request, 'max_words', 20, self.max_words),
+            beam_width,
+            self.get_limited(request, 'num', beam_width, self.max_num),
+            float(request.get('length_penalty',
+                word_predictor.LENGTH_PENALTY)))
+        continuations = answered.get(key)
+        if continuations == None:
+            continuations = word_predictor.beam_search(self.word_gen,
+                ' '.join(key[1]), *key[2:])
+            answered[key] = continuations
+        return {'continuations': continuations}
+
+    # Answers a complete_word REQUEST with the most likely completions of the
+    # last word of its seed. ANSWERED is as for NEXT_WORDS
+    def complete_word(self, request, answered):
+        seed = request.get('seed', '')
+        if not isinstance(seed, str):
+            raise TypeError("seed must be a string")
+        key = ('complete_word', seed,
+            self.get_limited(request, 'num', 1, self.max_num))
+        words = answered.get(key)
+        if words == None:
+            words = word_predictor.complete_word(self.word_gen, seed, key[2])
+            answered[key] = words
+        return {'words': words}
+
+    # Returns a dictionary of the server's counters and latency summaries
+    def stats(self):
+        stats = dict(self.counters)
+        elapsed = time.time() - self.start_time
+        stats['uptime_sec'] = elapsed
+        stats['requests_per_sec'] = self.counters['requests'] / max(elapsed,
+            1e-9)
+        stats['mean_batch_size'] = 0.0
+        if self.counters['batches'] > 0:
+            stats['mean_batch_size'] = (self.counters['batched_requests']
+                / self.counters['batches'])
+        stats['latency'] = dict((op, histogram.summary())
+            for op, histogram in self.latency.items())
+        stats['cache'] = self.word_gen.cache_stats()
+        return stats
+
+# Loads the model in MODEL_FILE and serves it until interrupted. The next
+# words of the CACHE_ENTRIES most recent contexts, and at most CACHE_BYTES
+# bytes of them, are cached (see WordGenerator.set_cache). Only ngrams of up
+# to MAX_ORDER words are used, or all of them if it is 0 (see
+# WordGenerator.set_max_order). MAX_WORDS, MAX_NUM and MAX_BEAM_WIDTH are
+# the limits on requests (see PredictionServer)
+def run_server(model_file, socket_path = None, host = '127.0.0.1', port = 0,
+    batch_window = BATCH_WINDOW, max_batch = MAX_BATCH,
+    cache_entries = word_predictor.CACHE_ENTRIES, cache_bytes = 0,
+    max_order = 0, max_words = MAX_WORDS, max_num = MAX_NUM,
+    max_beam_width = MAX_BEAM_WIDTH):
+    word_gen = word_predictor.load_default_word_gen(model_file)
+    word_gen.set_max_order(max_order)
+    word_gen.set_cache(cache_entries, cache_bytes)
+    server = PredictionServer(word_gen, batch_window, max_batch, max_words,
+        max_num, max_beam_width)
+    loop = asyncio.new_event_loop()
+    try:
+        listener = loop.run_until_complete(server.start(socket_path, host,
+            port))
+    except OSError as e:
+        loop.close()
+        sys.exit("Fatal Error: Cannot listen for requests: %s" % e)
+    if socket_path != None:
+        Utilities.log("Serving '%s' on %s", (model_file, socket_path),
+            sys.stderr)
+    else:
+        address = listener.sockets[0].getsockname()
+        Utilities.log("Serving '%s' on %s:%d", (model_file, address[0],
+            address[1]), sys.stderr)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        Utilities.log("%s", json.dumps(server.stats()), sys.stderr)
+        listener.close()
+        server.batcher.cancel()
+        loop.run_until_complete(asyncio.gather(server.batcher,
+            return_exceptions = True))
+        server.executor.shutdown()
+        loop.close()
+
+# Starts a prediction server. See PredictionServer for the protocol, and
+# loadgen.py for a client that measures it
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model",
+                    default = word_predictor.NGRAM_MODEL_NAME,
+                    help="the model file to serve (default = %s)"
+                        % word_predictor.NGRAM_MODEL_NAME,
+                    action="store")
+    parser.add_argument("-u", "--socket",
+                    help="listen on a Unix socket at this path",
+                    action="store")
+    parser.add_argument("--host",
+                    default = '127.0.0.1',
+                    help="the address to listen on (default = 127.0.0.1)",
+                    action="store")
+    parser.add_argument("-p", "--port",
+                    type = int,
+                    default = 8765,
+                    help="the TCP port to listen on (default = 8765)",
+                    action="store")
+    parser.add_argument("--batch_window",
+                    type = float,
+                    default = BATCH_WINDOW * 1e3,
+                    help="milliseconds to wait for requests to batch "
+                        "together (default = %g)" % (BATCH_WINDOW * 1e3),
+                    action="store")
+    parser.add_argument("--max_batch",
+                    type = int,
+                    default = MAX_BATCH,
+                    help="the most requests handled in one batch "
+                        "(default = %d)" % MAX_BATCH,
+                    action="store")
+    parser.add_argument("--cache_entries",
+                    type = int,
+                    default = word_predictor.CACHE_ENTRIES,
+                    help="the number of contexts whose next words are "
+                        "cached, 0 for no limit if --cache_bytes is given or "
+                        "no cache otherwise (default = %d)"
+                        % word_predictor.CACHE_ENTRIES,
+                    action="store")
+    parser.add_argument("--cache_bytes",
+                    type = int,
+                    default = 0,
+                    help="the most bytes of next words cached, 0 for no "
+                        "limit (default = 0)",
+                    action="store")
+    parser.add_argument("--max_order",
+                    type = int,
+                    default = 0,
+                    help="predict with ngrams of at most this size "
+                        "(default = 0, the model's largest)",
+                    action="store")
+    parser.add_argument("--max_words",
+                    type = int,
+                    default = MAX_WORDS,
+                    help="the most words a request may ask to predict "
+                        "(default = %d)" % MAX_WORDS,
+                    action="store")
+    parser.add_argument("--max_num",
+                    type = int,
+                    default = MAX_NUM,
+                    help="the most words or continuations a request may "
+                        "ask for (default = %d)" % MAX_NUM,
+                    action="store")
+    parser.add_argument("--max_beam_width",
+                    type = int,
+                    default = MAX_BEAM_WIDTH,
+                    help="the widest beam a complete request may ask for "
+                        "(default = %d)" % MAX_BEAM_WIDTH,
+                    action="store")
+    args = parser.parse_args()
+    run_server(args.model, args.socket, args.host, args.port,
+        args.batch_window / 1e3, args.max_batch, args.cache_entries,
+        args.cache_bytes, args.max_order, args.max_words, args.max_num,
+        args.max_beam_width)
@@ -1,10 +1,12 @@
 import word_predictor as wp
+import corpuscache
 import nltk
 import sys
 
 def simple_word_predictor(seed_str, limit = 10):
     print("Training data...")
-    predictor = wp.train_on_corpus(3, [nltk.corpus.brown, nltk.corpus.abc])
+    predictor = wp.train_on_corpus(3, [nltk.corpus.brown, nltk.corpus.abc],
+        cache_dir = corpuscache.CACHE_DIR)
     predicted = wp.predict_words(predictor, seed_str, limit)
     print(predicted)
 
@@ -0,0 +1,252 @@
+from wordprob import WordProb
+from store import NgramStore
+import array
+import random
+import math
+
+# A Mersenne prime larger than any hash, used by the row hash functions
+PRIME = (1 << 61) - 1
+
+
+# A count-min sketch: DEPTH rows of WIDTH counters, where every key is
+# counted in one counter per row, chosen by that row's hash function. The
+# estimate for a key is the smallest of its counters, so it is never lower
+# than the key's true count and only higher when other keys share all of
+# its counters. With WIDTH = ceil(e / EPSILON) and DEPTH = ceil(ln(1 /
+# DELTA)), where N is the sum of every count added:
+#
+#   true count <= estimate <= true count + EPSILON * N
+#
+# holds for any one key with probability at least 1 - DELTA. Memory is
+# WIDTH * DEPTH counters, however many keys are added. Counters are raised
+# with the conservative update, which only raises the counters that are at
+# the current minimum; estimates are then never higher than with the
+# plain update, so the same bound holds
+class CountMinSketch:
+
+    # Class Members:
+    #   self.width: The number of counters in each row
+    #   self.depth: The number of rows
+    #   self.table: An array of WIDTH * DEPTH counters, row by row
+    #   self.hashes: A list of DEPTH (a, b) pairs, one per row. A key's
+    #       counter in row i is ((a * hash(key) + b) % PRIME) % WIDTH
+    #   self.total: N, the sum of every count added
+
+    def __init__(self, width, depth, seed = 0):
+        self.width = width
+        self.depth = depth
+        self.table = array.array('q', [0]) * (width * depth)
+        rng = random.Random(seed)
+        self.hashes = [(rng.randrange(1, PRIME), rng.randrange(0, PRIME))
+            for i in range(depth)]
+        self.total = 0
+
+    # Returns a sketch sized so that estimates are within EPSILON times the
+    # total count of the true count, with probability 1 - DELTA
+    @staticmethod
+    def from_error(epsilon, delta, seed = 0):
+        width = int(math.ceil(math.e / epsilon))
+        depth = int(math.ceil(math.log(1.0 / delta)))
+        return CountMinSketch(width, max(depth, 1), seed)
+
+    # Returns the position in self.table of KEY's counter in every row
+    def positions(self, key):
+        h = hash(key)
+        width = self.width
+        return [row * width + (a * h + b) % PRIME % width
+            for row, (a, b) in enumerate(self.hashes)]
+
+    # Adds COUNT observations of KEY, a hashable value such as a tuple of
+    # ids. Returns the new estimate for KEY
+    def add(self, key, count = 1):
+        table = self.table
+        positions = self.positions(key)
+        estimate = min([table[pos] for pos in positions]) + count
+        for pos in positions:
+            if table[pos] < estimate:
+                table[pos] = estimate
+        self.total += count
+        return estimate
+
+    # Returns the estimated count of KEY
+    def estimate(self, key):
+        table = self.table
+        return min([table[pos] for pos in self.positions(key)])
+
+    # Returns the largest amount by which an estimate should exceed the true
+    # count, except with probability self.error_probability()
+    def error_bound(self):
+        return math.e / self.width * self.total
+
+    # Returns the probability that an estimate exceeds ERROR_BOUND
+    def error_probability(self):
+        return math.exp(-self.depth)
+
+    # Returns the number of bytes held by the counters
+    def num_bytes(self):
+        return len(self.table) * self.table.itemsize
+
+
+# Keeps a fixed number of slots of heavy contexts, each with a fixed number
+# of candidate successors, so that the most frequent successors of the most
+# frequent contexts can be listed without keeping every context. A context
+# always lands in the same slot. When two contexts share a slot the one
+# observed more often keeps it, and within a slot a new successor replaces
+# the least frequent candidate once it has been observed more often (the
+# Space-Saving rule). Counts come from a CountMinSketch, so they are
+# overestimates with the same bound
+class HeavyHitters:
+
+    # Class Members:
+    #   self.num_slots: The number of contexts tracked at most
+    #   self.num_successors: The number of successors tracked per context
+    #   self.keys: The context held by each slot, or None
+    #   self.totals: The estimated total of the context in each slot, as of
+    #       its last observation
+    #   self.candidates: For each slot, a dictionary mapping the successors
+    #       being tracked to their estimated counts
+
+    def __init__(self, num_slots, num_successors):
+        self.num_slots = num_slots
+        self.num_successors = num_successors
+        self.keys = [None] * num_slots
+        self.totals = array.array('q', [0]) * num_slots
+        self.candidates = [None] * num_slots
+
+    # Records that SUCCESSOR followed CONTEXT, whose estimated total is now
+    # CONTEXT_TOTAL and whose estimated count with SUCCESSOR is now COUNT
+    def offer(self, context, successor, context_total, count):
+        slot = hash(context) % self.num_slots
+        if self.keys[slot] != context:
+            if self.keys[slot] != None and \
+                self.totals[slot] >= context_total:
+                return
+            self.keys[slot] = context
+            self.candidates[slot] = dict()
+        self.totals[slot] = context_total
+
+        candidates = self.candidates[slot]
+        if successor in candidates or \
+            len(candidates) < self.num_successors:
+            candidates[successor] = count
+            return
+        weakest = min(candidates, key=candidates.__getitem__)
+        if candidates[weakest] < count:
+            del candidates[weakest]
+            candidates[successor] = count
+
+    # Yields a tuple (context, candidates) for every slot in use, where
+    # candidates maps successors to their estimated counts
+    def iter_contexts(self):
+        for slot in range(self.num_slots):
+            if self.keys[slot] != None:
+                yield (self.keys[slot], self.candidates[slot])
+
+
+# A WordProb that counts approximately, in memory fixed when it is made, so
+# that it can be trained on more ngrams than would fit in memory as exact
+# counts. Pair counts and context totals are kept in two CountMinSketches,
+# and a HeavyHitters table lists the successors of the heaviest contexts.
+# Only the vocabulary grows with the input.
+#
+# Lookups are served by the same NgramStore as an exact WordProb, built from
+# the HeavyHitters table by FREEZE, so WordGenerator and save_word_gen work
+# unchanged. Compared with exact counts:
+#   - a context is missing if a heavier context took its slot
+#   - at most NUM_SUCCESSORS successors are kept per context
+#   - every stored count is an overestimate, by at most EPSILON times the
+#       number of (context, successor) observations, except with
+#       probability DELTA for each count
+#   - probabilities are relative to the successors that are kept
+# Memory is bounded by the sketches and the table rather than by pruning;
+# PRUNE still works on the built store, until more observations rebuild it
+class ApproxWordProb(WordProb):
+
+    # Class Members:
+    #   self.pairs: A CountMinSketch of (context, successor) counts
+    #   self.contexts: A CountMinSketch of context totals
+    #   self.heavy: The HeavyHitters table of contexts and successors
+    #   self.dirty: True if observations were added since the last FREEZE
+
+    def __init__(self, epsilon = 1e-5, delta = 0.01, num_contexts = 1 << 18,
+        num_successors = 8, seed = 0):
+        WordProb.__init__(self)
+        self.pairs = CountMinSketch.from_error(epsilon, delta, seed)
+        self.contexts = CountMinSketch.from_error(epsilon, delta, seed + 1)
+        self.heavy = HeavyHitters(num_contexts, num_successors)
+        self.dirty = False
+
+    # Same as WordProb.add_ngram_observations, but counted in the sketches
+    def add_ngram_observations(self, ng, include_shorter_grams = True):
+        self.vocab = self.vocab.thaw()
+        add = self.vocab.add
+        for ng_tuple in ng:
+            num_keys = len(ng_tuple) - 1
+            assert(num_keys) >= 1
+            ids = tuple(map(add, ng_tuple))
+            if include_shorter_grams == True:
+                for i in range(num_keys):
+                    self.observe(ids[i:num_keys], ids[-1])
+            else:
+                self.observe(ids[0:num_keys], ids[-1])
+
+    # Same as WordProb.add_token_observations, but counted in the sketches
+    def add_token_observations(self, tokens, max_order, skip = 0):
+        self.vocab = self.vocab.thaw()
+        add = self.vocab.add
+        history = ()
+        for position, token in enumerate(tokens):
+            observed_id = add(token)
+            if position >= skip:
+                for i in range(len(history) + 1):
+                    self.observe(history[i:], observed_id)
+            if max_order > 1:
+                history = (history + (observed_id,))[1 - max_order:]
+
+    # Counts COUNT observations of the word id SUCCESSOR after CONTEXT, a
+    # tuple of ids
+    def observe(self, context, successor, count = 1):
+        context_total = self.contexts.add(context, count)
+        pair_count = self.pairs.add((context, successor), count)
+        self.heavy.offer(context, successor, context_total, pair_count)
+        self.dirty = True
+
+    # Returns the estimated number of times the word id SUCCESSOR was seen
+    # after CONTEXT, a tuple of ids
+    def estimate(self, context, successor):
+        return self.pairs.estimate((context, successor))
+
+    # Rebuilds self.store from the HeavyHitters table, with counts read
+    # from the sketch again since they may have grown after being offered
+    def freeze(self):
+        if not self.dirty:
+            return
+        updates = dict()
+        for context, candidates in self.heavy.iter_contexts():
+            updates[context] = dict((successor,
+                self.estimate(context, successor))
+                for successor in candidates)
+        self.store = NgramStore().merge(updates)
+        self.dirty = False
+
+    # Adds every observation made by OTHER, an exact or approximate
+    # WordProb, with its words translated to ids in self.vocab
+    def merge(self, other):
+        other.freeze()
+        self.vocab = self.vocab.thaw()
+        add = self.vocab.add
+        get_word = other.vocab.get_word
+        remap = [add(get_word(i)) for i in range(len(other.vocab))]
+        successors = other.store.successors
+        counts = other.store.counts
+        for context, start, end, total in other.store.iter_contexts():
+            key = tuple([remap[i] for i in context])
+            for pos in range(start, end):
+                self.observe(key, remap[successors[pos]], counts[pos])
+
+    # Same as WordProb.size, plus the bytes held by the sketches
+    def size(self):
+        size = WordProb.size(self)
+        size['sketch_bytes'] = self.pairs.num_bytes() + \
+            self.contexts.num_bytes()
+        return size
@@ -0,0 +1,244 @@
+from wordprob import WordProb
+from wordprob import WordGenerator
+from util import Histogram
+import threading
+import time
+
+# A model that can be read from any number of threads while one writer keeps
+# adding to it. Readers never take a lock: they read an immutable Snapshot,
+# the version of the model as of some point in time. The writer adds to a
+# WordProb only it touches, and publishes a new Snapshot once the new
+# observations are packed, by replacing one reference. A reader that took
+# the previous Snapshot goes on reading it, consistently, until it takes the
+# next one.
+#
+# This works because every NgramStore is immutable once built: freezing or
+# pruning a WordProb builds a new store and leaves the old one as it was, so
+# a Snapshot only has to keep the store it was published with. The writer's
+# Vocabulary only ever grows, so a Snapshot shares it, hiding the words
+# added after it was published (see FrozenVocabulary). What takes time in
+# proportion to the model to build, the scorer's tables and the prefix
+# index's word ranks, is built once per Snapshot when it is published and
+# then only read. Everything a lookup builds as it goes, such as the cache,
+# the sampler's alias tables and the prefix index's context indexes, belongs
+# to a WordGenerator that each thread gets for itself from the Snapshot.
+#
+# Publishing is not free: the writer's observations are merged into a new
+# store, a copy of the old one (see NgramStore.merge), while readers may still
+# be reading the old one. A publish takes time in proportion to the size of
+# the model and, at its peak, memory for two stores. So a VersionedModel
+# publishes at most once every PUBLISH_INTERVAL seconds, and observations
+# added sooner than that wait for the next publish, together with any others
+# added meanwhile. bench.py --snapshots measures both costs.
+
+# The fewest seconds between two Snapshots published by a VersionedModel
+PUBLISH_INTERVAL = 0.1
+
+
+# A read only view of a Vocabulary as it was when the view was made. Words
+# added to the Vocabulary later are not seen, which keeps the view
+# consistent with the store it was made for
+class FrozenVocabulary:
+
+    # Class Members:
+    #   self.vocab: The Vocabulary or MappedVocabulary being viewed
+    #   self.size: The number of words in self.vocab when the view was made
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.size = len(vocab)
+
+    def __len__(self):
+        return self.size
+
+    # Returns the id of WORD, or None if it hadn't been seen
+    def get_id(self, word):
+        word_id = self.vocab.get_id(word)
+        if word_id == None or word_id >= self.size:
+            return None
+        return word_id
+
+    # Returns the word with the id WORD_ID
+    def get_word(self, word_id):
+        return self.vocab.get_word(word_id)
+
+    # Converts the list of strings in WORDS into a tuple of ids. Returns None
+    # if any of the words hadn't been seen
+    def get_ids(self, words):
+        context = []
+        for word in words:
+            word_id = self.get_id(word)
+            if word_id == None:
+                return None
+            context.append(word_id)
+        return tuple(context)
+
+    # A snapshot is never added to, so this fails
+    def thaw(self):
+        raise TypeError("a snapshot of a vocabulary is read only")
+
+
+# One published version of a VersionedModel
+class Snapshot:
+
+    # Class Members:
+    #   self.version: The number of this version, counting from 1
+    #   self.vocab: A FrozenVocabulary of the words in this version
+    #   self.store: The NgramStore of this version
+    #   self.configure: A function called with the WordGenerator every
+    #       thread's WordGenerator is copied from, or None
+    #   self.shared: That WordGenerator, configured and with its scorer's
+    #       tables and prefix index built. It is never used for lookups
+    #   self.local: Thread local storage holding each thread's WordGenerator
+
+    # Creates the version VERSION of a model, with the FrozenVocabulary
+    # VOCAB and the NgramStore STORE, and builds self.shared. This takes
+    # time in proportion to the model, so it is only done by the writer
+    # publishing the version
+    def __init__(self, version, vocab, store, configure = None):
+        self.version = version
+        self.vocab = vocab
+        self.store = store
+        self.configure = configure
+        self.local = threading.local()
+        self.shared = WordGenerator.from_word_probs(self.word_probs())
+        if configure != None:
+            configure(self.shared)
+        self.shared.word_probs.get_prefix_index()
+
+    # Returns a WordProb over this version, which must not be added to
+    def word_probs(self):
+        word_probs = WordProb()
+        word_probs.vocab = self.vocab
+        word_probs.store = self.store
+        return word_probs
+
+    # Returns the calling thread's WordGenerator over this version, copying
+    # self.shared the first time the thread asks (see WordGenerator.copy).
+    # Its cache, sampler and context indexes are only ever used by that
+    # thread, so no lookup takes a lock
+    def word_gen(self):
+        word_gen = getattr(self.local, 'word_gen', None)
+        if word_gen == None:
+            word_gen = self.shared.copy()
+            self.local.word_gen = word_gen
+        return word_gen
+
+
+# Publishes a new Snapshot of a WordProb every time a writer adds to it. Any
+# number of threads can read the latest Snapshot while one thread at a time
+# writes; writers take a lock between them, readers never do
+class VersionedModel:
+
+    # Class Members:
+    #   self.word_probs: The WordProb new observations are added to. Only
+    #       the writer holding self.lock touches it
+    #   self.configure: A function called with the WordGenerator each
+    #       Snapshot's readers copy theirs from, such as one setting its cache
+    #       and scorer, or None
+    #   self.lock: The lock writers hold while adding and publishing
+    #   self.current: The latest Snapshot. Replacing it is atomic, so a
+    #       reader always gets either the old or the new one whole
+    #   self.publish_latency: A Histogram of the time from a writer starting
+    #       to pack its new observations to the new Snapshot being published
+    #   self.publish_interval: The fewest seconds between two publishes
+    #   self.last_publish: The time.perf_counter() of the last publish
+    #   self.dirty: True if observations were added since the last publish
+    #   self.timer: The threading.Timer that publishes the observations
+    #       waiting for the next publish, or None if there are none
+
+    # Creates a model publishing the observations in WORD_PROBS, a new
+    # WordProb by default, as its first version. CONFIGURE is as above. New
+    # versions are published at most once every PUBLISH_INTERVAL seconds, or
+    # after every update if it is 0
+    def __init__(self, word_probs = None, configure = None,
+        publish_interval = PUBLISH_INTERVAL):
+        if word_probs == None:
+            word_probs = WordProb()
+        self.word_probs = word_probs
+        self.configure = configure
+        self.lock = threading.Lock()
+        self.current = None
+        self.publish_latency = Histogram()
+        self.publish_interval = publish_interval
+        self.last_publish = None
+        self.dirty = False
+        self.timer = None
+        with self.lock:
+            self.publish_locked()
+
+    # Returns the latest Snapshot
+    def snapshot(self):
+        return self.current
+
+    # Returns the calling thread's WordGenerator over the latest Snapshot.
+    # Results from two calls can come from different versions, so a reader
+    # that needs several consistent lookups should call SNAPSHOT once and
+    # use Snapshot.word_gen
+    def word_gen(self):
+        return self.current.word_gen()
+
+    # Calls FUNCTION with the writer's WordProb, then publishes the result
+    # as a new Snapshot and returns it. Other writers wait; readers go on
+    # reading the previous Snapshot meanwhile. If the last Snapshot was
+    # published less than self.publish_interval seconds ago, the result is
+    # published once the interval is up instead, and the latest Snapshot,
+    # without it, is returned; call PUBLISH to publish it sooner
+    def update(self, function):
+        with self.lock:
+            function(self.word_probs)
+            self.dirty = True
+            wait = self.last_publish + self.publish_interval - \
+                time.perf_counter()
+            if wait <= 0:
+                return self.publish_locked()
+            if self.timer == None:
+                self.timer = threading.Timer(wait, self.publish)
+                self.timer.daemon = True
+                self.timer.start()
+            return self.current
+
+    # Adds the ngrams in NG and publishes them. See
+    # WordGenerator.add_list_of_ngrams
+    def add_list_of_ngrams(self, ng, include_shorter_grams = True):
+        return self.update(lambda word_probs:
+            word_probs.add_ngram_observations(ng, include_shorter_grams))
+
+    # Adds the iterable TOKENS, counting every order up to MAX_ORDER, and
+    # publishes them. See WordGenerator.add_list_of_tokens
+    def add_list_of_tokens(self, tokens, max_order, skip = 0):
+        return self.update(lambda word_probs:
+            word_probs.add_token_observations(tokens, max_order, skip))
+
+    # Adds every observation of OTHER, a WordGenerator, and publishes them.
+    # See WordGenerator.merge
+    def merge(self, other):
+        return self.update(lambda word_probs:
+            word_probs.merge(other.word_probs))
+
+    # Publishes the observations waiting for the next publish, if there are
+    # any, right away. Returns the latest Snapshot
+    def publish(self):
+        with self.lock:
+            if self.dirty:
+                self.publish_locked()
+            return self.current
+
+    # Packs the writer's observations and publishes them as the next
+    # Snapshot, which is returned. The caller holds self.lock
+    def publish_locked(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        self.dirty = False
+        start = time.perf_counter()
+        self.word_probs.freeze()
+        version = 1
+        if self.current != None:
+            version = self.current.version + 1
+        snapshot = Snapshot(version, FrozenVocabulary(self.word_probs.vocab),
+            self.word_probs.store, self.configure)
+        self.current = snapshot
+        self.last_publish = time.perf_counter()
+        self.publish_latency.add(self.last_publish - start)
+        return snapshot
@@ -0,0 +1,534 @@
+import array
+import bisect
+
+
+# Interns words as compact integer ids, so that contexts can be stored as
+# tuples or flat arrays of ids rather than joined strings
+class Vocabulary:
+
+    # Class Members:
+    #   self.words: A list of every word seen, indexed by its id
+    #   self.ids: A dictionary mapping each word to its id
+
+    def __init__(self):
+        self.words = []
+        self.ids = dict()
+
+    def __len__(self):
+        return len(self.words)
+
+    # Returns the id of WORD, giving it the next free id if it hasn't been
+    # seen before
+    def add(self, word):
+        word_id = self.ids.get(word)
+        if word_id == None:
+            word_id = len(self.words)
+            self.ids[word] = word_id
+            self.words.append(word)
+        return word_id
+
+    # Returns the id of WORD, or None if it hasn't been seen
+    def get_id(self, word):
+        return self.ids.get(word)
+
+    # Returns the word with the id WORD_ID
+    def get_word(self, word_id):
+        return self.words[word_id]
+
+    # Converts the list of strings in WORDS into a tuple of ids. Returns None
+    # if any of the words hasn't been seen, since no context can contain it
+    def get_ids(self, words):
+        ids = self.ids
+        context = []
+        for word in words:
+            word_id = ids.get(word)
+            if word_id == None:
+                return None
+            context.append(word_id)
+        return tuple(context)
+
+    # Returns a vocabulary that new words can be added to, which is this one
+    def thaw(self):
+        return self
+
+
+# Thresholds for dropping rare observations from an NgramStore, which at
+# larger ngram sizes is mostly made of successors seen only once
+class Pruning:
+
+    # Class Members:
+    #   self.min_count: Successors seen fewer times than this are dropped
+    #   self.min_context_total: Contexts seen fewer times than this are
+    #       dropped along with all of their successors
+    #   self.max_successors: Only this many of the most frequent successors
+    #       of each context are kept, or all of them if 0
+
+    def __init__(self, min_count = 1, min_context_total = 1,
+        max_successors = 0):
+        self.min_count = min_count
+        self.min_context_total = min_context_total
+        self.max_successors = max_successors
+
+    # Returns True if any of the thresholds would drop something
+    def is_enabled(self):
+        return self.min_count > 1 or self.min_context_total > 1 or \
+            self.max_successors > 0
+
+
+# An immutable, array backed table of successor counts for every context,
+# indexed as a trie of reversed contexts. All contexts of the same length are
+# stored back to back in one array of ids, sorted by their last word, then
+# the word before it, and so on. The contexts of length K + 1 that end with
+# the same K words are then next to each other, and are the children of the
+# context made of those K words, so the longest stored suffix of any list of
+# words is found by one walk of at most one step per word, without building
+# any keys. Nothing in the store is a per-context Python object. The
+# successors of each context are stored most frequent first, which makes the
+# top-k of a context a simple slice.
+#
+# Every suffix of a stored context is in the trie. Suffixes that were never
+# observed as contexts themselves are stored with no successors, and are
+# never returned by FIND or FIND_SUFFIX.
+#
+# The empty context, of length 0, holds the unigram counts of a model
+# trained with every order (see WordProb.add_token_observations). It is the
+# root of the trie: FIND and FIND_SUFFIX fall back to it when not even the
+# last word matches, but WALK never passes it.
+class NgramStore:
+
+    # Class Members:
+    #   self.contexts: A dictionary mapping a context length K to an array of
+    #       ids, holding every context of that length (K ids each) in
+    #       reversed sorted order
+    #   self.offsets: A dictionary mapping K to an array with one more entry
+    #       than there are contexts of length K. The successors of the i-th
+    #       context are self.successors[offsets[i]:offsets[i + 1]]
+    #   self.totals: A dictionary mapping K to an array holding the number of
+    #       observations of each context of length K
+    #   self.children: A dictionary mapping K to an array with one more entry
+    #       than there are contexts of length K, for every K but the longest.
+    #       The contexts of length K + 1 that extend the i-th context of
+    #       length K by one word at the front are those from children[i] to
+    #       children[i + 1]
+    #   self.successors: An array of word ids, most frequent first within
+    #       each context
+    #   self.counts: An array with the count of each entry in self.successors,
+    #       64 bit like the totals, since a count summed over a large corpus
+    #       can pass 2 ** 31
+
+    def __init__(self):
+        self.contexts = dict()
+        self.offsets = dict()
+        self.totals = dict()
+        self.children = dict()
+        self.successors = array.array('i')
+        self.counts = array.array('q')
+
+    # Returns the number of contexts in the store
+    def num_contexts(self):
+        num_contexts = 0
+        for offsets in self.offsets.values():
+            for i in range(len(offsets) - 1):
+                if offsets[i] < offsets[i + 1]:
+                    num_contexts += 1
+        return num_contexts
+
+    # Returns the number of (context, successor) pairs in the store
+    def num_entries(self):
+        return len(self.successors)
+
+    # Returns the number of bytes held by the store's arrays
+    def num_bytes(self):
+        arrays = [self.successors, self.counts]
+        for k in self.contexts:
+            arrays += [self.contexts[k], self.offsets[k], self.totals[k]]
+        arrays += list(self.children.values())
+        return sum(len(values) * values.itemsize for values in arrays)
+
+    # Returns the length of the longest context in the store, or 0 if empty
+    def max_context_length(self):
+        if len(self.contexts) == 0:
+            return 0
+        return max(self.contexts.keys())
+
+    # Walks the trie with REVERSED_IDS, an iterable of word ids starting with
+    # the last word of a context and going backwards. A None id, which no
+    # context contains, ends the walk. Yields a tuple (k, i) for every trie
+    # node passed, meaning the i-th context of length K
+    def walk(self, reversed_ids):
+        totals = self.totals.get(1)
+        if totals == None:
+            return
+        lo = 0
+        hi = len(totals)
+        k = 1
+        for word_id in reversed_ids:
+            if word_id == None:
+                return
+            flat = self.contexts[k]
+            # the contexts from LO to HI share all but their first word, and
+            # are sorted by it
+            if k == 1:
+                i = bisect.bisect_left(flat, word_id, lo, hi)
+            else:
+                i = lo
+                top = hi
+                while i < top:
+                    mid = (i + top) // 2
+                    if flat[mid * k] < word_id:
+                        i = mid + 1
+                    else:
+                        top = mid
+            if i == hi or flat[i * k] != word_id:
+                return
+            yield (k, i)
+            children = self.children.get(k)
+            if children == None:
+                return
+            lo = children[i]
+            hi = children[i + 1]
+            if lo == hi:
+                return
+            k += 1
+
+    # Finds the tuple of ids CONTEXT. Returns a tuple (start, end, total),
+    # where the successors of the context are in positions START to END of
+    # self.successors and self.counts, and TOTAL is the sum of their counts.
+    # If the context isn't stored, None is returned
+    def find(self, context):
+        found = None
+        if len(self.totals.get(0, ())) > 0:
+            found = (0, 0)
+        for k, i in self.walk(reversed(context)):
+            found = (k, i)
+        if found == None or found[0] != len(context):
+            return None
+        k, i = found
+        offsets = self.offsets[k]
+        if offsets[i] == offsets[i + 1]:
+            return None
+        return (offsets[i], offsets[i + 1], self.totals[k][i])
+
+    # Finds the longest stored context that the words in REVERSED_IDS end
+    # with, where REVERSED_IDS is as for WALK. Ids are only taken from it as
+    # far as the walk goes, so it can convert words lazily. Returns a tuple
+    # (start, end, total, k) as FIND does plus the length K of the context,
+    # or None if not even the last word is a stored context and there is no
+    # empty context
+    def find_suffix(self, reversed_ids):
+        # the same walk as WALK, unrolled since it is on every lookup
+        found = None
+        offsets = self.offsets.get(0)
+        if offsets != None and offsets[0] < offsets[1]:
+            found = (offsets[0], offsets[1], self.totals[0][0], 0)
+        flat = self.contexts.get(1)
+        if flat == None:
+            return found
+        lo = 0
+        hi = len(flat)
+        k = 1
+        for word_id in reversed_ids:
+            if word_id == None:
+                break
+            if k == 1:
+                i = bisect.bisect_left(flat, word_id)
+            else:
+                i = lo
+                top = hi
+                while i < top:
+                    mid = (i + top) // 2
+                    if flat[mid * k] < word_id:
+                        i = mid + 1
+                    else:
+                        top = mid
+            if i == hi or flat[i * k] != word_id:
+                break
+            offsets = self.offsets[k]
+            if offsets[i] < offsets[i + 1]:
+                found = (offsets[i], offsets[i + 1], self.totals[k][i], k)
+            children = self.children.get(k)
+            if children == None:
+                break
+            lo = children[i]
+            hi = children[i + 1]
+            k += 1
+            flat = self.contexts.get(k)
+            if lo == hi:
+                break
+        return found
+
+    # Same as FIND_SUFFIX, but returns a list of such a tuple for every
+    # stored context the words in REVERSED_IDS end with, longest first and
+    # ending with the empty context if there is one
+    def find_suffixes(self, reversed_ids):
+        found = []
+        offsets = self.offsets.get(0)
+        if offsets != None and offsets[0] < offsets[1]:
+            found.append((offsets[0], offsets[1], self.totals[0][0], 0))
+        for k, i in self.walk(reversed_ids):
+            offsets = self.offsets[k]
+            if offsets[i] < offsets[i + 1]:
+                found.append((offsets[i], offsets[i + 1], self.totals[k][i],
+                    k))
+        found.reverse()
+        return found
+
+    # Returns True if the tuple of ids CONTEXT is a node of the trie, either
+    # as a stored context or as a suffix of one
+    def has_node(self, context):
+        depth = 0
+        for k, i in self.walk(reversed(context)):
+            depth = k
+        return depth == len(context)
+
+    # Returns the index one past the last successor that should be returned
+    # when asking for the NUM_TO_RETURN most frequent successors in the range
+    # START to END, keeping any successors tied with the last one
+    def top_end(self, start, end, num_to_return):
+        if num_to_return < 1:
+            num_to_return = 1
+        stop = start + num_to_return
+        if stop >= end:
+            return end
+        counts = self.counts
+        last = counts[stop - 1]
+        while stop < end and counts[stop] == last:
+            stop += 1
+        return stop
+
+    # Yields a tuple (context, start, end, total) for every stored context,
+    # shortest contexts first and in reversed sorted order within each
+    # length. Suffixes with no successors of their own are skipped
+    def iter_contexts(self):
+        for k in sorted(self.contexts.keys()):
+            flat = self.contexts[k]
+            offsets = self.offsets[k]
+            totals = self.totals[k]
+            for i in range(len(totals)):
+                if offsets[i] < offsets[i + 1]:
+                    yield (tuple(flat[i * k:i * k + k]), offsets[i],
+                        offsets[i + 1], totals[i])
+
+    # Returns a new NgramStore holding the counts in this store plus the
+    # counts in UPDATES, a dictionary mapping tuples of ids to dictionaries of
+    # {successor id: count}. This store is left unchanged. Only the contexts
+    # in UPDATES are re-ranked: each run of untouched contexts between them
+    # is copied over in bulk, and the trie links are shifted rather than
+    # rebuilt (see RELINK). A merge still copies every array, so it takes
+    # time and memory in proportion to the size of the store, but for a small
+    # UPDATES most of that is a few slice copies rather than Python work per
+    # context
+    def merge(self, updates):
+        by_length = dict()
+        for context in updates:
+            by_length.setdefault(len(context), []).append(context)
+        # make sure every suffix of a new context is a node of the trie
+        for context in updates:
+            for i in range(1, len(context)):
+                suffix = context[i:]
+                if suffix in updates or self.has_node(suffix):
+                    break
+                by_length.setdefault(len(suffix), []).append(suffix)
+        empty = dict()
+
+        merged = NgramStore()
+        successors = merged.successors
+        counts = merged.counts
+        plans = dict()
+        for k in sorted(set(self.contexts.keys()) | set(by_length.keys())):
+            flat = self.contexts.get(k, array.array('i'))
+            old_offsets = self.offsets.get(k, array.array('q', [0]))
+            old_totals = self.totals.get(k, array.array('q'))
+            new_keys = sorted(set(by_length.get(k, [])),
+                key=lambda context: context[::-1])
+            # where each new key goes among the old contexts, and whether it
+            # is one of them
+            plan = [self.locate(k, key) + (key,) for key in new_keys]
+            plans[k] = plan
+
+            contexts = array.array('i')
+            offsets = array.array('q', [len(successors)])
+            totals = array.array('q')
+            i = 0
+            for position, found, key in plan + [(len(old_totals), False,
+                None)]:
+                if position > i:
+                    # untouched contexts, their ranking is still valid
+                    start = old_offsets[i]
+                    end = old_offsets[position]
+                    shift = len(successors) - start
+                    contexts.extend(flat[i * k:position * k])
+                    successors.extend(self.successors[start:end])
+                    counts.extend(self.counts[start:end])
+                    totals.extend(old_totals[i:position])
+                    ends = old_offsets[i + 1:position + 1]
+                    if shift != 0:
+                        ends = [end + shift for end in ends]
+                    offsets.extend(ends)
+                    i = position
+                if key == None:
+                    break
+
+                combined = dict(updates.get(key, empty))
+                if found:
+                    for pos in range(old_offsets[i], old_offsets[i + 1]):
+                        word_id = self.successors[pos]
+                        combined[word_id] = (combined.get(word_id, 0)
+                            + self.counts[pos])
+                    i += 1
+                ranked = sorted(combined.items(),
+                    key=lambda pair: (-pair[1], pair[0]))
+                contexts.extend(key)
+                total = 0
+                for word_id, count in ranked:
+                    successors.append(word_id)
+                    counts.append(count)
+                    total += count
+                totals.append(total)
+                offsets.append(len(successors))
+
+            merged.contexts[k] = contexts
+            merged.offsets[k] = offsets
+            merged.totals[k] = totals
+        if len(self.contexts) == 0:
+            merged.link()
+        else:
+            merged.relink(self, plans)
+        return merged
+
+    # Finds the tuple of ids CONTEXT among the contexts of length K. Returns
+    # a tuple (i, found), where I is the position of the first context of
+    # length K that is not ordered before CONTEXT, and FOUND is True if that
+    # context is CONTEXT itself
+    def locate(self, k, context):
+        totals = self.totals.get(k)
+        if totals == None:
+            return (0, False)
+        flat = self.contexts[k]
+        target = context[::-1]
+        lo = 0
+        hi = len(totals)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tuple(flat[mid * k:mid * k + k])[::-1] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = lo < len(totals) and tuple(flat[lo * k:lo * k + k]) == context
+        return (lo, found)
+
+    # Returns the position of the first context of length K + 1, from LO on,
+    # whose last K words are not ordered before the tuple of ids CONTEXT.
+    # Searches forward from LO in growing steps, so that finding the
+    # children of consecutive contexts costs little more than a scan
+    def children_start(self, k, context, lo):
+        longer = self.contexts[k + 1]
+        num_longer = len(longer) // (k + 1)
+        target = context[::-1]
+        hi = lo
+        step = 1
+        while hi < num_longer and \
+            tuple(longer[hi * (k + 1) + 1:(hi + 1) * (k + 1)])[::-1] < target:
+            lo = hi + 1
+            hi += step
+            step *= 2
+        hi = min(hi, num_longer)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tuple(longer[mid * (k + 1) + 1:(mid + 1) * (k + 1)])[::-1] < \
+                target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Fills in self.children for a store just merged from OLD, where PLANS
+    # maps every context length K to the list of (position, found, context)
+    # tuples MERGE placed among OLD's contexts of that length. The children
+    # of an old context start where they did in OLD, moved along by the
+    # number of new contexts of length K + 1 whose suffix is ordered before
+    # it, so runs of old contexts between two such suffixes are copied with
+    # one shift. Only the children of new contexts are searched for
+    def relink(self, old, plans):
+        self.children = dict()
+        for k in sorted(self.contexts.keys()):
+            if k == 0 or k + 1 not in self.contexts:
+                continue
+            old_children = old.children.get(k)
+            # every new context of length K + 1 moves the children of the
+            # old contexts of length K from BOUNDS[j] on along by one
+            bounds = []
+            for position, found, context in plans.get(k + 1, []):
+                if not found:
+                    suffix_position, suffix_found = old.locate(k,
+                        context[1:])
+                    bounds.append(suffix_position + 1 if suffix_found
+                        else suffix_position)
+            bounds.sort()
+
+            children = array.array('q')
+            i = 0
+            for position, found, context in plans.get(k, []) + [(len(
+                old.totals.get(k, ())), True, None)]:
+                end = position + 1 if found and context != None else position
+                # old contexts, in runs that are all moved by the same amount
+                while i < end:
+                    shift = bisect.bisect_right(bounds, i)
+                    stop = end
+                    if shift < len(bounds):
+                        stop = min(stop, bounds[shift])
+                    if old_children == None:
+                        children.extend([shift] * (stop - i))
+                    elif shift == 0:
+                        children.extend(old_children[i:stop])
+                    else:
+                        children.extend([start + shift for start in
+                            old_children[i:stop]])
+                    i = stop
+                if context != None and not found:
+                    lo = children[-1] if len(children) > 0 else 0
+                    children.append(self.children_start(k, context, lo))
+            children.append(len(self.contexts[k + 1]) // (k + 1))
+            self.children[k] = children
+
+    # Fills in self.children from self.contexts. Every context longer than 1
+    # must have its suffix one word shorter stored too. The empty context
+    # has no children, since every walk starts at the contexts of length 1
+    def link(self):
+        self.children = dict()
+        for k in sorted(self.contexts.keys()):
+            longer = self.contexts.get(k + 1)
+            if k == 0 or longer == None:
+                continue
+            flat = self.contexts[k]
+            num_longer = len(longer) // (k + 1)
+            children = array.array('q', [0])
+            j = 0
+            for i in range(len(flat) // k):
+                parent = tuple(flat[i * k:i * k + k])
+                while j < num_longer and \
+                    tuple(longer[j * (k + 1) + 1:(j + 1) * (k + 1)]) == parent:
+                    j += 1
+                children.append(j)
+            self.children[k] = children
+
+    # Returns a new NgramStore without the observations that PRUNING, a
+    # Pruning object, says to drop. Context totals are recomputed from the
+    # successors that are kept, and contexts left without any successors are
+    # dropped. This store is left unchanged
+    def prune(self, pruning):
+        kept = dict()
+        for context, start, end, total in self.iter_contexts():
+            if total < pruning.min_context_total:
+                continue
+            if pruning.max_successors > 0:
+                end = min(end, start + pruning.max_successors)
+            # successors are most frequent first, so everything after the
+            # first rare one is rare too
+            stop = start
+            while stop < end and self.counts[stop] >= pruning.min_count:
+                stop += 1
+            if stop > start:
+                kept[context] = dict(zip(self.successors[start:stop],
+                    self.counts[start:stop]))
+        return NgramStore().merge(kept)
@@ -1,27 +1,80 @@
-from nltk.util import ngrams
 from util import Utilities
+from util import LRUCache
 from text import TextUtils
 from wordprob import NgramProb
 from wordprob import WordProb
 from wordprob import WordGenerator
+from store import Pruning
+from sketch import ApproxWordProb
+from sketch import CountMinSketch
+from scorers import StupidBackoff
+from scorers import KneserNey
+import word_predictor
+import completion
+import snapshot
+import corpuscache
+import bench
+import server
+import evaluate
+import journal
+import modelfile
+import profiler
+import loadgen
+import subprocess
+import threading
+import asyncio
+import bisect
+import json
+import array
+import tempfile
+import random
+import time
+import math
+import sys
+import os
 
 # Some constants. If testing materials are moved, reflect it here
 TST_DIR = "testing_docs/"
 TXT_NORMAL_FILE = "test_normalize.txt"
 TXT_NORMAL_FILE_EXP = "test_normalize_expected.txt"
 TXT_FILE_TO_NGRAM = "test_file_to_ngram.txt"
+LEGACY_PICKLE = "legacy_ngram_hash.pkl"
 
 
 # Entry point for all text.py class method tests
 def run_test_suite():
 	run_text_tests()
 	run_word_prob_tests()
+	run_word_predictor_tests()
+
+# Test the helpers in word_predictor.py
+def run_word_predictor_tests():
+    test_save_load_word_gen()
+    test_parallel_training()
+    test_multi_order()
+    test_corpus_cache()
+    test_journal()
+    test_predict_words()
+    test_predict_many()
+    test_beam_search()
+    test_complete_word()
+    test_snapshots()
+    test_server()
+    test_evaluate()
+    test_bench_suite()
+    test_profiler()
+    test_lazy_imports()
 	
 # Test NgramProb, WordProb, and WordGenerator
 def run_word_prob_tests():
     test_ngram_prob()
     test_word_prob()
     test_word_generator()
+    test_sampling()
+    test_pruning()
+    test_approx_word_prob()
+    test_scorers()
+    test_cache()
     
 def test_word_generator():
     str = "hello world, I am Nick Iodice"
@@ -30,7 +83,7 @@ def test_word_generator():
     str += "a b c d a b c d a b d"
 
     strContent = TextUtils.normalize_line(str)
-    ng = ngrams(strContent, 3)
+    ng = TextUtils.iter_ngrams(strContent, 3)
     wg = WordGenerator(ng)    
     match = wg.get_next_words(['hello', 'world'])
     assert (match[0][0] == 'alex') or (match[0][0] == 'i')
@@ -58,9 +111,313 @@ def test_word_generator():
     assert (match[0][0] == 'alex') or (match[0][0] == 'i')
     assert (match[1][0] == 'alex') or (match[1][0] == 'i')
     assert len(match) == 2
+
+    # backing off uses the statistics of the shorter context itself, which
+    # are those of the word before the predicted one
+    assert wg.get_next_words(['c', 'b'], num_to_return = 2) == \
+        [('c', 2/3), ('d', 1/3)]
+    assert wg.get_next_words(['c', 'b'], min_preceding_match = 2) == None
+    assert wg.get_next_words(['c', 'd', 'a']) == [('b', 1.0)]
+    assert wg.get_next_words(['missing', 'b']) == \
+        wg.get_next_words(['b'])
+
+    # contexts stored without their suffixes are still found
+    wg = WordGenerator(TextUtils.iter_ngrams(
+        TextUtils.normalize_line("a b c a d e"), 3),
+        include_shorter_grams = False)
+    assert wg.get_next_words(['a', 'b']) == [('c', 1.0)]
+    assert wg.get_next_words(['x', 'a', 'd']) == [('e', 1.0)]
+    assert wg.get_next_words(['b']) == None
+    assert wg.word_probs.store.num_contexts() == 4
         
     print("PASSED: WordGenerator")
     
+# Test drawing words at random with WordGenerator.sample_next_words
+def test_sampling():
+    ng = [('a', 'b')] * 6 + [('a', 'c')] * 3 + [('a', 'd')]
+    wg = WordGenerator(ng)
+    rng = random.Random(7)
+    drawn = wg.sample_next_words(['a'], 20000, rng)
+    assert abs(drawn.count('b') / 20000 - 0.6) < 0.02
+    assert abs(drawn.count('c') / 20000 - 0.3) < 0.02
+    assert abs(drawn.count('d') / 20000 - 0.1) < 0.02
+
+    # the same seed gives the same words
+    again = wg.sample_next_words(['a'], 20000, random.Random(7))
+    assert again == drawn
+
+    assert set(wg.sample_next_words(['a'], 200, rng, top_k = 2)) == \
+        set(['b', 'c'])
+    assert set(wg.sample_next_words(['a'], 200, rng, top_p = 0.6)) == \
+        set(['b'])
+    assert set(wg.sample_next_words(['a'], 200, rng, top_p = 0.61)) == \
+        set(['b', 'c'])
+    assert set(wg.sample_next_words(['a'], 200, rng,
+        temperature = 0.05)) == set(['b'])
+    hot = wg.sample_next_words(['a'], 20000, rng, temperature = 1000)
+    assert abs(hot.count('d') / 20000 - 1/3) < 0.02
+
+    # backs off like get_next_words, and gives None with no match
+    assert wg.sample_next_word(['x', 'a'], rng) in ('b', 'c', 'd')
+    assert wg.sample_next_word(['x'], rng) == None
+    print("PASSED: sampling")
+
+# Test dropping rare observations, after training and while training
+def test_pruning():
+    content = TextUtils.normalize_line("a b a b a b a c a d x y x y q r")
+    wg = WordGenerator(TextUtils.iter_ngrams(content, 2))
+    before = wg.word_probs.size()
+    wg.prune(Pruning(min_count = 2))
+    after = wg.word_probs.size()
+    assert after['contexts'] < before['contexts']
+    assert after['entries'] < before['entries']
+    assert after['bytes'] < before['bytes']
+    # totals only count the successors that are kept
+    assert wg.get_next_words(['a'], num_to_return = 5) == [('b', 1.0)]
+    assert wg.get_next_words(['x']) == [('y', 1.0)]
+    assert wg.word_probs.find_context(['q']) == None
+
+    wg = WordGenerator(TextUtils.iter_ngrams(content, 2))
+    wg.prune(Pruning(min_context_total = 3, max_successors = 2))
+    assert wg.get_next_words(['a'], num_to_return = 5) == [('b', 0.75),
+        ('c', 0.25)]
+    assert wg.word_probs.find_context(['x']) == None
+
+    # pruning in flight keeps at most what was seen since the last pruning
+    # plus what survived it
+    wg = WordGenerator([])
+    wg.set_pruning(Pruning(min_count = 2), prune_every = 4)
+    wg.add_list_of_ngrams(TextUtils.iter_ngrams(content, 2))
+    wg.prune()
+    assert wg.get_next_words(['a']) == [('b', 1.0)]
+    assert wg.word_probs.find_context(['x']) == None
+
+    hits = word_predictor.lookup_hits(wg, [('a', 'b'), ('a', 'c'),
+        ('z', 'b'), ('x', 'y')])
+    assert hits == {'lookups': 4, 'context_hits': 0.5, 'word_hits': 0.25}
+    print("PASSED: pruning")
+
+# Test approximate counting against exact counts on the testing docs
+def test_approx_word_prob():
+    sketch = CountMinSketch.from_error(0.01, 0.05)
+    assert sketch.width == 272 and sketch.depth == 3
+    for i in range(1000):
+        sketch.add(i % 7, 2)
+    assert sketch.estimate(3) >= 286 and sketch.estimate('unseen') >= 0
+
+    exact = WordGenerator(TextUtils.file_to_ngram(TST_DIR + TXT_FILE_TO_NGRAM,
+        3))
+    approx_probs = ApproxWordProb(epsilon = 1e-3, delta = 0.01,
+        num_contexts = 1 << 12, num_successors = 4)
+    approx = WordGenerator(TextUtils.file_to_ngram(TST_DIR + TXT_FILE_TO_NGRAM,
+        3), word_probs = approx_probs)
+    exact_probs = exact.word_probs
+    exact_probs.freeze()
+
+    # estimates are never low, and are within the bound except with
+    # probability delta each
+    bound = approx_probs.pairs.error_bound()
+    pairs = 0
+    outside = 0
+    for context, start, end, total in exact_probs.store.iter_contexts():
+        words = [exact_probs.vocab.get_word(i) for i in context]
+        key = approx_probs.vocab.get_ids(words)
+        for pos in range(start, end):
+            successor = approx_probs.vocab.get_id(exact_probs.vocab.get_word(
+                exact_probs.store.successors[pos]))
+            error = approx_probs.estimate(key, successor) - \
+                exact_probs.store.counts[pos]
+            assert error >= 0
+            pairs += 1
+            if error > bound:
+                outside += 1
+    assert outside <= pairs * approx_probs.pairs.error_probability()
+
+    # the heaviest contexts are tracked, and mostly agree on the best word
+    heaviest = sorted(exact_probs.store.iter_contexts(),
+        key=lambda found: -found[3])[0:50]
+    agree = 0
+    for context, start, end, total in heaviest:
+        words = [exact_probs.vocab.get_word(i) for i in context]
+        best = approx.get_next_words(words)
+        assert best != None and len(best) <= 4
+        if best[0][0] in [pair[0] for pair in exact.get_next_words(words)]:
+            agree += 1
+    assert agree >= 45
+    size = approx_probs.size()
+    assert size['entries'] <= (1 << 12) * 4
+    assert size['sketch_bytes'] == 2 * 2719 * 5 * 8
+
+    # training on tokens counts every order in the sketches too
+    tokens = list(TextUtils.iter_file_tokens(TST_DIR + TXT_FILE_TO_NGRAM))
+    exact_probs = WordProb()
+    exact_probs.add_token_observations(tokens, 3)
+    exact_probs.freeze()
+    approx_probs = ApproxWordProb(epsilon = 1e-3, delta = 0.01,
+        num_contexts = 1 << 12, num_successors = 4)
+    WordGenerator.from_word_probs(approx_probs).add_list_of_tokens(tokens, 3)
+    for context, start, end, total in exact_probs.store.iter_contexts():
+        words = [exact_probs.vocab.get_word(i) for i in context]
+        key = approx_probs.vocab.get_ids(words)
+        assert approx_probs.contexts.estimate(key) >= total
+        for pos in range(start, end):
+            successor = approx_probs.vocab.get_id(exact_probs.vocab.get_word(
+                exact_probs.store.successors[pos]))
+            assert approx_probs.estimate(key, successor) >= \
+                exact_probs.store.counts[pos]
+    approx_probs.freeze()
+    assert 0 in approx_probs.store.contexts
+    assert approx_probs.size()['entries'] <= (1 << 12) * 4
+    print("PASSED: ApproxWordProb")
+
+# Test smoothed scoring with stupid backoff and Kneser-Ney
+def test_scorers():
+    content = TextUtils.normalize_line("a b c a b d a b c")
+    wg = WordGenerator(TextUtils.iter_ngrams(content, 3))
+    backoff = StupidBackoff(wg.word_probs)
+    assert backoff.score(['a', 'b'], 'c') == 2/3
+    assert backoff.score(['x', 'b'], 'd') == 1/3
+    # 'a' follows 2 of the 7 bigrams, and was never seen after 'a b' or 'b'
+    assert abs(backoff.score(['a', 'b'], 'a') - 0.4 * 0.4 * 2/7) < 1e-12
+    assert backoff.score(['a', 'b'], 'missing') == 0.0
+    # 'b' is only stored as the suffix of 'a b', so backing off past it
+    # costs nothing: the only bigram context is 'y', followed by 'c'
+    gapped = WordGenerator([('a', 'b', 'd'), ('x', 'y', 'b')], False)
+    gapped.add_list_of_ngrams([('y', 'c')])
+    assert StupidBackoff(gapped.word_probs).score(['a', 'b'], 'c') == 0.4
+
+    # Kneser-Ney gives a distribution over the vocabulary for any context
+    wg = WordGenerator(TextUtils.file_to_ngram(TST_DIR + TXT_FILE_TO_NGRAM,
+        3))
+    vocab = wg.word_probs.vocab
+    words = [vocab.get_word(i) for i in range(len(vocab))]
+    kneser_ney = KneserNey(wg.word_probs)
+    for context in (['went', 'to'], ['the'], ['zzz', 'the'], []):
+        total = sum(kneser_ney.score(context, word) for word in words)
+        assert abs(total - 1.0) < 1e-9
+    for k, discount in kneser_ney.discounts.items():
+        assert 0 < discount < 1
+
+    # the scorer ranks the words returned by the generator
+    expected = kneser_ney.get_next_words(['went', 'to'], num_to_return = 3)
+    assert len(expected) >= 3
+    assert expected == sorted(expected, key=lambda pair: -pair[1])
+    wg.set_scorer(kneser_ney)
+    assert wg.get_next_words(['went', 'to'], num_to_return = 3) == expected
+    assert wg.get_next_words(['zzz'], min_preceding_match = 1) == None
+
+    # scorers work over mapped models, and rebuild once new observations
+    # are frozen
+    directory = tempfile.mkdtemp()
+    model_name = os.path.join(directory, 'model.bin')
+    word_predictor.save_word_gen(model_name, wg)
+    loaded = word_predictor.load_word_gen(model_name)
+    loaded.set_scorer(KneserNey(loaded.word_probs))
+    assert loaded.get_next_words(['went', 'to'], num_to_return = 3) == \
+        expected
+    loaded.add_list_of_ngrams([('went', 'to', 'qqq')] * 50)
+    loaded.freeze()
+    assert loaded.get_next_words(['went', 'to'])[0][0] == 'qqq'
+
+    # with unigrams only, both scorers rank by their unigram scores, with
+    # or without the empty context in the store
+    all_orders = WordGenerator([])
+    all_orders.add_list_of_tokens(TextUtils.iter_file_tokens(TST_DIR +
+        TXT_FILE_TO_NGRAM), 3)
+    for model in (wg, all_orders):
+        for scorer_class in (StupidBackoff, KneserNey):
+            scorer = scorer_class(model.word_probs)
+            model.set_scorer(scorer)
+            model.set_max_order(1)
+            found = model.get_next_words(['went', 'to'], num_to_return = 3)
+            assert found != None and len(found) >= 3
+            assert found == model.get_next_words([], num_to_return = 3)
+            assert found == sorted(found, key=lambda pair: -pair[1])
+            assert found[0][1] == max(scorer.unigram)
+            model.set_max_order(0)
+            assert model.get_next_words(['went', 'to']) != found
+            model.set_scorer(None)
+    # stupid backoff's unigrams are raw relative frequencies, so they rank
+    # like the counts of the empty context
+    all_orders.set_max_order(1)
+    expected = [word for word, probability in
+        all_orders.get_next_words([], num_to_return = 5)]
+    all_orders.set_scorer(StupidBackoff(all_orders.word_probs))
+    assert [word for word, score in all_orders.get_next_words(['went'],
+        num_to_return = 5)] == expected
+
+    # the ranking agrees with score() over the whole vocabulary, even for a
+    # word that is rare after the context but common everywhere else
+    rare = WordGenerator([('a', 'w%02d' % i) for i in range(17)])
+    rare.add_list_of_ngrams([('a', 'zz')] + [('x%02d' % i, 'zz')
+        for i in range(40)])
+    rare.freeze()
+    assert KneserNey(rare.word_probs).get_next_words(['a'])[0][0] == 'zz'
+    for model in (wg, rare):
+        vocab = model.word_probs.vocab
+        words = [vocab.get_word(i) for i in range(len(vocab))]
+        for scorer_class in (StupidBackoff, KneserNey):
+            scorer = scorer_class(model.word_probs)
+            for context in (['went', 'to'], ['the'], ['a'], ['zzz'], []):
+                scores = sorted([(scorer.score(context, word), word)
+                    for word in words], key=lambda pair: (-pair[0],
+                    vocab.get_id(pair[1])))
+                scores = [(word, score) for score, word in scores
+                    if score > 0]
+                found = scorer.get_next_words(context, num_to_return = 5)
+                if found == None:
+                    continue
+                assert found == scores[0:len(found)]
+                assert len(found) >= min(5, len(scores))
+                assert len(found) == len(scores) or \
+                    scores[len(found)][1] < found[-1][1]
+    print("PASSED: StupidBackoff/KneserNey")
+
+# Test the LRU cache and caching next words in a live model
+def test_cache():
+    cache = LRUCache(max_entries = 2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') == None and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+    cache = LRUCache(max_entries = 0, max_bytes = 100)
+    cache.put('a', 1, 60)
+    cache.put('b', 2, 50)
+    cache.put('c', 3, 101)
+    assert len(cache) == 1 and cache.bytes == 50 and cache.get('c') == None
+    cache.clear()
+    assert cache.stats()['invalidations'] == 1 and cache.bytes == 0
+
+    content = TextUtils.normalize_line("a b c a b d a b c x y z")
+    uncached = WordGenerator(TextUtils.iter_ngrams(content, 3))
+    wg = WordGenerator(TextUtils.iter_ngrams(content, 3))
+    wg.set_cache(16)
+    for words in (['a', 'b'], ['q', 'a', 'b'], ['b'], ['zzz'], ['a', 'b']):
+        for num in (1, 3):
+            assert wg.get_next_words(words, num_to_return = num) == \
+                uncached.get_next_words(words, num_to_return = num)
+    stats = wg.cache_stats()
+    # the longest context has two words, so ['q', 'a', 'b'] is ['a', 'b']
+    assert stats['hits'] == 4 and stats['misses'] == 6
+    assert stats['entries'] == 6 and stats['bytes'] > 0
+    assert wg.get_next_words(['a', 'b'], 3, 1) == None
+    assert wg.get_next_words(['q', 'a', 'b'], 3, 1) == None
+    assert wg.cache_stats()['hits'] == 5
+
+    # new observations are seen by the next lookup
+    wg.add_list_of_ngrams([('a', 'b', 'x')] * 3)
+    assert wg.get_next_words(['a', 'b']) == [('x', 3/6)]
+    assert wg.cache_stats()['invalidations'] == 1
+    wg.set_scorer(StupidBackoff(wg.word_probs))
+    assert wg.get_next_words(['a', 'b']) == [('x', 3/6)]
+    assert wg.cache_stats()['invalidations'] == 2
+
+    wg.set_cache(0, 0)
+    assert wg.cache_stats() == None
+    print("PASSED: LRUCache")
+
 # test WordProb
 def test_word_prob():
     str = "one two three"
@@ -72,7 +429,7 @@ def test_word_prob():
     
     # first we try to add the words, and ensure that bad input is properly
     # rejected
-    ng = ngrams(strContent, 1)
+    ng = TextUtils.iter_ngrams(strContent, 1)
     word_prob = WordProb()
     try:
         # this should fail because ng size is 1
@@ -84,9 +441,13 @@ def test_word_prob():
     else:
         assert 0 == 1
         
-    ng = ngrams(strContent, 3)
+    ng = TextUtils.iter_ngrams(strContent, 3)
 #    for gram in ng:
     word_prob.add_ngram_observations(ng)
+    # lookups don't see observations until they are frozen
+    assert word_prob.get_word_likelihood(['one', 'two']) == None
+    assert len(word_prob.pending) > 0
+    word_prob.freeze()
 
     # now that the words are added, see if the calculations are correct
     words = word_prob.get_word_likelihood(['one', 'two'])
@@ -98,6 +459,48 @@ def test_word_prob():
     assert word_prob.get_word_likelihood(['one', 'two', 'three']) == None
     assert word_prob.get_word_likelihood([]) == None
     assert word_prob.get_word_likelihood(['one', 'three']) == None
+
+    # contexts are tuples of word ids, so '_' inside a word can't collide
+    # with two words joined together
+    word_prob.add_ngram_observations([('one_two', 'ten'), ('x', 'y', 'z')])
+    word_prob.freeze()
+    words = word_prob.get_word_likelihood(['one_two'])
+    assert words == [('ten', 1.0)]
+    words = word_prob.get_word_likelihood(['one', 'two'])
+    assert words[0] == ('three', 2/3)
+    assert word_prob.get_top_word_likelihood(['x', 'y'], 1) == [('z', 1.0)]
+
+    # counts are 64 bit, so they can grow past 2 ** 31
+    large = WordProb()
+    large.add_ngram_observations([('a', 'b')])
+    large.freeze()
+    large.store = large.store.merge({(0,): {1: 2 ** 31}})
+    assert large.store.find((0,)) == (0, 1, 2 ** 31 + 1)
+    assert large.store.counts[0] == 2 ** 31 + 1
+
+    # pending observations are packed in bounded chunks while training, to
+    # the same store as packing them all at the end. Chunks grow with the
+    # store, so it is copied a few times rather than once per 50 ngrams
+    tokens = list(TextUtils.iter_file_tokens(TST_DIR + TXT_FILE_TO_NGRAM))
+    for add in (lambda probs: probs.add_token_observations(tokens, 3),
+        lambda probs: probs.add_ngram_observations(
+            TextUtils.iter_ngrams(tokens, 3))):
+        chunked = WordProb()
+        chunked.freeze_every = 50
+        freezes = []
+        freeze = chunked.freeze
+        chunked.freeze = lambda: freezes.append(freeze())
+        add(chunked)
+        assert len(chunked.pending) <= chunked.freeze_threshold() * 3
+        assert 1 < len(freezes) < len(tokens) // 50
+        whole = WordProb()
+        whole.freeze_every = 0
+        add(whole)
+        assert len(whole.pending) > 50 * 3
+        chunked.freeze()
+        whole.freeze()
+        assert_same_word_gen(WordGenerator.from_word_probs(chunked),
+            WordGenerator.from_word_probs(whole))
     
     print("PASSED: WordProb")
    
@@ -122,12 +525,859 @@ def test_ngram_prob():
     assert word_likelihoods[1][1] == 1/3
     assert word_likelihoods[2][0] == 'hello'
     assert word_likelihoods[2][1] == 1/6
+
     print("PASSED: NgramProb")  
     
+# Test saving and loading models, including pickles from older versions
+def test_save_load_word_gen():
+    content = TextUtils.normalize_line("a b c a b d a b c x_y z")
+    wg = WordGenerator(TextUtils.iter_ngrams(content, 3))
+    directory = tempfile.mkdtemp()
+    model_name = os.path.join(directory, 'model.bin')
+    word_predictor.save_word_gen(model_name, wg)
+
+    loaded = word_predictor.load_word_gen(model_name)
+    for words in (['a', 'b'], ['a'], ['b', 'c'], ['x']):
+        assert loaded.get_next_words(words, num_to_return = 5) == \
+            wg.get_next_words(words, num_to_return = 5)
+    assert loaded.get_next_words(['missing']) == None
+    for k, children in wg.word_probs.store.children.items():
+        assert list(loaded.word_probs.store.children[k]) == list(children)
+
+    # new observations can still be added to a mapped model
+    loaded.add_list_of_ngrams([('a', 'b', 'd'), ('q', 'r', 's')])
+    match = loaded.get_next_words(['a', 'b'], num_to_return = 1)
+    assert len(match) == 2 and match[0][1] == 1/2
+    assert loaded.get_next_words(['q', 'r']) == [('s', 1.0)]
+
+    # models pickled by older versions were keyed by the '_' joined
+    # prefixes of each ngram. This one was pickled by that code, trained on
+    # the trigrams of TXT_NORMAL_FILE
+    imported = word_predictor.load_word_gen(TST_DIR + LEGACY_PICKLE)
+    trained = WordGenerator(TextUtils.file_to_ngram(TST_DIR + TXT_NORMAL_FILE,
+        3))
+    assert imported.word_probs.size() == trained.word_probs.size()
+    for context, start, end, total in trained.word_probs.store.iter_contexts():
+        words = [trained.word_probs.vocab.get_word(i) for i in context]
+        assert imported.get_next_words(words, num_to_return = 100) == \
+            trained.get_next_words(words, num_to_return = 100)
+    assert imported.get_next_words(['hello']) == [('world', 1.0)]
+    print("PASSED: save_word_gen/load_word_gen")
+
+# Test that training with several processes matches training serially, and
+# that merging two saved models matches training on both sources at once
+def test_parallel_training():
+    files = [TST_DIR + TXT_FILE_TO_NGRAM, TST_DIR + TXT_NORMAL_FILE]
+    min_shard_bytes = word_predictor.MIN_SHARD_BYTES
+    word_predictor.MIN_SHARD_BYTES = 256
+    try:
+        serial = word_predictor.train_on_plain_text(3, files)
+        parallel = word_predictor.train_on_plain_text(3, files,
+            processes = 3)
+    finally:
+        word_predictor.MIN_SHARD_BYTES = min_shard_bytes
+    assert_same_word_gen(serial, parallel)
+
+    directory = tempfile.mkdtemp()
+    names = []
+    for file in files:
+        names.append(os.path.join(directory, os.path.basename(file)))
+        word_predictor.save_word_gen(names[-1],
+            word_predictor.train_on_plain_text(3, [file]))
+    merged = word_predictor.merge_word_gens(names)
+    assert_same_word_gen(serial, merged)
+    print("PASSED: parallel training")
+
+# Test that a model trained with every order in one pass gives the same
+# counts and predictions at each order as a model trained with only that many
+def test_multi_order():
+    files = [TST_DIR + TXT_FILE_TO_NGRAM, TST_DIR + TXT_NORMAL_FILE]
+    full = word_predictor.train_on_plain_text(4, files, all_orders = True)
+    tokens = [token for file in files
+        for token in TextUtils.iter_file_tokens(file)]
+    root = full.word_probs.store.find(())
+    assert root != None and root[2] == len(tokens)
+    contexts = list(full.word_probs.store.iter_contexts())
+
+    directory = tempfile.mkdtemp()
+    model_name = os.path.join(directory, 'model.bin')
+    word_predictor.save_word_gen(model_name, full)
+    loaded = word_predictor.load_word_gen(model_name)
+    assert list(loaded.word_probs.store.iter_contexts()) == contexts
+
+    seeds = [['went', 'to', 'the'], ['the'], ['zzz', 'the'], ['zzz'], []]
+    for order in (1, 2, 3):
+        single = word_predictor.train_on_plain_text(order, files,
+            all_orders = True)
+        # the single order model has the same vocabulary, so its contexts
+        # are the shorter ones of the full model
+        assert list(single.word_probs.store.iter_contexts()) == \
+            [found for found in contexts if len(found[0]) < order]
+        loaded.set_max_order(order)
+        assert loaded.max_context_length() == order - 1
+        for words in seeds:
+            assert loaded.get_next_words(words, num_to_return = 3) == \
+                single.get_next_words(words, num_to_return = 3)
+        loaded.set_scorer(KneserNey(loaded.word_probs))
+        single.set_scorer(KneserNey(single.word_probs))
+        for words in seeds:
+            assert loaded.get_next_words(words, num_to_return = 3) == \
+                single.get_next_words(words, num_to_return = 3)
+        loaded.set_scorer(None)
+    # unigrams answer when not even the last word has been seen
+    assert loaded.get_next_words(['zzz'])[0][0] == \
+        max(set(tokens), key=tokens.count)
+
+    min_shard_bytes = word_predictor.MIN_SHARD_BYTES
+    word_predictor.MIN_SHARD_BYTES = 256
+    try:
+        parallel = word_predictor.train_on_plain_text(4, files,
+            processes = 3, all_orders = True)
+    finally:
+        word_predictor.MIN_SHARD_BYTES = min_shard_bytes
+    assert_same_word_gen(full, parallel)
+    print("PASSED: multi-order training")
+
+# Stands in for a corpus from nltk.corpus over the plain text files FILEIDS
+# in the directory ROOT, counting how often its words are read
+class FakeCorpus:
+    def __init__(self, root, fileids):
+        self.root = root
+        self.names = fileids
+        self.reads = 0
+
+    def fileids(self):
+        return list(self.names)
+
+    def abspath(self, fileid):
+        return FakePath(os.path.join(self.root, fileid))
+
+    def words(self, fileids = None):
+        self.reads += 1
+        for fileid in fileids or self.names:
+            with open(os.path.join(self.root, fileid)) as file:
+                for line in file:
+                    yield from line.split()
+
+# Stands in for the path pointers returned by FakeCorpus.abspath
+class FakePath:
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        FakePath.opens += 1
+        return open(self.path, 'rb')
+
+# The number of times any FakePath has been opened
+FakePath.opens = 0
+
+# Test that corpus tokens are cached once, then read back without reading
+# the corpus, and are cached again when the corpus changes
+def test_corpus_cache():
+    directory = tempfile.mkdtemp()
+    root = os.path.join(directory, 'mini')
+    os.mkdir(root)
+    names = [TXT_FILE_TO_NGRAM, TXT_NORMAL_FILE]
+    for name in names:
+        with open(TST_DIR + name) as source, \
+            open(os.path.join(root, name), 'w') as target:
+            target.write(source.read())
+    corpus = FakeCorpus(root, names)
+    cache_dir = os.path.join(directory, 'cache')
+    uncached = word_predictor.train_on_corpus(3, [corpus])
+
+    cached = word_predictor.train_on_corpus(3, [corpus],
+        cache_dir = cache_dir)
+    assert_same_word_gen(uncached, cached)
+    assert corpus.reads == 2 and len(os.listdir(cache_dir)) == 1
+    path = corpuscache.cache_path(corpus, cache_dir)
+    assert os.path.basename(path).startswith('mini.')
+    assert list(corpuscache.iter_cached_tokens(path)) == \
+        list(TextUtils.iter_word_tokens(corpus.words()))
+    corpus.reads = 0
+    # the cache is found by the files' sizes and times, without reading them
+    # unless their contents are to be hashed
+    assert FakePath.opens == 0
+    hashed = corpuscache.cache_path(corpus, cache_dir, hash_contents = True)
+    assert FakePath.opens == len(names) and hashed != path
+    stat = os.stat(os.path.join(root, names[0]))
+    os.utime(os.path.join(root, names[0]), ns = (0, 0))
+    assert corpuscache.cache_path(corpus, cache_dir) != path
+    assert corpuscache.cache_path(corpus, cache_dir, True) == hashed
+    os.utime(os.path.join(root, names[0]), ns = (stat.st_atime_ns,
+        stat.st_mtime_ns))
+    assert corpuscache.cache_path(corpus, cache_dir) == path
+    cached = word_predictor.train_on_corpus(3, [corpus],
+        cache_dir = cache_dir, hash_corpus = True)
+    assert_same_word_gen(uncached, cached)
+    assert corpus.reads == 1 and len(os.listdir(cache_dir)) == 2
+    corpus.reads = 0
+
+    for processes in (1, 3):
+        min_shard_bytes = word_predictor.MIN_SHARD_BYTES
+        word_predictor.MIN_SHARD_BYTES = 256
+        try:
+            cached = word_predictor.train_on_corpus(3, [corpus],
+                cache_dir = cache_dir, processes = processes)
+        finally:
+            word_predictor.MIN_SHARD_BYTES = min_shard_bytes
+        assert_same_word_gen(uncached, cached)
+    assert corpus.reads == 0
+
+    with open(os.path.join(root, TXT_NORMAL_FILE), 'a') as file:
+        file.write("a brand new line\n")
+    changed = word_predictor.train_on_corpus(3, [corpus],
+        cache_dir = cache_dir)
+    assert corpus.reads == 1 and len(os.listdir(cache_dir)) == 3
+    assert changed.get_next_words(['brand']) == [('new', 1.0)]
+    print("PASSED: corpus token cache")
+
+# Test scoring sentences and files, in one process and split between several
+def test_evaluate():
+    files = [TST_DIR + TXT_FILE_TO_NGRAM, TST_DIR + TXT_NORMAL_FILE]
+    directory = tempfile.mkdtemp()
+    model_name = os.path.join(directory, 'model.bin')
+    wg = word_predictor.train_on_plain_text(3, files[0:1])
+    word_predictor.save_word_gen(model_name, wg)
+
+    kneser_ney = KneserNey(wg.word_probs)
+    evaluator = evaluate.Evaluator(wg.word_probs, kneser_ney)
+    scored = evaluator.score_sentence("Went to google, zzz")
+    words = ['went', 'to', 'google', 'zzz']
+    assert [pair[0] for pair in scored['surprisal']] == words
+    expected = [-math.log2(kneser_ney.score(words[max(i - 2, 0):i],
+        words[i])) for i in range(3)]
+    for i in range(3):
+        assert abs(scored['surprisal'][i][1] - expected[i]) < 1e-9
+    assert scored['surprisal'][3][1] == None
+    assert abs(scored['log_prob'] + sum(expected)) < 1e-9
+    assert abs(scored['perplexity'] - 2 ** (sum(expected) / 3)) < 1e-9
+
+    serial = evaluate.evaluate_files(model_name, files)
+    num_tokens = sum(len(list(TextUtils.iter_file_tokens(file)))
+        for file in files)
+    assert serial['tokens'] + serial['oov'] + serial['zero'] == num_tokens
+    assert serial['oov'] > 0 and serial['zero'] == 0
+    assert serial['cache']['hits'] > 0 and serial['tokens_per_sec'] > 0
+    assert 1 < serial['perplexity'] < len(wg.word_probs.vocab)
+
+    min_shard_bytes = word_predictor.MIN_SHARD_BYTES
+    word_predictor.MIN_SHARD_BYTES = 256
+    try:
+        assert len(evaluate.file_shards(files, 3)) > 2
+        parallel = evaluate.evaluate_files(model_name, files, processes = 3)
+    finally:
+        word_predictor.MIN_SHARD_BYTES = min_shard_bytes
+    for key in ('tokens', 'oov', 'zero'):
+        assert parallel[key] == serial[key]
+    assert abs(parallel['log_prob'] - serial['log_prob']) < 1e-6
+    print("PASSED: evaluate")
+
+# Test the benchmark suite's corpora, results and regression checks
+def test_bench_suite():
+    directory = tempfile.mkdtemp()
+    names = [os.path.join(directory, name) for name in ('a.txt', 'b.txt')]
+    for name in names:
+        bench.write_zipf_corpus(name, 1000, 50, seed = 1)
+    with open(names[0]) as first, open(names[1]) as second:
+        assert first.read() == second.read()
+    with open(names[0]) as file:
+        words = [word for words in TextUtils.normalize_lines(file)
+            for word in words]
+    assert len(words) == 1000 and len(set(words)) <= 50
+    assert words.count('a') > words.count('b') > words.count('c')
+
+    results = bench.run_suite(TST_DIR + TXT_FILE_TO_NGRAM, num_words = 2000,
+        vocab_size = 100, repeat = 1)
+    assert set(results['results'].keys()) == set(corpus + '/' + name
+        for corpus in ('zipf', 'file') for name in ('normalize_line',
+        'file_to_ngram', 'add_ngram_observations', 'train_unchunked',
+        'train_chunked', 'save_word_gen',
+        'load_word_gen', 'merge_small_delta', 'get_next_words',
+        'predict_words') +
+        tuple('beam_search_%d' % width for width in bench.BEAM_TARGETS) +
+        ('complete_word', 'legacy_complete_word')) | \
+        set('startup/' + mode for mode, script, arguments in
+        bench.STARTUP_MODES)
+    for result in results['results'].values():
+        assert result['ops_per_sec'] > 0 and result['peak_rss'] > 0
+        assert result['alloc_peak_bytes'] > 0
+    beam = results['results']['zipf/beam_search_5']
+    assert 0 < beam['p50_ms'] <= beam['p99_ms'] and beam['target_ms'] > 0
+    missed = bench.missed_targets({'results': {'x': dict(beam,
+        target_ms = beam['p99_ms'] / 2)}})
+    assert missed == [('x', beam['p99_ms'], beam['p99_ms'] / 2)]
+    assert bench.compare_results(results, results) == []
+    # packing in chunks while training keeps the memory target, on a corpus
+    # large enough for the pending observations to outweigh the store
+    chunked = results['results']['file/train_chunked']
+    assert chunked['alloc_target_bytes'] > 0
+    assert bench.missed_memory_targets({'results': {'file/train_chunked':
+        chunked}}) == []
+
+    slower = {'results': dict((name, dict(result, ops_per_sec =
+        result['ops_per_sec'] * 0.7)) for name, result in
+        results['results'].items())}
+    regressions = bench.compare_results(slower, results, threshold = 0.2)
+    assert len(regressions) == len(results['results'])
+    assert bench.compare_results(slower, results, threshold = 0.4) == []
+    print("PASSED: benchmark suite")
+
+# Test that generating from a saved model never imports nltk, which is only
+# needed to retrain on its corpora
+def test_lazy_imports():
+    directory = tempfile.mkdtemp()
+    model_name = os.path.join(directory, 'model.bin')
+    word_predictor.save_word_gen(model_name,
+        word_predictor.train_on_plain_text(3, [TST_DIR + TXT_FILE_TO_NGRAM]))
+    script = ("import runpy, sys\n"
+        "sys.argv = ['word_predictor.py', '-m', %r, '-s', 'went to']\n"
+        "runpy.run_path('word_predictor.py', run_name = '__main__')\n"
+        "print(sorted(name for name in sys.modules\n"
+        "    if name.split('.')[0] == 'nltk'))\n" % model_name)
+    output = subprocess.run([sys.executable, '-c', script],
+        stdout = subprocess.PIPE, check = True, universal_newlines = True)
+    lines = output.stdout.splitlines()
+    assert lines[0].startswith('went to ')
+    assert lines[-1] == '[]'
+    print("PASSED: lazy imports")
+
+# Test that the profiler times and counts stages only while enabled
+def test_profiler():
+    wg = word_predictor.train_on_plain_text(3, [TST_DIR + TXT_FILE_TO_NGRAM])
+    original = TextUtils.__dict__['normalize_line']
+    random.seed(1)
+    expected = word_predictor.predict_words(wg, 'went to', 10)
+
+    profiler.reset()
+    profiler.enable({'word_predictor': word_predictor})
+    try:
+        random.seed(1)
+        assert word_predictor.predict_words(wg, 'went to', 10) == expected
+        assert TextUtils.normalize_line('A b') == ['a', 'b']
+    finally:
+        profiler.disable()
+    assert TextUtils.__dict__['normalize_line'] is original
+    assert not profiler.ENABLED
+
+    stats = profiler.snapshot()
+    timers = stats['timers']
+    assert timers['predict']['calls'] == 1
+    assert timers['normalize']['calls'] == 2
+    assert timers['choose']['calls'] == timers['lookup']['calls'] == 10
+    assert timers['predict']['seconds'] >= timers['choose']['seconds']
+    assert stats['counters']['lookups'] == 10
+    assert stats['values']['matched_length']['max'] == 2
+    assert stats['values']['successors']['count'] == 10
+    assert stats['values']['backoff_depth']['count'] == 10
+
+    # nothing is counted once disabled
+    word_predictor.predict_words(wg, 'went to', 10)
+    assert profiler.snapshot() == stats
+
+    sampler = profiler.StackSampler(interval = 0.0005)
+    sampler.start()
+    start = time.time()
+    while time.time() - start < 0.1:
+        sum(range(1000))
+    sampler.stop()
+    assert any('test.py:test_profiler' in stack for stack in sampler.stacks)
+    stacks_name = os.path.join(tempfile.mkdtemp(), 'stacks.txt')
+    sampler.write(stacks_name)
+    with open(stacks_name) as file:
+        for line in file:
+            stack, samples = line.rsplit(' ', 1)
+            assert int(samples) > 0 and 'profiler.py:wrapper' not in stack
+    print("PASSED: profiler")
+
+# Test appending to a model's journal, loading it and compacting it
+def test_journal():
+    files = [TST_DIR + TXT_FILE_TO_NGRAM, TST_DIR + TXT_NORMAL_FILE]
+    directory = tempfile.mkdtemp()
+    model_name = os.path.join(directory, 'model.bin')
+    word_predictor.save_word_gen(model_name,
+        word_predictor.train_on_plain_text(3, files[0:1]))
+
+    # training into an existing generator adds to it
+    expected = word_predictor.train_on_plain_text(3, files[0:1])
+    word_predictor.train_on_plain_text(3, files[1:2], expected)
+    assert_same_word_gen(expected,
+        word_predictor.train_on_plain_text(3, files))
+
+    assert word_predictor.append_to_model(model_name, files[1:2],
+        compact_after = 0) == 1
+    assert_same_word_gen(word_predictor.load_word_gen(model_name), expected)
+    word_predictor.train_on_plain_text(3, files[1:2], expected)
+    delta = word_predictor.train_on_plain_text(3, files[1:2])
+    assert journal.append_segment(model_name, delta.word_probs) == 2
+    assert_same_word_gen(word_predictor.load_word_gen(model_name), expected)
+
+    # compacting folds the segments in and records the last one
+    assert journal.compact(model_name) == 2
+    assert journal.list_segments(model_name) == []
+    assert journal.read_word_probs(model_name)[1] == 2
+    assert_same_word_gen(word_predictor.load_word_gen(model_name), expected)
+
+    # segments missing from the middle of the journal are noticed
+    assert journal.append_segment(model_name, delta.word_probs) == 3
+    assert journal.append_segment(model_name, delta.word_probs) == 4
+    os.remove(journal.segment_path(model_name, 3))
+    try:
+        journal.read_segments(model_name, 2)
+        assert False
+    except FileNotFoundError:
+        pass
+    assert journal.read_segments(model_name, 3)[1] == 4
+    journal.remove_segments(model_name, 4)
+
+    # one compaction at a time, unless the lock was left by a dead process
+    lock = journal.acquire_lock(model_name)
+    assert lock != None and journal.acquire_lock(model_name) == None
+    assert journal.compact(model_name) == None
+    with open(lock, 'w') as file:
+        file.write('999999999')
+    assert journal.compact(model_name) == 0
+
+    # saving a whole model replaces its journal
+    journal.append_segment(model_name, delta.word_probs)
+    retrained = word_predictor.train_on_plain_text(3, files[0:1])
+    word_predictor.save_word_gen(model_name, retrained)
+    assert journal.list_segments(model_name) == []
+    assert_same_word_gen(word_predictor.load_word_gen(model_name), retrained)
+
+    # a model file written with an older format version is rewritten whole
+    modelfile.write_sections(model_name, [('counts', array.array('i'))],
+        version = 1)
+    journal.append_segment(model_name, delta.word_probs)
+    word_predictor.save_word_gen(model_name, retrained)
+    assert journal.list_segments(model_name) == []
+    assert journal.read_word_probs(model_name)[1] == 1
+    assert_same_word_gen(word_predictor.load_word_gen(model_name), retrained)
+
+    # model files are written under a unique temporary name, which never
+    # outlives the write, and get the usual permissions
+    class Unwritable(array.array):
+        def tobytes(self):
+            raise IOError("disk full")
+    names = set(os.listdir(directory))
+    try:
+        modelfile.write_sections(model_name, [('counts',
+            Unwritable('i', [1]))])
+        assert False
+    except IOError:
+        pass
+    assert set(os.listdir(directory)) == names
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(model_name).st_mode & 0o777 == 0o666 & ~umask
+    word_predictor.del_word_gen(model_name)
+    assert not os.path.exists(journal.journal_dir(model_name))
+    print("PASSED: journal")
+
+# Test that incremental generation matches re-normalizing the whole string
+def test_predict_words():
+    wg = word_predictor.train_on_plain_text(3, [TST_DIR + TXT_FILE_TO_NGRAM,
+        TST_DIR + 'test_file_to_ngram copy.txt'])
+    for seed in ('', 'the other', 'Went TO the', 'unknown words', 'html'):
+        random.seed(seed)
+        expected = bench.legacy_predict_words(wg, seed, 40)
+        random.seed(seed)
+        assert word_predictor.predict_words(wg, seed, 40) == expected
+
+    # words are produced lazily, one at a time
+    predicted = word_predictor.iter_predicted_words(wg, ['the', 'other'],
+        10 ** 9)
+    assert next(predicted) == 'day'
+    assert next(predicted) == 'and'
+
+    # sampled predictions repeat with the same seed
+    sampling = {'temperature': 1.5, 'top_k': 0, 'top_p': 0.9}
+    first = word_predictor.predict_words(wg, 'the', 30, sampling,
+        random.Random(3))
+    second = word_predictor.predict_words(wg, 'the', 30, sampling,
+        random.Random(3))
+    assert first == second and len(first.split()) > 1
+    many = word_predictor.predict_many(wg, ['the', 'the'], 30, sampling,
+        random.Random(3))
+    assert len(many) == 2
+    print("PASSED: predict_words")
+
+# Counts the calls made to GET_NEXT_WORDS on a WordGenerator
+class CountingPredictor:
+    def __init__(self, word_gen):
+        self.word_gen = word_gen
+        self.lookups = 0
+
+    def max_context_length(self):
+        return self.word_gen.max_context_length()
+
+    def get_next_words(self, words, **kwargs):
+        self.lookups += 1
+        return self.word_gen.get_next_words(words, **kwargs)
+
+# Test that batched generation matches generating one seed at a time, with
+# one lookup per distinct context per step
+def test_predict_many():
+    content = TextUtils.normalize_line("a b c d e f g h a b c d e f g h")
+    wg = WordGenerator(TextUtils.iter_ngrams(content, 3))
+    seeds = ['a b', 'A, B!', 'e f', 'nothing here', '', 'c d\n']
+    predictor = CountingPredictor(wg)
+    generated = word_predictor.predict_many(predictor, seeds, 6)
+    assert generated == [word_predictor.predict_words(wg, seed, 6)
+        for seed in seeds]
+    assert generated[0] == 'a b c d e f g h'
+    assert generated[3] == 'nothing here'
+    # 3 distinct contexts per step, plus 2 dead ends on the first step
+    assert predictor.lookups == 3 * 6 + 2
+
+    out_file = tempfile.TemporaryFile('w+')
+    word_predictor.predict_file(wg, iter(seeds), out_file, 6, batch_size = 4)
+    out_file.seek(0)
+    assert out_file.read().split('\n') == generated + ['']
+    print("PASSED: predict_many")
+
+# Test that the beam search finds continuations that picking the most
+# likely word at each step misses, and ranks them by their log probability
+def test_beam_search():
+    ng = [('a', 'b')] * 3 + [('a', 'c')] * 2 + [('b', 'd')] * 5 + \
+        [('b', 'e')] * 3 + [('b', 'f')] * 2 + [('b', 'h')] * 2 + \
+        [('c', 'g')] * 2
+    wg = WordGenerator(ng)
+    assert [word for word, probability in wg.get_next_words(['b'], 0, 3)] \
+        == ['d', 'e', 'f', 'h']
+    assert wg.get_top_words(['b'], 3) == wg.get_next_words(['b'], 0, 3)[0:3]
+    assert wg.get_top_words(['zzz'], 3) == None
+
+    # greedily, b is more likely after a, but a c g is the likelier pair
+    greedy = word_predictor.beam_search(wg, 'A', 5, beam_width = 1)
+    assert greedy == [('a b d', math.log2(0.6 * 5 / 12))]
+    best = word_predictor.beam_search(wg, 'a', 5, beam_width = 2,
+        num_results = 3)
+    assert best == [('a c g', math.log2(0.4)),
+        ('a b d', math.log2(0.6 * 5 / 12))]
+    best = word_predictor.beam_search(wg, 'a', 5, beam_width = 4)
+    assert [text for text, log_prob in best[0:3]] == ['a c g', 'a b d',
+        'a b e']
+    assert best[3][0] in ('a b f', 'a b h') and len(best) == 4
+    assert word_predictor.beam_search(wg, 'a', 1, beam_width = 4)[0] == \
+        ('a b', math.log2(0.6))
+    assert word_predictor.beam_search(wg, 'zzz', 5) == [('zzz', 0.0)]
+
+    # without length normalization, stopping early is more probable
+    short = WordGenerator([('x', 'y')] * 2 + [('x', 'z')] * 3 +
+        [('y', 'w')] * 2 + [('y', 'v')] * 1)
+    assert word_predictor.beam_search(short, 'x', 5, 2,
+        length_penalty = 0)[0][0] == 'x z'
+    assert word_predictor.beam_search(short, 'x', 5, 2,
+        length_penalty = 2)[0][0] == 'x y w'
+    print("PASSED: beam_search")
+
+# Test that completing a partly typed word through the prefix index finds
+# the same words as looking at every successor, for contexts small enough to
+# be scanned and big enough to be indexed, with both kinds of vocabulary
+def test_complete_word():
+    assert completion.prefix_end('ab') == 'ac'
+    assert completion.prefix_end('a\U0010ffff') == 'b'
+    rng = random.Random(0)
+    words = [bench.letter_word(i) for i in range(400)]
+    ng = [('x', rng.choice(words[0:300])) for i in range(3000)] + \
+        [('y', 'x', rng.choice(words)) for i in range(2000)] + \
+        [('z', rng.choice(words[0:20])) for i in range(40)]
+    wg = WordGenerator(ng)
+    model_name = os.path.join(tempfile.mkdtemp(), 'model.bin')
+    word_predictor.save_word_gen(model_name, wg)
+    loaded = word_predictor.load_word_gen(model_name)
+    for predictor in (wg, loaded):
+        for context in (['x'], ['y', 'x'], ['z']):
+            for prefix in ['', 'a', 'b', 'ab', 'ba', 'zz'] + words[0:30]:
+                expected = bench.legacy_complete_word(predictor, context,
+                    prefix, 4)
+                found = predictor.get_completions(context, prefix, 4)
+                if expected != None and len(expected) == 4:
+                    assert found == expected
+                elif found != None:
+                    # the rest come from the shorter contexts
+                    assert found[0:len(expected or [])] == (expected or [])
+                    assert all(word.startswith(prefix) for word, probability
+                        in found)
+        assert predictor.get_completions(['x'], '', 3) == \
+            predictor.get_top_words(['x'], 3)
+        assert predictor.get_completions(['x'], 'qq') == None
+        assert predictor.get_completions(['q'], 'a') == None
+
+    # the index finds the same lowest positions as a scan, for runs of
+    # matches of any size
+    index = wg.word_probs.get_prefix_index()
+    start, end, total = wg.word_probs.find_context(['x'])
+    ranks, tree = index.get_index(start, end)
+    assert tree.typecode == 'q'
+    for lo in range(0, len(words), 7):
+        for hi in (lo + 1, lo + 5, lo + 50, len(words)):
+            first = bisect.bisect_left(ranks, lo)
+            last = bisect.bisect_left(ranks, hi)
+            for num_to_return in (1, 4, 50):
+                expected = index.scan(start, end, lo, hi, num_to_return)
+                assert index.lowest(tree, first, last, num_to_return) == \
+                    expected
+                assert index.complete(start, end, lo, hi,
+                    num_to_return) == expected
+
+    # a context with no completion backs off to a shorter one
+    wg = WordGenerator([('a', 'b', 'cat'), ('a', 'b', 'cab'), ('x', 'b', 'dog'),
+        ('x', 'b', 'dog'), ('b', 'dot')])
+    assert wg.get_completions(['a', 'b'], 'ca', 2) == [('cat', 0.5),
+        ('cab', 0.5)]
+    assert wg.get_completions(['a', 'b'], 'do', 2) == [('dog', 0.4),
+        ('dot', 0.2)]
+    assert word_predictor.complete_word(wg, 'A b Do', 1) == [('dog', 0.4)]
+    assert word_predictor.complete_word(wg, 'a b ', 1) == \
+        wg.get_completions(['a', 'b'], '', 1)
+    print("PASSED: complete_word")
+
+# Test that a snapshot of a VersionedModel never changes once published,
+# and that readers in other threads only ever see whole versions while a
+# writer keeps publishing
+def test_snapshots():
+    model = snapshot.VersionedModel(configure = lambda word_gen:
+        word_gen.set_cache(16), publish_interval = 0)
+    first = model.snapshot()
+    assert first.version == 1 and first.word_gen().get_next_words(['a']) \
+        == None
+    second = model.add_list_of_ngrams([('a', 'b'), ('a', 'c'), ('a', 'b')])
+    assert second is model.snapshot() and second.version == 2
+    assert first.word_gen().get_next_words(['a']) == None
+    assert second.word_gen().get_next_words(['a']) == [('b', 2 / 3)]
+    assert second.word_gen().cache != None
+    third = model.add_list_of_ngrams([('a', 'd'), ('d', 'e')])
+    # words added after a snapshot was published are hidden from it
+    assert second.vocab.get_id('d') == None and len(second.vocab) == 3
+    assert second.word_gen().get_completions(['a'], 'd') == None
+    assert third.word_gen().get_completions(['a'], 'd') == [('d', 0.25)]
+    assert second.word_gen().get_next_words(['a']) == [('b', 2 / 3)]
+    try:
+        second.word_probs().add_ngram_observations([('a', 'z')])
+        assert False
+    except TypeError:
+        pass
+
+    # the scorer and the prefix index are built once per snapshot, when it
+    # is published, and shared by every thread, which only has its own cache
+    configured = []
+    def configure(word_gen):
+        configured.append(word_gen)
+        word_gen.set_cache(16)
+        word_gen.set_scorer(KneserNey(word_gen.word_probs))
+    model = snapshot.VersionedModel(configure = configure,
+        publish_interval = 0)
+    current = model.add_list_of_ngrams([('a', 'b'), ('a', 'c'), ('a', 'b')])
+    assert len(configured) == 2
+    word_gens = []
+    threads = [threading.Thread(target = lambda: word_gens.append(
+        current.word_gen())) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    word_gens.append(current.word_gen())
+    assert len(configured) == 2 and len(set(map(id, word_gens))) == 3
+    for word_gen in word_gens:
+        assert word_gen.scorer is current.shared.scorer
+        assert word_gen.word_probs.prefix_index.ranks is \
+            current.shared.word_probs.prefix_index.ranks
+        assert word_gen.cache is not current.shared.cache
+        assert word_gen.get_next_words(['a']) == \
+            current.shared.scorer.get_next_words(['a'])
+        assert word_gen.get_completions(['a'], 'c') == [('c', 1 / 3)]
+
+    # publishes are at most once per interval, and observations added sooner
+    # wait for the next one
+    model = snapshot.VersionedModel(publish_interval = 60)
+    first = model.snapshot()
+    assert model.add_list_of_ngrams([('a', 'b')]) is first
+    assert model.add_list_of_ngrams([('a', 'c')]) is first
+    assert model.timer != None
+    second = model.publish()
+    assert second.version == 2 and model.timer == None
+    assert second.word_gen().find_context(['a'])[2] == 2
+    assert model.publish() is second
+    model = snapshot.VersionedModel(publish_interval = 0.05)
+    model.add_list_of_ngrams([('a', 'b')])
+    for i in range(100):
+        if model.snapshot().version == 2:
+            break
+        time.sleep(0.01)
+    assert model.snapshot().word_gen().get_next_words(['a']) == [('b', 1.0)]
+
+    # every batch adds 10 observations of ('ctx', ...), so the version
+    # alone says what the total of 'ctx' must be
+    model = snapshot.VersionedModel(publish_interval = 0)
+    done = threading.Event()
+    failures = []
+    def read():
+        last = 0
+        while not done.is_set():
+            current = model.snapshot()
+            word_gen = current.word_gen()
+            found = word_gen.find_context(['ctx'])
+            total = 0
+            if found != None:
+                start, end, total = found
+                if sum(current.store.counts[start:end]) != total:
+                    failures.append('counts')
+            if total != 10 * (current.version - 1) or current.version < last:
+                failures.append((current.version, total))
+            last = current.version
+    readers = [threading.Thread(target = read) for i in range(4)]
+    for reader in readers:
+        reader.start()
+    for i in range(50):
+        model.add_list_of_ngrams([('ctx', 'w%d' % (j % 7)) for j in
+            range(i, i + 10)])
+    done.set()
+    for reader in readers:
+        reader.join()
+    assert failures == [] and model.snapshot().version == 51
+    assert model.publish_latency.total == 51
+
+    result = bench.bench_snapshots(num_readers = 2, num_batches = 5,
+        publish_interval = 0)
+    assert result['inconsistent'] == 0 and result['publishes'] == 5
+    assert result['publish']['count'] == 6
+    assert result['publish_peak_bytes'] > result['store_bytes'] > 0
+    result = bench.bench_snapshots(num_readers = 2, num_batches = 5,
+        publish_interval = 60)
+    assert result['inconsistent'] == 0 and result['publishes'] == 1
+    print("PASSED: snapshots")
+
+# Test that the prediction server answers batched requests the same way as
+# calling word_predictor directly, over a Unix socket
+def test_server():
+    wg = word_predictor.train_on_plain_text(3, [TST_DIR + TXT_FILE_TO_NGRAM])
+    socket_path = os.path.join(tempfile.mkdtemp(), 'server.sock')
+    seeds = ['the', 'the other', 'nothing here', 'Went TO the']
+
+    async def exercise():
+        prediction_server = server.PredictionServer(wg, batch_window = 0.01)
+        await prediction_server.start(socket_path)
+        requests = [{'op': 'generate', 'seed': seed, 'max_words': 8, 'id': i}
+            for i, seed in enumerate(seeds)]
+        results = await asyncio.gather(*[loadgen.send_requests([request],
+            socket_path) for request in requests])
+        responses = await loadgen.send_requests([
+            {'op': 'next', 'seed': 'the other', 'num': 2},
+            {'op': 'next', 'seed': 'zzz qqq'},
+            {'op': 'generate', 'seed': 'the', 'sample': True,
+                'temperature': 0},
+            {'op': 'unknown'},
+            {'op': 'complete', 'seed': 'the other', 'max_words': 6,
+                'beam_width': 3},
+            {'op': 'complete_word', 'seed': 'went to s', 'num': 2},
+            {'op': 'stats'}], socket_path)
+        report = await loadgen.run_load(seeds, {'op': 'next'}, 4, 5,
+            socket_path)
+        await prediction_server.stop()
+        return (results, responses, report)
+
+    results, responses, report = asyncio.run(exercise())
+    # ties between the best words are broken at random, so only the shape
+    # of each prediction is checked
+    for i in range(len(seeds)):
+        assert results[i][0]['id'] == i
+        words = results[i][0]['text'].split()
+        seed_words = TextUtils.normalize_line(seeds[i])
+        assert words[0:len(seed_words)] == seed_words
+        assert len(seed_words) <= len(words) <= len(seed_words) + 8
+    assert responses[0]['words'] == wg.get_next_words(['the', 'other'],
+        num_to_return = 2)
+    assert responses[1]['words'] == None
+    assert 'error' in responses[2] and 'error' in responses[3]
+    assert responses[4]['continuations'] == [list(continuation) for
+        continuation in word_predictor.beam_search(wg, 'the other', 6, 3)]
+    assert responses[5]['words'] == [list(word) for word in
+        word_predictor.complete_word(wg, 'went to s', 2)]
+    stats = responses[6]
+    assert stats['requests'] == len(seeds) + 6
+    # the concurrent generate requests were answered together
+    assert stats['batches'] < len(seeds) + 3
+    assert report['requests'] == 20 and report['errors'] == 0
+    assert report['server']['latency']['next']['count'] == 22
+
+    # a request that raises only fails its own group of the batch
+    failing = WordGenerator.from_word_probs(wg.word_probs)
+    get_next_words = failing.get_next_words
+    def get_next_words_or_fail(words, *args, **kwargs):
+        if 'boom' in words:
+            raise RuntimeError("lookup failed")
+        return get_next_words(words, *args, **kwargs)
+    failing.get_next_words = get_next_words_or_fail
+
+    prediction_server = server.PredictionServer(failing)
+    responses = prediction_server.answer_batch([{'op': op, 'seed': seed,
+        'max_words': max_words} for op, seed, max_words in [
+        ('generate', 'the boom', 5), ('generate', 'the', 6),
+        ('next', 'boom', 0), ('next', 'the other', 0)]])
+    assert responses[0] == {'error': "lookup failed"}
+    assert responses[1]['text'].startswith('the')
+    assert responses[2] == {'error': "lookup failed"}
+    assert responses[3]['words'] == wg.get_next_words(['the', 'other'])
+
+    # requests are held to the server's limits, and a line too long to read
+    # gets an error and ends the connection
+    async def exercise_limits():
+        prediction_server = server.PredictionServer(wg, max_words = 3,
+            max_num = 2, max_beam_width = 2)
+        await prediction_server.start(socket_path)
+        responses = await loadgen.send_requests([
+            {'op': 'generate', 'seed': 'the', 'max_words': 1000000},
+            {'op': 'next', 'seed': 'the', 'num': 1000000},
+            {'op': 'complete', 'seed': 'the', 'max_words': 1000000,
+                'beam_width': 1000000, 'num': 1000000}], socket_path)
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b'{"op": "next", "seed": "' + b'a' * (1 << 17) +
+            b'"}\n')
+        await writer.drain()
+        too_long = json.loads(await reader.readline())
+        closed = await reader.read()
+        writer.close()
+        stats = prediction_server.stats()
+        await prediction_server.stop()
+        return (responses, too_long, closed, stats)
+
+    responses, too_long, closed, stats = asyncio.run(exercise_limits())
+    assert len(responses[0]['text'].split()) <= 1 + 3
+    assert responses[1]['words'] == [list(word) for word in
+        wg.get_next_words(['the'], num_to_return = 2)]
+    assert responses[2]['continuations'] == [list(continuation) for
+        continuation in word_predictor.beam_search(wg, 'the', 3, 2, 2)]
+    assert 'error' in too_long and closed == b''
+    assert stats['errors'] == 1
+    print("PASSED: server")
+
+# Asserts that the WordGenerators A and B hold exactly the same model
+def assert_same_word_gen(a, b):
+    a.freeze()
+    b.freeze()
+    a_probs = a.word_probs
+    b_probs = b.word_probs
+    assert len(a_probs.vocab) == len(b_probs.vocab)
+    for i in range(len(a_probs.vocab)):
+        assert a_probs.vocab.get_word(i) == b_probs.vocab.get_word(i)
+    a_contexts = list(a_probs.store.iter_contexts())
+    assert a_contexts == list(b_probs.store.iter_contexts())
+    assert list(a_probs.store.successors) == list(b_probs.store.successors)
+    assert list(a_probs.store.counts) == list(b_probs.store.counts)
+    assert sorted(a_probs.store.children.keys()) == \
+        sorted(b_probs.store.children.keys())
+    for k in a_probs.store.children:
+        assert list(a_probs.store.children[k]) == \
+            list(b_probs.store.children[k])
+
 # Test TestUtils
 def run_text_tests():
 	textutils_normalize_line()
 	textutils_file_to_ngram()
+	textutils_streaming()
+	textutils_normalize_matches_legacy()
 	print("PASSED: TextUtils")
 
 # Test TextUtils.normalize_line
@@ -166,6 +1416,47 @@ def textutils_file_to_ngram():
 	assert i > 0
 
 
+# Test that the streaming helpers match normalizing whole lines at once
+def textutils_streaming():
+	for name in (TXT_FILE_TO_NGRAM, TXT_NORMAL_FILE):
+		expected = []
+		for line in Utilities.open_file(TST_DIR + name):
+			expected += TextUtils.normalize_line(line)
+			expected.append(' ')
+		# small chunks force lines and words to be split between reads
+		for chunk_size in (3, 64, 4096):
+			tokens = TextUtils.iter_file_tokens(TST_DIR + name, chunk_size)
+			assert list(tokens) == expected
+		assert list(TextUtils.iter_ngrams(expected, 3)) == \
+			list(zip(expected, expected[1:], expected[2:]))
+
+	words = ['Hello,', 'world', '!', "isn't", 'it', 'grand'] * 7
+	expected = TextUtils.normalize_line(' '.join(words))
+	for batch_size in (1, 4, 100):
+		assert list(TextUtils.iter_word_tokens(words, batch_size)) == expected
+	assert list(TextUtils.iter_ngrams(['a', 'b'], 3)) == []
+
+
+# Test that the str.translate based normalizer matches the original one
+def textutils_normalize_matches_legacy():
+	lines = []
+	for name in (TXT_FILE_TO_NGRAM, TXT_NORMAL_FILE, 'test_file_to_ngram copy.txt'):
+		lines += list(Utilities.open_file(TST_DIR + name))
+	lines += ["Ça va? ÉCOLE naïve", "x\u00b2 + \u2167 \u00bd", "İstanbul ΟΔΟΣ",
+		"tab\tsep\x1cinfo\u3000wide", "under_score\0null", "", "   "]
+	for line in lines:
+		assert TextUtils.normalize_line(line) == bench.legacy_normalize_line(line)
+	assert TextUtils.normalize_lines(lines) == \
+		[bench.legacy_normalize_line(line) for line in lines]
+	assert TextUtils.normalize_lines(iter(lines[0:3])) == \
+		[bench.legacy_normalize_line(line) for line in lines[0:3]]
+	assert TextUtils.normalize_lines([]) == []
+	# a whole buffer of lines is one string to NORMALIZE_LINE, with line
+	# breaks treated like any other white space
+	assert TextUtils.normalize_line(''.join(lines)) == \
+		bench.legacy_normalize_line(''.join(lines))
+
+
 if __name__ == "__main__":
 	run_test_suite()
 	
\ No newline at end of file
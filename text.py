@@ -1,26 +1,216 @@
-from nltk.util import ngrams
 from util import Utilities
-import re
+from collections import deque
+import codecs
+import locale
+import os
+
+# The number of characters read from a file at a time while streaming it
+CHUNK_SIZE = 1 << 20
+
+# The version of the tokens produced by NORMALIZE_LINE and the functions
+# built on it. Bump it whenever their output changes, so that tokens cached
+# by corpuscache.py are normalized again
+NORMALIZER_VERSION = 1
+
+# A table for str.translate that maps every character that is neither a
+# letter nor white space to a space, and every other character to itself.
+# Characters are looked up with str.isalpha and str.isspace the first time
+# they are seen, and the result is kept for next time
+class NormalizeTable(dict):
+
+	def __missing__(self, code):
+		character = chr(code)
+		if character.isalpha() or character.isspace():
+			value = code
+		else:
+			value = SPACE
+		self[code] = value
+		return value
+
+SPACE = ord(' ')
+NORMALIZE_TABLE = NormalizeTable()
+
+# NORMALIZE_LINES joins lines with LINE_SEPARATOR, which must survive
+# cleaning so the result can be split back into lines
+LINE_SEPARATOR = '\0'
+NORMALIZE_LINES_TABLE = NormalizeTable()
+NORMALIZE_LINES_TABLE[ord(LINE_SEPARATOR)] = ord(LINE_SEPARATOR)
+
 
 class TextUtils:
 
 	# Converts the file located at FILE_PATH to an ngram of with length N.
-	# If the file does not exist, NONE is returned. Otherwise, an NGRAM is
-	# returned. The type is NLTK.UTIL.NGRAMS
+	# If the file does not exist, NONE is returned. Otherwise, a generator of
+	# ngram tuples is returned. The file is streamed in chunks as the
+	# generator is consumed, so memory use doesn't grow with the file size.
+	# An optional THROUGHPUT object (see Utilities.Throughput) is updated as
+	# the file is read
 	@staticmethod
-	def file_to_ngram(file_path, n):
+	def file_to_ngram(file_path, n, throughput = None):
 		if n < 1:
 			return None
 		if Utilities.is_file(file_path) == False:
 			return None
-		fileContent = []
-		file = Utilities.open_file(file_path);
-		for line in file:
-			fileContent += TextUtils.normalize_line(line)
-			fileContent.append(' ')
+		tokens = TextUtils.iter_file_tokens(file_path, throughput = throughput)
+		return TextUtils.iter_ngrams(tokens, n)
 
-		ng = ngrams(fileContent, n)
-		return ng
+	# Yields every ngram of length N from the iterable TOKENS as a tuple, in
+	# order. Only the last N - 1 tokens are held at any time, so TOKENS can be
+	# a stream of any length
+	@staticmethod
+	def iter_ngrams(tokens, n):
+		window = deque(maxlen = n)
+		for token in tokens:
+			window.append(token)
+			if len(window) == n:
+				yield tuple(window)
+
+	# Yields the normalized words of the file at FILE_PATH, reading
+	# CHUNK_SIZE characters at a time. Each line is followed by a ' ' token,
+	# which is what FILE_TO_NGRAM has always produced. Lines that are longer
+	# than a chunk are split at whitespace, so no chunk is ever held twice.
+	# An optional THROUGHPUT object is updated after every chunk
+	@staticmethod
+	def iter_file_tokens(file_path, chunk_size = CHUNK_SIZE, throughput = None):
+		file = Utilities.open_file(file_path)
+		if file == None:
+			return
+		with file:
+			chunks = iter(lambda: file.read(chunk_size), '')
+			yield from TextUtils.iter_chunk_tokens(chunks, chunk_size,
+				throughput, file.buffer.tell)
+
+	# Same as ITER_FILE_TOKENS, but only reads the bytes from START up to END
+	# (or the end of the file if END is None). START and END must be the
+	# beginning of a line, such as the offsets returned by SPLIT_FILE. The
+	# tokens of consecutive ranges add up to the tokens of the whole file
+	@staticmethod
+	def iter_file_range_tokens(file_path, start, end, chunk_size = CHUNK_SIZE,
+		throughput = None):
+		with open(file_path, 'rb') as file:
+			file.seek(start)
+			chunks = TextUtils.read_range_chunks(file, start, end, chunk_size)
+			yield from TextUtils.iter_chunk_tokens(chunks, chunk_size,
+				throughput, lambda: file.tell() - start)
+
+	# Yields the normalized words in CHUNKS, an iterable of strings that
+	# together make up a text. See ITER_FILE_TOKENS. If THROUGHPUT is given,
+	# it is updated after every chunk with the byte position returned by
+	# GET_POSITION
+	@staticmethod
+	def iter_chunk_tokens(chunks, chunk_size, throughput = None,
+		get_position = None):
+		# CARRY is the unfinished last line. SPLIT_LINE is true if part of
+		# that line has already been emitted
+		carry = ''
+		split_line = False
+		for chunk in chunks:
+			lines = (carry + chunk).split('\n')
+			carry = lines.pop()
+			tokens = []
+			for words in TextUtils.normalize_lines(lines):
+				tokens += words
+				tokens.append(' ')
+				split_line = False
+			if len(carry) > chunk_size:
+				# no newline in sight, so emit everything up to the last
+				# break between words and keep the rest
+				cut = TextUtils.last_break(carry)
+				tokens += TextUtils.normalize_line(carry[0:cut])
+				carry = carry[cut:]
+				split_line = split_line or cut > 0
+			if throughput != None:
+				throughput.update(len(tokens), get_position())
+			yield from tokens
+		if carry != '' or split_line:
+			tokens = TextUtils.normalize_line(carry)
+			tokens.append(' ')
+			if throughput != None:
+				throughput.update(len(tokens), get_position())
+			yield from tokens
+
+	# Yields the text in FILE, a file opened in binary mode and positioned at
+	# START, up to the byte offset END (or the end of the file if END is
+	# None). The bytes are decoded and newlines translated the same way as a
+	# file opened in text mode
+	@staticmethod
+	def read_range_chunks(file, start, end, chunk_size):
+		decoder = codecs.getincrementaldecoder(
+			locale.getpreferredencoding(False))()
+		position = start
+		pending_cr = ''
+		while end == None or position < end:
+			size = chunk_size
+			if end != None:
+				size = min(size, end - position)
+			data = file.read(size)
+			if data == b'':
+				break
+			position += len(data)
+			text = pending_cr + decoder.decode(data)
+			pending_cr = ''
+			# a '\r' at the end of a chunk may be half of a '\r\n'
+			if text.endswith('\r'):
+				text = text[0:-1]
+				pending_cr = '\r'
+			yield text.replace('\r\n', '\n').replace('\r', '\n')
+		text = pending_cr + decoder.decode(b'', True)
+		if text != '':
+			yield text.replace('\r\n', '\n').replace('\r', '\n')
+
+	# Splits the file at FILE_PATH into at most NUM_PARTS ranges of roughly
+	# equal size, each starting at the beginning of a line. Returns a list of
+	# (start, end) byte offsets covering the whole file
+	@staticmethod
+	def split_file(file_path, num_parts):
+		size = os.path.getsize(file_path)
+		offsets = [0]
+		with open(file_path, 'rb') as file:
+			for i in range(1, num_parts):
+				target = size * i // num_parts
+				if target <= offsets[-1]:
+					continue
+				# move to the start of the line after byte TARGET - 1
+				file.seek(target - 1)
+				file.readline()
+				if offsets[-1] < file.tell() < size:
+					offsets.append(file.tell())
+		offsets.append(size)
+		return [(offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1)]
+
+	# Yields the normalized version of every word in the iterable WORDS, such
+	# as the words of an NLTK corpus. The result is the same as normalizing
+	# ' '.join(WORDS), but only BATCH_SIZE words are joined at a time. An
+	# optional THROUGHPUT object is updated after every batch
+	@staticmethod
+	def iter_word_tokens(words, batch_size = 10000, throughput = None):
+		batch = []
+		num_bytes = 0
+		for word in words:
+			batch.append(word)
+			if len(batch) == batch_size:
+				joined = ' '.join(batch)
+				batch = []
+				tokens = TextUtils.normalize_line(joined)
+				if throughput != None:
+					num_bytes += len(joined) + 1
+					throughput.update(len(tokens), num_bytes)
+				yield from tokens
+		if len(batch) > 0:
+			joined = ' '.join(batch)
+			tokens = TextUtils.normalize_line(joined)
+			if throughput != None:
+				throughput.update(len(tokens), num_bytes + len(joined))
+			yield from tokens
+
+	# Returns the index just past the last character of LINE that can't be
+	# part of a word, or 0 if every character can be
+	@staticmethod
+	def last_break(line):
+		for i in range(len(line) - 1, -1, -1):
+			if not line[i].isalpha():
+				return i + 1
+		return 0
 
 	# Clean a line for use in creating an ngram. LINE is a string that will
 	# be cleaned and returned to the caller. Cleaning process does:
@@ -33,16 +223,21 @@ class TextUtils:
 	# cleaned version of LINE, or order of original appearance 
 	@staticmethod
 	def normalize_line(line):
-		line = line.lower()
-
-		buffer = []
-		for c in line:
-			if c.isalpha() or c.isspace():
-				buffer.append(c)
-			else:
-				buffer.append(' ')
-
-		line = "".join(buffer)
-		line = re.sub("\s+", " ", line)
-		line = line.rstrip().lstrip()
-		return line.split()
+		return line.lower().translate(NORMALIZE_TABLE).split()
+
+	# Same as calling NORMALIZE_LINE on every string in the iterable LINES,
+	# returning a list with one list of words per line. The lines are cleaned
+	# together, which is much faster than one at a time for short lines
+	@staticmethod
+	def normalize_lines(lines):
+		if not isinstance(lines, list):
+			lines = list(lines)
+		if len(lines) == 0:
+			return []
+		joined = LINE_SEPARATOR.join(lines)
+		if joined.count(LINE_SEPARATOR) != len(lines) - 1:
+			# a line contains the separator itself
+			return [TextUtils.normalize_line(line) for line in lines]
+		cleaned = joined.lower().translate(NORMALIZE_LINES_TABLE)
+		return [line.split() for line in cleaned.split(LINE_SEPARATOR)]
+
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
+from collections import OrderedDict
 import datetime
+import bisect
 import time
 import sys
 
@@ -48,4 +50,185 @@ class Utilities:
         return s
 
 
+# Keeps running totals of tokens and bytes processed by a long running job,
+# and periodically logs the rate at which they are being processed
+class Throughput:
 
+    # Class Members:
+    #   self.label: A name for the job, included in every log line
+    #   self.interval: The minimum number of seconds between log lines
+    #   self.file: The file log lines are written to
+    #   self.tokens: The total number of tokens processed
+    #   self.bytes: The total number of bytes processed
+    #   self.base_bytes: The number of bytes in the sources already finished
+
+    def __init__(self, label, interval = 5.0, file = sys.stderr):
+        self.label = label
+        self.interval = interval
+        self.file = file
+        self.tokens = 0
+        self.bytes = 0
+        self.base_bytes = 0
+        self.start_time = time.time()
+        self.last_log = self.start_time
+
+    # Records NUM_TOKENS more tokens. NUM_BYTES is the number of bytes read
+    # so far from the current source, since sources are easiest to measure
+    # by their position
+    def update(self, num_tokens, num_bytes):
+        self.tokens += num_tokens
+        self.bytes = self.base_bytes + num_bytes
+        now = time.time()
+        if now - self.last_log >= self.interval:
+            self.last_log = now
+            self.log()
+
+    # Moves on to a new source, keeping the totals from the previous ones
+    def next_source(self):
+        self.base_bytes = self.bytes
+
+    # Logs the totals and rates so far
+    def log(self):
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        Utilities.log("%s: %d tokens (%.0f tokens/sec), %.1f MB "
+            "(%.2f MB/sec)", (self.label, self.tokens, self.tokens / elapsed,
+            self.bytes / 1e6, self.bytes / 1e6 / elapsed), self.file)
+
+
+# Counts latencies in buckets whose upper bounds double from MIN_SECONDS, so
+# that any number of observations can be kept in constant space. Percentiles
+# are reported as the upper bound of the bucket they fall in
+class Histogram:
+
+    # Class Members:
+    #   self.bounds: The upper bound of each bucket, in seconds. The last
+    #       bucket has no upper bound
+    #   self.counts: The number of observations in each bucket
+    #   self.total: The number of observations
+    #   self.sum: The sum of every observation, in seconds
+    #   self.max: The largest observation, in seconds
+
+    def __init__(self, min_seconds = 1e-5, num_buckets = 24):
+        self.bounds = [min_seconds * 2 ** i for i in range(num_buckets - 1)]
+        self.counts = [0] * num_buckets
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # Records an observation of SECONDS
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Returns the upper bound of the bucket holding the FRACTION-th
+    # observation (e.g. 0.99 for the 99th percentile), or 0 if empty
+    def percentile(self, fraction):
+        if self.total == 0:
+            return 0.0
+        needed = fraction * self.total
+        seen = 0
+        for i in range(len(self.counts)):
+            seen += self.counts[i]
+            if seen >= needed and self.counts[i] > 0:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    # Returns a dictionary summarizing the histogram, with times in
+    # milliseconds
+    def summary(self):
+        mean = 0.0
+        if self.total > 0:
+            mean = self.sum / self.total
+        return {'count': self.total, 'mean_ms': mean * 1e3,
+            'p50_ms': self.percentile(0.5) * 1e3,
+            'p90_ms': self.percentile(0.9) * 1e3,
+            'p99_ms': self.percentile(0.99) * 1e3, 'max_ms': self.max * 1e3}
+
+
+# Returns the number of bytes held by VALUE and, if it is a list or tuple,
+# everything in it. Objects shared with other values, such as interned
+# strings, are counted every time, so this is an upper bound
+def deep_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            size += deep_size(item)
+    return size
+
+
+# A cache mapping keys to values that keeps at most MAX_ENTRIES values and
+# at most MAX_BYTES bytes of them, as given to PUT, evicting the least
+# recently used values first. A limit of 0 means no limit. Counts its hits,
+# misses, evictions and invalidations
+class LRUCache:
+
+    # Class Members:
+    #   self.max_entries: The most values kept, or 0 for no limit
+    #   self.max_bytes: The most bytes kept, or 0 for no limit
+    #   self.entries: An OrderedDict mapping keys to (value, bytes) tuples,
+    #       least recently used first
+    #   self.bytes: The sum of the bytes of every value kept
+    #   self.hits: The number of GETs that found their key
+    #   self.misses: The number of GETs that didn't
+    #   self.evictions: The number of values dropped to stay within limits
+    #   self.invalidations: The number of times CLEAR dropped every value
+
+    def __init__(self, max_entries = 4096, max_bytes = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the value kept for KEY, or DEFAULT if there is none
+    def get(self, key, default = None):
+        found = self.entries.get(key)
+        if found == None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return found[0]
+
+    # Keeps VALUE for KEY, counting it as NUM_BYTES bytes. A value larger
+    # than self.max_bytes on its own is not kept
+    def put(self, key, value, num_bytes = 0):
+        if self.max_bytes > 0 and num_bytes > self.max_bytes:
+            return
+        found = self.entries.pop(key, None)
+        if found != None:
+            self.bytes -= found[1]
+        self.entries[key] = (value, num_bytes)
+        self.bytes += num_bytes
+        while (self.max_entries > 0 and len(self.entries) > self.max_entries) \
+            or (self.max_bytes > 0 and self.bytes > self.max_bytes):
+            key, (value, num_bytes) = self.entries.popitem(last = False)
+            self.bytes -= num_bytes
+            self.evictions += 1
+
+    # Drops every value, such as when the values they were computed from
+    # have changed
+    def clear(self):
+        if len(self.entries) > 0:
+            self.invalidations += 1
+        self.entries.clear()
+        self.bytes = 0
+
+    # Returns a dictionary with the cache's size, limits and counts
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes,
+            'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations}
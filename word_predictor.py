@@ -1,92 +1,634 @@
 from wordprob import WordGenerator
-from nltk.util import ngrams
+from wordprob import WordProb
+from store import Pruning
 from util import Utilities
+from util import Throughput
 from text import TextUtils
-import word_predictor
-import nltk.corpus
+import corpuscache
+import modelfile
+import journal
+import profiler
+import scorers
+from collections import deque
+import multiprocessing
+import itertools
+import functools
 import argparse
 import pickle
 import random
+import heapq
+import math
 import sys
 import os
 
-# the default filename for the ngram hash saved after training
+# the default filename for the model saved after training
+NGRAM_MODEL_NAME = 'ngram_model.bin'
+# the filename older versions pickled the model to. It is converted to
+# NGRAM_MODEL_NAME the first time it is found
 NGRAM_HASH_NAME = 'ngram_hash.pkl'
+# files smaller than this are never split between training processes
+MIN_SHARD_BYTES = 1 << 20
+# the default number of contexts whose next words are cached while
+# predicting
+CACHE_ENTRIES = 4096
+# the default number of continuations kept at each step of BEAM_SEARCH
+BEAM_WIDTH = 5
+# the default exponent of the length normalization of BEAM_SEARCH
+LENGTH_PENALTY = 1.0
+
+# Returns the nltk.corpus package. nltk is only imported when a corpus is
+# trained on, since importing it takes longer than loading a model and
+# generating a sentence
+def nltk_corpus():
+    import nltk.corpus
+    return nltk.corpus
 
 # Trains the word generator on a number of NGRAM sources. The sources can be
-# specified in a list (or any iterable container) using LIST_OF_CORPUS. The type
-# must be of NLTK.CORPUS, and must implement the WORDS() method, which returns
-# an iterable container of words. An existing WordProb object can be passed in
-# using the WORD_GEN parameter
-def train_on_corpus(ngram_size, 
-    list_of_corpus = [nltk.corpus.brown, nltk.corpus.abc], word_gen = None):
-    for i in range(len(list_of_corpus)):
-        words = ' '.join(list_of_corpus[i].words())
-        cleaned_words = TextUtils.normalize_line(words)
-        ngram = ngrams(cleaned_words, ngram_size)
-        if i == 0:
-            word_gen = WordGenerator(ngram)
+# specified in a list (or any iterable container) using LIST_OF_CORPUS, which
+# defaults to the brown and abc corpora. The type must be of NLTK.CORPUS, and
+# must implement the WORDS() method, which returns an iterable container of
+# words. An existing WordProb object can be passed in
+# using the WORD_GEN parameter. Each corpus is streamed, so only a batch of
+# its words is held in memory at a time. If REPORT_PROGRESS is true, the
+# training throughput is logged to stderr as it goes. If PROCESSES is more
+# than 1, the files of each corpus are split between that many processes;
+# the corpora must then come from nltk.corpus. If PRUNING is a Pruning
+# object and PRUNE_EVERY is more than 0, rare observations are dropped every
+# PRUNE_EVERY ngrams to cap memory use. Since counts are not final until
+# training is finished, the result should be compacted afterwards with
+# WordGenerator.prune. If ALL_ORDERS is true, every order from 1 to
+# NGRAM_SIZE is counted exactly in the same pass, as if each had been
+# trained on its own, and any of them can be picked with
+# WordGenerator.set_max_order once the model is loaded. If CACHE_DIR is
+# given, the normalized tokens of each corpus are read from a cache file
+# there, which is written the first time the corpus is read (see
+# corpuscache.py), so later runs skip parsing the corpus. The cache file is
+# found by the sizes and modification times of the corpus's files, or by a
+# hash of their contents if HASH_CORPUS is true
+def train_on_corpus(ngram_size, list_of_corpus = None, word_gen = None,
+    report_progress = False, processes = 1, pruning = None, prune_every = 0,
+    all_orders = False, cache_dir = None, hash_corpus = False):
+    if list_of_corpus == None:
+        list_of_corpus = [nltk_corpus().brown, nltk_corpus().abc]
+    throughput = None
+    if report_progress:
+        throughput = Throughput("training")
+    if processes > 1:
+        shards = []
+        for corpus in list_of_corpus:
+            path = None
+            if cache_dir != None:
+                path = corpuscache.build_cache(corpus,
+                    corpuscache.cache_path(corpus, cache_dir, hash_corpus))
+            if path != None:
+                shards += cache_shards(ngram_size, path, processes)
+            else:
+                shards += corpus_shards(ngram_size, corpus, processes)
+        return merge_into(word_gen, train_on_shards(shards, processes,
+            throughput, pruning, prune_every, all_orders))
+    if word_gen == None:
+        word_gen = WordGenerator([])
+    word_gen.set_pruning(pruning, prune_every)
+    for corpus in list_of_corpus:
+        if cache_dir != None:
+            tokens = corpuscache.read_through(corpus, corpuscache.cache_path(
+                corpus, cache_dir, hash_corpus), throughput)
+        else:
+            tokens = TextUtils.iter_word_tokens(corpus.words(),
+                throughput = throughput)
+        if all_orders:
+            word_gen.word_probs.add_token_observations(tokens, ngram_size)
         else:
-            word_gen.add_list_of_ngrams(ngram)
+            word_gen.word_probs.add_ngram_observations(
+                TextUtils.iter_ngrams(tokens, ngram_size))
+        if throughput != None:
+            throughput.next_source()
+    if throughput != None:
+        throughput.log()
+    word_gen.freeze()
     return word_gen
     
 # Trains the word generator on a number of plain text sources. The sources can
 # be specified in a list (or any iterable container) using LIST_OF_CORPUS. An 
-# existing WordProb object can be passed in using the WORD_GEN parameter
-def train_on_plain_text(ngram_size, list_of_files, word_gen = None):
-    word_gen = None
+# existing WordProb object can be passed in using the WORD_GEN parameter. Each
+# file is streamed in chunks, so files larger than memory can be used. If
+# REPORT_PROGRESS is true, the training throughput is logged to stderr as it
+# goes. If PROCESSES is more than 1, the files are split into byte ranges
+# which are trained on by that many processes. PRUNING, PRUNE_EVERY and
+# ALL_ORDERS are the same as for TRAIN_ON_CORPUS
+def train_on_plain_text(ngram_size, list_of_files, word_gen = None,
+    report_progress = False, processes = 1, pruning = None, prune_every = 0,
+    all_orders = False):
+    throughput = None
+    if report_progress:
+        throughput = Throughput("training")
+    if processes > 1:
+        shards = []
+        for file in list_of_files:
+            shards += file_shards(ngram_size, file, processes)
+        return merge_into(word_gen, train_on_shards(shards, processes,
+            throughput, pruning, prune_every, all_orders))
+    if word_gen == None:
+        word_gen = WordGenerator([])
+    word_gen.set_pruning(pruning, prune_every)
     for file in list_of_files:
-        ng = TextUtils.file_to_ngram(file, ngram_size)
-        if ng == None:
+        if Utilities.is_file(file) == False:
             sys.exit("Fatal Error: file '%s' cannot be opened" % file)
+        if all_orders:
+            word_gen.word_probs.add_token_observations(
+                TextUtils.iter_file_tokens(file, throughput = throughput),
+                ngram_size)
+        else:
+            word_gen.word_probs.add_ngram_observations(
+                TextUtils.file_to_ngram(file, ngram_size, throughput))
+        if throughput != None:
+            throughput.next_source()
+    if throughput != None:
+        throughput.log()
+    word_gen.freeze()
+    return word_gen
+
+# Returns TRAINED, a WordGenerator, merged into WORD_GEN, or TRAINED itself
+# if WORD_GEN is None
+def merge_into(word_gen, trained):
+    if word_gen == None:
+        return trained
+    word_gen.merge(trained)
+    return word_gen
+
+# Splits the plain text file FILE into at most PROCESSES shards for
+# TRAIN_ON_SHARDS. Each shard is a tuple ('file', NGRAM_SIZE, FILE, start,
+# end), where start and end are byte offsets at the start of a line
+def file_shards(ngram_size, file, processes):
+    if Utilities.is_file(file) == False:
+        sys.exit("Fatal Error: file '%s' cannot be opened" % file)
+    num_parts = min(processes, os.path.getsize(file) // MIN_SHARD_BYTES + 1)
+    return [('file', ngram_size, file, start, end)
+        for start, end in TextUtils.split_file(file, num_parts)]
+
+# Splits the files of CORPUS, a corpus from nltk.corpus, into at most
+# PROCESSES shards for TRAIN_ON_SHARDS. Each shard is a tuple ('corpus',
+# NGRAM_SIZE, corpus name, fileids, fileids of the rest of the corpus)
+def corpus_shards(ngram_size, corpus, processes):
+    name = getattr(corpus, '__name__', None)
+    if name == None or getattr(nltk_corpus(), name, None) is not corpus:
+        sys.exit("Fatal Error: only corpora from nltk.corpus can be trained \
+            on by several processes")
+    fileids = corpus.fileids()
+    num_parts = min(processes, len(fileids))
+    shards = []
+    for i in range(num_parts):
+        start = len(fileids) * i // num_parts
+        end = len(fileids) * (i + 1) // num_parts
+        shards.append(('corpus', ngram_size, name, fileids[start:end],
+            fileids[end:]))
+    return shards
+
+# Splits the tokens of the corpus cache file PATH into at most PROCESSES
+# shards for TRAIN_ON_SHARDS. Each shard is a tuple ('tokens', NGRAM_SIZE,
+# PATH, start, end), where start and end are token positions
+def cache_shards(ngram_size, path, processes):
+    num_tokens = corpuscache.num_tokens(path)
+    num_parts = min(processes, num_tokens * 4 // MIN_SHARD_BYTES + 1)
+    return [('tokens', ngram_size, path, num_tokens * i // num_parts,
+        num_tokens * (i + 1) // num_parts) for i in range(num_parts)]
+
+# Trains a WordProb on a single shard made by FILE_SHARDS, CORPUS_SHARDS or
+# CACHE_SHARDS.
+# The shard's own tokens are followed by the first NGRAM_SIZE - 1 tokens of
+# the rest of its source, so that the ngrams that start in this shard and
+# end in the next one are counted here, exactly once. With ALL_ORDERS, the
+# first NGRAM_SIZE - 1 tokens of every shard but the first of a source are
+# only used as context instead, since the shard before counts them.
+# PRUNING, PRUNE_EVERY and ALL_ORDERS are the same as for TRAIN_ON_CORPUS.
+# Returns a tuple (WordProb, number of tokens, number of bytes)
+def train_shard(shard, pruning = None, prune_every = 0, all_orders = False):
+    kind, ngram_size = shard[0:2]
+    counter = Throughput(kind, interval = float('inf'))
+    if kind == 'file':
+        file, start, end = shard[2:]
+        first = start == 0
+        tokens = TextUtils.iter_file_range_tokens(file, start, end,
+            throughput = counter)
+        following = TextUtils.iter_file_range_tokens(file, end, None)
+    elif kind == 'tokens':
+        path, start, end = shard[2:]
+        first = start == 0
+        tokens = corpuscache.iter_cached_tokens(path, start, end,
+            throughput = counter)
+        following = corpuscache.iter_cached_tokens(path, end)
+    else:
+        name, fileids, following_fileids = shard[2:]
+        corpus = getattr(nltk_corpus(), name)
+        first = fileids[0:1] == corpus.fileids()[0:1]
+        tokens = TextUtils.iter_word_tokens(corpus.words(fileids),
+            throughput = counter)
+        following = iter(())
+        if len(following_fileids) > 0:
+            following = TextUtils.iter_word_tokens(
+                corpus.words(following_fileids))
+
+    tokens = itertools.chain(tokens,
+        itertools.islice(following, ngram_size - 1))
+    word_probs = WordProb()
+    word_probs.set_pruning(pruning, prune_every)
+    if all_orders:
+        skip = 0
+        if not first:
+            skip = ngram_size - 1
+        word_probs.add_token_observations(tokens, ngram_size, skip)
+    else:
+        word_probs.add_ngram_observations(TextUtils.iter_ngrams(tokens,
+            ngram_size))
+    word_probs.freeze()
+    return (word_probs, counter.tokens, counter.bytes)
+
+# Trains a WordGenerator on SHARDS, a list made by FILE_SHARDS,
+# CORPUS_SHARDS or CACHE_SHARDS, using a pool of PROCESSES worker processes.
+# The shards are merged in order as they finish, so the result is identical
+# to training on the same sources one after another. An optional THROUGHPUT
+# object is updated as shards are merged. PRUNING, PRUNE_EVERY and
+# ALL_ORDERS are the same as for TRAIN_ON_CORPUS
+def train_on_shards(shards, processes, throughput = None, pruning = None,
+    prune_every = 0, all_orders = False):
+    word_gen = None
+    train = functools.partial(train_shard, pruning = pruning,
+        prune_every = prune_every, all_orders = all_orders)
+    with multiprocessing.Pool(processes) as pool:
+        for word_probs, num_tokens, num_bytes in pool.imap(train, shards):
+            shard_gen = WordGenerator.from_word_probs(word_probs)
+            if word_gen == None:
+                word_gen = shard_gen
+            else:
+                word_gen.merge(shard_gen)
+            if throughput != None:
+                throughput.update(num_tokens, num_bytes)
+                throughput.next_source()
+    if throughput != None:
+        throughput.log()
+    word_gen.set_pruning(pruning, prune_every)
+    return word_gen
+
+# Returns a dictionary describing how well WORD_GEN covers NG, an iterable of
+# ngrams held out from training. For each ngram, its first words are looked
+# up as a context: 'context_hits' is the fraction found without backing off
+# to fewer words, and 'word_hits' is the fraction whose last word is among
+# the successors of the longest context that was found. 'lookups' is the
+# number of ngrams
+def lookup_hits(word_gen, ng):
+    word_probs = word_gen.word_probs
+    lookups = 0
+    context_hits = 0
+    word_hits = 0
+    for ng_tuple in ng:
+        lookups += 1
+        context = list(ng_tuple[0:-1])
+        if word_probs.find_context(context) != None:
+            context_hits += 1
+        found = word_gen.find_context(context)
+        word_id = word_probs.vocab.get_id(ng_tuple[-1])
+        if found != None and word_id != None:
+            start, end, total = found
+            successors = word_probs.store.successors
+            if any(successors[i] == word_id for i in range(start, end)):
+                word_hits += 1
+    lookups_seen = max(lookups, 1)
+    return {'lookups': lookups, 'context_hits': context_hits / lookups_seen,
+        'word_hits': word_hits / lookups_seen}
+
+# Prunes WORD_GEN with PRUNING and logs its size before and after. If
+# TEST_FILES is a list of plain text files, the LOOKUP_HITS of their ngrams,
+# as long as the ones WORD_GEN was trained on, are logged before and after
+# too. Returns a list of the WordProb.size dictionaries before and after
+def prune_with_report(word_gen, pruning, test_files = None):
+    ngram_size = word_gen.max_context_length() + 1
+    reports = []
+    for stage in ('before', 'after'):
+        if stage == 'after':
+            word_gen.prune(pruning)
+        report = word_gen.word_probs.size()
+        for file in test_files or []:
+            ng = TextUtils.file_to_ngram(file, ngram_size)
+            if ng == None:
+                sys.exit("Fatal Error: file '%s' cannot be opened" % file)
+            hits = lookup_hits(word_gen, ng)
+            Utilities.log("Pruning %s: %d lookups in '%s', %.1f%% contexts "
+                "hit, %.1f%% words hit", (stage, hits['lookups'], file,
+                hits['context_hits'] * 100, hits['word_hits'] * 100),
+                sys.stderr)
+        Utilities.log("Pruning %s: %d contexts, %d entries, %.1f MB", (stage,
+            report['contexts'], report['entries'], report['bytes'] / 1e6),
+            sys.stderr)
+        reports.append(report)
+    return reports
+
+# Loads every model in LIST_OF_FILES and merges them into WORD_GEN, or into
+# the first of them if WORD_GEN is None. Returns the merged WordGenerator
+def merge_word_gens(list_of_files, word_gen = None):
+    for filename in list_of_files:
+        other = load_word_gen(filename)
         if word_gen == None:
-            word_gen = WordGenerator(ng)
+            word_gen = other
         else:
-            word_gen.add_list_of_ngrams(ng)
+            word_gen.merge(other)
     return word_gen
 
 # Produces a string prediction based on the provided seed srings. PREDICTOR
 # is a WordProb object trained with any number of ngrams. SEED_STR is a base
 # string for which all other predictions will be based. MAX_PREDICTED_WORDS is
-# a limit for the length of the produced string           
-def predict_words(predictor, seed_str, max_predicted_words):
+# a limit for the length of the produced string. By default one of the most
+# likely next words is picked at each step. If SAMPLING is a dictionary of
+# keyword arguments for WordGenerator.sample_next_words (temperature, top_k,
+# top_p), the next word is instead drawn from all of the likely words. RNG
+# is the random.Random object used for both, or the random module
+def predict_words(predictor, seed_str, max_predicted_words, sampling = None,
+    rng = random):
     # cleans the lines and returns an array of individual words, in order
     # of appearance in string
     cleaned_string = TextUtils.normalize_line(seed_str)
     seed_str = ' '.join(cleaned_string)    
+    predicted = iter_predicted_words(predictor, cleaned_string,
+        max_predicted_words, sampling, rng)
+    return ' '.join([seed_str] + list(predicted))
+
+# Yields up to MAX_PREDICTED_WORDS predicted words, one at a time, following
+# SEED_WORDS, a list of normalized words. Only the last few words can ever
+# match a context of PREDICTOR, so only that many are kept, and each word
+# costs the same no matter how many have been generated before it. SAMPLING
+# and RNG are the same as for PREDICT_WORDS
+def iter_predicted_words(predictor, seed_words, max_predicted_words,
+    sampling = None, rng = random):
+    window = deque(seed_words, maxlen = max(predictor.max_context_length(), 1))
     for i in range(max_predicted_words):
-        # gets only the best matches because NUM_TO_MATCH is 1. See comments
-        # of WordProb.get_next_word
-        seeds = TextUtils.normalize_line(seed_str)
-        candidates = predictor.get_next_words(seeds, num_to_return = 1)
-        if candidates == None:
+        next_words = next_word_batch(predictor, list(window), 1, sampling, rng)
+        if next_words == None:
             break
-        # now, get a random best choice word
-        word_prob_pair = random.choice(candidates)
-        next_word = word_prob_pair[0]
-        seed_str += ' '
-        seed_str += next_word
-    return seed_str
-
-# Saves a WordGenerator object to the given file
+        next_word = next_words[0]
+        yield next_word
+        # plain text training marks line ends with a ' ' token, which is
+        # never part of a seed once it has been normalized
+        if not next_word.isspace():
+            window.append(next_word)
+
+# Returns a list of NUM_WORDS words picked independently to follow WORDS,
+# or None if PREDICTOR has no match for WORDS. SAMPLING and RNG are the same
+# as for PREDICT_WORDS
+def next_word_batch(predictor, words, num_words, sampling, rng):
+    if sampling != None:
+        return predictor.sample_next_words(words, num_words, rng, **sampling)
+    # gets only the best matches because NUM_TO_MATCH is 1. See comments
+    # of WordProb.get_next_word
+    candidates = predictor.get_next_words(words, num_to_return = 1)
+    if candidates == None:
+        return None
+    # now, get random best choice words. A single word is picked with
+    # choice(), which is what seeded callers have always relied on
+    if num_words == 1:
+        return [rng.choice(candidates)[0]]
+    return [word_prob_pair[0]
+        for word_prob_pair in rng.choices(candidates, k = num_words)]
+
+# Produces a prediction for every seed string in the list SEEDS, the same way
+# PREDICT_WORDS does for one. All of the predictions are advanced together,
+# one word per step, and the seeds whose recent words are the same share a
+# single lookup in PREDICTOR per step, with their next words drawn in one
+# batch. SAMPLING and RNG are the same as for PREDICT_WORDS. Returns a list
+# of strings, in the order of SEEDS
+def predict_many(predictor, seeds, max_predicted_words, sampling = None,
+    rng = random):
+    window_size = max(predictor.max_context_length(), 1)
+    cleaned = TextUtils.normalize_lines(seeds)
+    windows = [deque(words, maxlen = window_size) for words in cleaned]
+    predicted = [[] for words in cleaned]
+
+    active = range(len(cleaned))
+    for i in range(max_predicted_words):
+        groups = dict()
+        for seq in active:
+            context = tuple(windows[seq])
+            if context in groups:
+                groups[context].append(seq)
+            else:
+                groups[context] = [seq]
+
+        active = []
+        for context, members in groups.items():
+            next_words = next_word_batch(predictor, list(context),
+                len(members), sampling, rng)
+            if next_words == None:
+                continue
+            for seq, next_word in zip(members, next_words):
+                predicted[seq].append(next_word)
+                if not next_word.isspace():
+                    windows[seq].append(next_word)
+                active.append(seq)
+        if len(active) == 0:
+            break
+
+    return [' '.join([' '.join(cleaned[seq])] + predicted[seq])
+        for seq in range(len(cleaned))]
+
+# Returns the NUM_RESULTS most probable continuations of the seed string
+# SEED_STR, of up to MAX_PREDICTED_WORDS words each, found by a beam search
+# over PREDICTOR: at each step, every one of the BEAM_WIDTH best
+# continuations so far is extended by each of its BEAM_WIDTH most likely
+# next words (see WordGenerator.get_top_words), and only the BEAM_WIDTH best
+# of those are kept, on a heap. A continuation ends early when it has no
+# next word or predicts the end of a line. NUM_RESULTS defaults to
+# BEAM_WIDTH.
+#
+# Continuations are ranked by their log probability divided by their length
+# to the power LENGTH_PENALTY, so that longer ones aren't ranked lower just
+# for being longer: 0 ranks by the log probability alone and 1 by the mean
+# log probability per word. Returns a list of (string, log probability)
+# tuples, best first, where the string is the seed followed by the
+# continuation as PREDICT_WORDS returns it and the log probability is in
+# bits (log base 2). With a scorer, the log probability is of its scores
+def beam_search(predictor, seed_str, max_predicted_words,
+    beam_width = BEAM_WIDTH, num_results = None,
+    length_penalty = LENGTH_PENALTY):
+    if num_results == None:
+        num_results = beam_width
+    seed_words = tuple(TextUtils.normalize_line(seed_str))
+    window_size = max(predictor.max_context_length(), 1)
+    log2 = math.log2
+    # live continuations are (log probability, words) tuples, and ended
+    # ones (log probability, words, number of words predicted)
+    beams = [(0.0, ())]
+    ended = []
+    for i in range(max_predicted_words):
+        heap = []
+        for log_prob, words in beams:
+            context = (seed_words + words)[-window_size:]
+            candidates = predictor.get_top_words(list(context), beam_width)
+            if candidates == None:
+                ended.append((log_prob, words, len(words)))
+                continue
+            for word, probability in candidates:
+                if probability <= 0:
+                    continue
+                extended = log_prob + log2(probability)
+                if word.isspace():
+                    ended.append((extended, words, len(words) + 1))
+                    continue
+                if len(heap) < beam_width:
+                    heapq.heappush(heap, (extended, words + (word,)))
+                    continue
+                if extended < heap[0][0]:
+                    continue
+                entry = (extended, words + (word,))
+                if entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        beams = heap
+        if len(beams) == 0:
+            break
+    ended += [(log_prob, words, len(words)) for log_prob, words in beams]
+
+    def normalized(entry):
+        log_prob, words, length = entry
+        return log_prob / max(length, 1) ** length_penalty
+    best = heapq.nlargest(num_results, ended, key=normalized)
+    return [(' '.join(seed_words + words), log_prob)
+        for log_prob, words, length in best]
+
+# Returns a list of (word, probability) tuples for the NUM_TO_RETURN most
+# likely completions of the last word of TEXT, a string being typed, by
+# PREDICTOR, or None if there are none. If TEXT ends in the middle of a word
+# that word is completed, as WordGenerator.get_completions does, and
+# otherwise the next word is predicted the same way
+def complete_word(predictor, text, num_to_return = 1):
+    words = TextUtils.normalize_line(text)
+    prefix = ''
+    if len(words) > 0 and text[-1].isalpha():
+        prefix = words.pop()
+    return predictor.get_completions(words, prefix, num_to_return)
+
+# Reads seed strings, one per line, from the file object SEED_FILE and
+# writes one prediction per line to OUT_FILE, in the same order. Seeds are
+# predicted in batches of BATCH_SIZE with PREDICT_MANY. SAMPLING and RNG are
+# the same as for PREDICT_WORDS
+def predict_file(predictor, seed_file, out_file, max_predicted_words,
+    sampling = None, rng = random, batch_size = 1024):
+    batch = []
+    for line in seed_file:
+        batch.append(line)
+        if len(batch) == batch_size:
+            for generated in predict_many(predictor, batch,
+                max_predicted_words, sampling, rng):
+                out_file.write(generated + '\n')
+            batch = []
+    if len(batch) > 0:
+        for generated in predict_many(predictor, batch, max_predicted_words,
+            sampling, rng):
+            out_file.write(generated + '\n')
+    out_file.flush()
+
+# Saves a WordGenerator object to the given file, in the binary format
+# described in modelfile.py. The file's journal, if it has one, is replaced
+# too, since the saved model is the whole model (see journal.py)
 def save_word_gen(filename, word_gen):
     try:
-        file = open(filename, 'wb')
-    except:
-        sys.exit("Fatal Error: cannot open file '%s' to save word hash")
-    pickle.dump(word_gen, file)
+        journal.save_word_probs(filename, word_gen.word_probs)
+    except IOError:
+        sys.exit("Fatal Error: cannot open file '%s' to save word hash"
+            % filename)
 
-# Loads a WordGenerator object to the given file
+# Loads a WordGenerator object from the given file. Binary model files are
+# memory mapped, so this returns almost immediately and the model is read
+# from disk as it is used, unless its journal has segments that still have
+# to be merged into it. Pickled models written by older versions are still
+# accepted and converted in memory
 def load_word_gen(filename):
     if Utilities.is_file(filename) == False:
         sys.exit("Fatal Error: no word hash found for file '%s'. Please \
             re-train the model and try again" % filename)
+    if not modelfile.is_model_file(filename):
+        return import_pickled_word_gen(filename)
+    try:
+        word_probs, position = journal.load_word_probs(filename)
+    except (IOError, ValueError) as e:
+        sys.exit("Fatal Error: cannot read word hash '%s': %s" % (filename, e))
+    return WordGenerator.from_word_probs(word_probs)
+
+# Trains a WordGenerator on the plain text files LIST_OF_FILES and appends
+# its counts to the journal of the model file FILENAME, which must exist,
+# rather than rewriting the model. NGRAM_SIZE defaults to the size of the
+# model's longest ngrams, and if the model was trained with every order, so
+# is the new text. Once the journal has COMPACT_AFTER segments, it is
+# compacted into the model by a background process, unless COMPACT_AFTER is
+# 0. REPORT_PROGRESS and PROCESSES are the same as for TRAIN_ON_PLAIN_TEXT.
+# Returns the segment's number
+def append_to_model(filename, list_of_files, ngram_size = None,
+    report_progress = False, processes = 1,
+    compact_after = journal.COMPACT_SEGMENTS):
+    if not modelfile.is_model_file(filename):
+        sys.exit("Fatal Error: no model found in '%s' to append to"
+            % filename)
+    try:
+        model = journal.read_word_probs(filename)[0]
+    except ValueError as e:
+        sys.exit("Fatal Error: cannot append to '%s': %s" % (filename, e))
+    if ngram_size == None:
+        ngram_size = model.max_context_length() + 1
+    delta = train_on_plain_text(ngram_size, list_of_files, None,
+        report_progress, processes, all_orders = 0 in model.store.contexts)
+    try:
+        number = journal.append_segment(filename, delta.word_probs)
+    except IOError as e:
+        sys.exit("Fatal Error: cannot append to '%s': %s" % (filename, e))
+    size = delta.word_probs.size()
+    Utilities.log("Appended %d contexts to '%s' as journal segment %d",
+        (size['contexts'], filename, number), sys.stderr)
+    if compact_after > 0 and \
+        len(journal.list_segments(filename)) >= compact_after:
+        Utilities.log("Compacting the journal of '%s' in the background",
+            (filename), sys.stderr)
+        journal.compact_in_background(filename)
+    return number
+
+# Loads a WordGenerator pickled by an older version of this tool, where
+# contexts were strings of words joined with '_', and converts it to the
+# current representation. The old contexts were the prefixes of each ngram
+# rather than its suffixes, so the shorter ones can't be used as they are:
+# only the longest contexts hold the counts of whole ngrams, and those
+# ngrams are counted again the way WordProb.add_ngram_observations does
+def import_pickled_word_gen(filename):
     try:
         file = open(filename, 'rb')
     except:
         sys.exit("Fatal Error: cannot open word hash '%s' for \
             reading" % filename)
-    return pickle.load(file)
+    with file:
+        legacy = pickle.load(file)
+    master = legacy.word_probs.__dict__.get('master')
+    if master == None:
+        return legacy
+
+    contexts = [(tuple(key.split('_')), ngram_prob) for key, ngram_prob in
+        master.items()]
+    longest = max([len(context) for context, ngram_prob in contexts],
+        default = 0)
+    word_gen = WordGenerator([])
+    for context, ngram_prob in contexts:
+        if len(context) == longest:
+            word_gen.word_probs.add_ngram_observations(
+                itertools.chain.from_iterable(itertools.repeat(
+                context + (word,), count) for word, count
+                in ngram_prob.seen_next_words.items()))
+    word_gen.freeze()
+    return word_gen
+
+# Loads the model saved in FILENAME by the last training run. If FILENAME is
+# NGRAM_MODEL_NAME and only a model pickled by an older version exists, it
+# is converted and saved as NGRAM_MODEL_NAME first
+def load_default_word_gen(filename):
+    if filename == NGRAM_MODEL_NAME and \
+        Utilities.is_file(NGRAM_MODEL_NAME) == False and \
+        Utilities.is_file(NGRAM_HASH_NAME) == True:
+        Utilities.log("Converting '%s' to '%s'", (NGRAM_HASH_NAME,
+            NGRAM_MODEL_NAME), sys.stderr)
+        save_word_gen(NGRAM_MODEL_NAME, load_word_gen(NGRAM_HASH_NAME))
+    return load_word_gen(filename)
     
 # Deletes a WordGenerator object if it exists at the given file
 def del_word_gen(filename):
@@ -94,14 +636,22 @@ def del_word_gen(filename):
         os.remove(filename)
     except OSError:
         pass
+    journal.remove_segments(filename, float('inf'))
+    try:
+        os.rmdir(journal.journal_dir(filename))
+    except OSError:
+        pass
 
 # The main entry point for the word_predictor utility. The tool has a few major
 # functionalities, all related to sentence generation using an ngram model.
 # Specifically, the tool can:
-#   1. Save, load, and delete training datasets into a pickled format
+#   1. Save, load, and delete training datasets in a memory mapped binary
+#       format
 #   2. Retrain on new data, specified by a plain text source file or a corpus
-#       from the nltk.corpus package, with parameterized ngram size
+#       from the nltk.corpus package, with parameterized ngram size, or append
+#       new plain text to a trained model without rewriting it
 #   3. Generate a sentence given a seed string, allowing for length limiting
+#   4. Generate sentences for a file of seed strings, one per line
 #
 # Usage details can be displayed by using the -h or --help flags
 if __name__ == "__main__":
@@ -115,13 +665,185 @@ if __name__ == "__main__":
     parser.add_argument("-rf", "--retrain_file", 
                     help="retrain using a specified text file",
                     action="append")
+    parser.add_argument("--corpus_cache",
+                    default = corpuscache.CACHE_DIR,
+                    help="with --retrain_nltk, the directory the normalized "
+                        "tokens of each corpus are cached in (default = "
+                        "~/.cache/word_predictor)",
+                    action="store")
+    parser.add_argument("--hash_corpus",
+                    help="with --retrain_nltk, find a corpus's cached "
+                        "tokens by a hash of its files' contents rather "
+                        "than their sizes and modification times",
+                    action="store_true")
+    parser.add_argument("--no_corpus_cache",
+                    help="with --retrain_nltk, read every corpus through "
+                        "nltk without caching its tokens",
+                    action="store_true")
+    parser.add_argument("-a", "--append",
+                    help="add the counts of a text file to the model's "
+                        "journal instead of retraining",
+                    action="append")
+    parser.add_argument("--compact",
+                    help="fold the model's journal into the model file",
+                    action="store_true")
+    parser.add_argument("--compact_after",
+                    type = int,
+                    default = journal.COMPACT_SEGMENTS,
+                    help="with --append, compact in the background once the "
+                        "journal has this many segments, 0 to never "
+                        "(default = %d)" % journal.COMPACT_SEGMENTS,
+                    action="store")
+    parser.add_argument("--progress",
+                    help="log training throughput to stderr while retraining",
+                    action="store_true")
+    parser.add_argument("-j", "--processes",
+                    type = int,
+                    default = 1,
+                    help="number of processes used for retraining "
+                        "(default = 1)",
+                    action="store")
+    parser.add_argument("--merge",
+                    help="merge a saved model into the retrained model, or "
+                        "into the current model if not retraining",
+                    action="append")
+    parser.add_argument("--min_count",
+                    type = int,
+                    default = 1,
+                    help="prune words seen fewer than this many times after "
+                        "a context (default = 1, keep all)",
+                    action="store")
+    parser.add_argument("--min_context_total",
+                    type = int,
+                    default = 1,
+                    help="prune contexts seen fewer than this many times "
+                        "(default = 1, keep all)",
+                    action="store")
+    parser.add_argument("--max_successors",
+                    type = int,
+                    default = 0,
+                    help="keep only this many of the most likely words after "
+                        "each context (default = 0, keep all)",
+                    action="store")
+    parser.add_argument("--prune_every",
+                    type = int,
+                    default = 0,
+                    help="while retraining, also prune after every this many "
+                        "ngrams to cap memory use (default = 0, only prune "
+                        "at the end)",
+                    action="store")
+    parser.add_argument("--prune_test",
+                    help="report how many lookups of the ngrams in a text "
+                        "file still hit after pruning",
+                    action="append")
+    parser.add_argument("-m", "--model",
+                    default = NGRAM_MODEL_NAME,
+                    help="the model file to save to and load from "
+                        "(default = %s)" % NGRAM_MODEL_NAME,
+                    action="store")
     parser.add_argument("-n", "--ngram_size",
                     type = int,
                     help="specify the size of the ngrams used for training",
                     action="store")
+    parser.add_argument("--all_orders",
+                    help="while retraining, count every order from 1 to "
+                        "--ngram_size in the same pass, so that any of them "
+                        "can be picked with --max_order",
+                    action="store_true")
+    parser.add_argument("--max_order",
+                    type = int,
+                    default = 0,
+                    help="predict with ngrams of at most this size, matching "
+                        "at most this many words minus 1 (default = 0, the "
+                        "model's largest)",
+                    action="store")
     parser.add_argument("-s", "--seed_string", 
                     help="predict words starting with a seed string",
                     action="store")
+    parser.add_argument("-sf", "--seed_file",
+                    help="predict words for every seed string in a file, "
+                        "one per line ('-' reads from stdin)",
+                    action="store")
+    parser.add_argument("--sample",
+                    help="draw each predicted word at random from all likely "
+                        "words, instead of picking one of the most likely",
+                    action="store_true")
+    parser.add_argument("-t", "--temperature",
+                    type = float,
+                    default = 1.0,
+                    help="with --sample, flatten (> 1) or sharpen (< 1) the "
+                        "word probabilities (default = 1.0)",
+                    action="store")
+    parser.add_argument("--top_k",
+                    type = int,
+                    default = 0,
+                    help="with --sample, only draw from the K most likely "
+                        "words (default = 0, no limit)",
+                    action="store")
+    parser.add_argument("--top_p",
+                    type = float,
+                    default = 1.0,
+                    help="with --sample, only draw from the most likely words "
+                        "covering P of the probability (default = 1.0)",
+                    action="store")
+    parser.add_argument("--beam_width",
+                    type = int,
+                    default = 0,
+                    help="find the most probable continuations with a beam "
+                        "search keeping this many at each step, and print "
+                        "them with their log probabilities in bits, best "
+                        "first (default = 0, predict word by word)",
+                    action="store")
+    parser.add_argument("--length_penalty",
+                    type = float,
+                    default = LENGTH_PENALTY,
+                    help="with --beam_width, rank continuations by their log "
+                        "probability over their length to this power, 0 to "
+                        "favor short ones (default = %g)" % LENGTH_PENALTY,
+                    action="store")
+    parser.add_argument("--complete",
+                    type = int,
+                    default = 0,
+                    help="print this many of the most likely completions of "
+                        "the last, partly typed, word of the seed string with "
+                        "their probabilities (default = 0, predict words)",
+                    action="store")
+    parser.add_argument("--scorer",
+                    default = 'mle',
+                    choices = ['mle'] + sorted(scorers.SCORERS.keys()),
+                    help="how to rank predicted words: by the counts of the "
+                        "longest matching context, or smoothed over shorter "
+                        "contexts too (default = mle)",
+                    action="store")
+    parser.add_argument("--cache_entries",
+                    type = int,
+                    default = CACHE_ENTRIES,
+                    help="the number of contexts whose next words are cached "
+                        "while predicting, 0 for no limit if --cache_bytes is "
+                        "given or no cache otherwise (default = %d)"
+                        % CACHE_ENTRIES,
+                    action="store")
+    parser.add_argument("--cache_bytes",
+                    type = int,
+                    default = 0,
+                    help="the most bytes of next words cached while "
+                        "predicting, 0 for no limit (default = 0)",
+                    action="store")
+    parser.add_argument("--random_seed",
+                    type = int,
+                    help="seed the random choices, for repeatable output",
+                    action="store")
+    parser.add_argument("--profile",
+                    metavar = "FILE",
+                    help="run under cProfile and dump its stats to FILE, and "
+                        "log the time spent in each stage",
+                    action="store")
+    parser.add_argument("--profile_stacks",
+                    metavar = "FILE",
+                    help="sample the stack every millisecond and write "
+                        "collapsed stacks for flame graphs to FILE, and log "
+                        "the time spent in each stage",
+                    action="store")
     parser.add_argument("-l", "--limit_length",
                     type = int,
                     default = 20,
@@ -132,45 +854,153 @@ if __name__ == "__main__":
     if not len(sys.argv) > 1:
         parser.print_help()
         sys.exit()
+    if args.profile != None or args.profile_stacks != None:
+        profiler.profile_until_exit({'word_predictor': sys.modules[__name__]},
+            args.profile, args.profile_stacks)
 
     if (args.ngram_size != None) and (args.retrain_nltk == None) \
+        and (args.retrain_file == None) and (args.append == None):
+        parser.error('--retrain_nltk, --retrain_file or --append required \
+            when --ngram_size specified')
+    if args.all_orders and (args.retrain_nltk == None) \
         and (args.retrain_file == None):
-        parser.error('--retrain_nltk or --retrain_file required when \
-            --ngram_size specified')
+        parser.error('--retrain_nltk or --retrain_file required when '
+            '--all_orders specified')
+    if args.append and (args.retrain_nltk or args.retrain_file or
+        args.merge or args.delete_training_set):
+        parser.error('--append cannot be combined with retraining, merging '
+            'or deleting the model')
+    if args.append != None:
+        append_to_model(args.model, args.append, args.ngram_size,
+            args.progress, args.processes, args.compact_after)
+    if args.compact:
+        try:
+            folded = journal.compact(args.model)
+        except (IOError, ValueError) as e:
+            sys.exit("Fatal Error: cannot compact '%s': %s" % (args.model, e))
+        if folded == None:
+            sys.exit("Fatal Error: '%s' is already being compacted"
+                % args.model)
+        Utilities.log("Compacted %d journal segments into '%s'", (folded,
+            args.model), sys.stderr)
     if args.ngram_size == None:
         args.ngram_size = 3
+    pruning = Pruning(args.min_count, args.min_context_total,
+        args.max_successors)
+    if not pruning.is_enabled():
+        pruning = None
+        if args.prune_every > 0 or args.prune_test:
+            parser.error('--min_count, --min_context_total or '
+                '--max_successors required when pruning')
+    # the final pass is made once training and merging are done, so only
+    # the pruning in flight happens while training
+    in_flight = None
+    if args.prune_every > 0:
+        in_flight = pruning
         
     # delete the model if required
     if args.delete_training_set:
-        del_word_gen(NGRAM_HASH_NAME)
+        del_word_gen(args.model)
+        if args.model == NGRAM_MODEL_NAME:
+            del_word_gen(NGRAM_HASH_NAME)
     
     # retrain the model if necessary
     word_gen = None
     retrained = False
     if args.retrain_file:
         word_gen = train_on_plain_text(args.ngram_size, args.retrain_file, 
-            word_gen)
+            word_gen, args.progress, args.processes, in_flight,
+            args.prune_every, args.all_orders)
         retrained = True
     if args.retrain_nltk:
         corpus_list = []
         for c in args.retrain_nltk:
             try:
-                corp_obj = getattr(nltk.corpus, c)
+                corp_obj = getattr(nltk_corpus(), c)
             except:
                 sys.exit("Fatal Error: corpus '%s' does not exist in \
                     nltk.corpus" % c)
             corpus_list.append(corp_obj)
-        word_gen = train_on_corpus(args.ngram_size, corpus_list, word_gen)
+        cache_dir = args.corpus_cache
+        if args.no_corpus_cache:
+            cache_dir = None
+        word_gen = train_on_corpus(args.ngram_size, corpus_list, word_gen,
+            args.progress, args.processes, in_flight, args.prune_every,
+            args.all_orders, cache_dir, args.hash_corpus)
+        retrained = True
+    if args.merge:
+        if word_gen == None and Utilities.is_file(args.model):
+            word_gen = load_default_word_gen(args.model)
+        word_gen = merge_word_gens(args.merge, word_gen)
+        retrained = True
+    if pruning != None:
+        if word_gen == None:
+            word_gen = load_default_word_gen(args.model)
+        prune_with_report(word_gen, pruning, args.prune_test)
         retrained = True
         
     if retrained == True:
-        save_word_gen(NGRAM_HASH_NAME, word_gen)
+        save_word_gen(args.model, word_gen)
 
     # generate new words if necessary
-    if args.seed_string != None:
+    sampling = None
+    if args.sample:
+        if args.temperature <= 0:
+            parser.error('--temperature must be greater than 0')
+        sampling = {'temperature': args.temperature, 'top_k': args.top_k,
+            'top_p': args.top_p}
+    if args.scorer != 'mle' and sampling != None:
+        parser.error('--scorer cannot be combined with --sample')
+    if args.beam_width < 0:
+        parser.error('--beam_width cannot be negative')
+    if args.beam_width > 0 and sampling != None:
+        parser.error('--beam_width cannot be combined with --sample')
+    if args.beam_width > 0 and args.seed_file != None:
+        parser.error('--beam_width cannot be combined with --seed_file')
+    if args.complete < 0:
+        parser.error('--complete cannot be negative')
+    if args.complete > 0 and (sampling != None or args.beam_width > 0 or
+        args.seed_file != None):
+        parser.error('--complete cannot be combined with --sample, '
+            '--beam_width or --seed_file')
+    if args.seed_string != None or args.seed_file != None:
         if word_gen == None:
-            word_gen = load_word_gen(NGRAM_HASH_NAME)
-        args.seed_string = TextUtils.normalize_line(args.seed_string)
-        args.seed_string = ' '.join(args.seed_string)
-        generated = predict_words(word_gen, args.seed_string, args.limit_length)
-        print(generated)
\ No newline at end of file
+            word_gen = load_default_word_gen(args.model)
+        if args.scorer != 'mle':
+            word_gen.set_scorer(scorers.SCORERS[args.scorer](
+                word_gen.word_probs))
+        word_gen.set_max_order(args.max_order)
+        word_gen.set_cache(args.cache_entries, args.cache_bytes)
+    rng = random
+    if args.random_seed != None:
+        rng = random.Random(args.random_seed)
+    if args.seed_string != None and args.complete > 0:
+        for word, probability in complete_word(word_gen, args.seed_string,
+            args.complete) or []:
+            print("%.4f\t%s" % (probability, word))
+    elif args.seed_string != None and args.beam_width > 0:
+        for text, log_prob in beam_search(word_gen, args.seed_string,
+            args.limit_length, args.beam_width,
+            length_penalty = args.length_penalty):
+            print("%.3f\t%s" % (log_prob, text))
+    elif args.seed_string != None:
+        seed_words = TextUtils.normalize_line(args.seed_string)
+        # words are printed as they are predicted
+        sys.stdout.write(' '.join(seed_words))
+        for word in iter_predicted_words(word_gen, seed_words,
+            args.limit_length, sampling, rng):
+            sys.stdout.write(' ' + word)
+            sys.stdout.flush()
+        sys.stdout.write('\n')
+    if args.seed_file != None:
+        if args.seed_file == '-':
+            predict_file(word_gen, sys.stdin, sys.stdout, args.limit_length,
+                sampling, rng)
+        else:
+            seed_file = Utilities.open_file(args.seed_file)
+            if seed_file == None:
+                sys.exit("Fatal Error: file '%s' cannot be opened"
+                    % args.seed_file)
+            with seed_file:
+                predict_file(word_gen, seed_file, sys.stdout,
+                    args.limit_length, sampling, rng)
\ No newline at end of file
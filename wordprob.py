@@ -1,6 +1,23 @@
 import operator
-import sys
-from nltk.util import ngrams
+from store import Vocabulary
+from store import NgramStore
+from sampling import Sampler
+from completion import PrefixIndex
+from util import LRUCache
+from util import deep_size
+import random
+
+# Returned by LRUCache.get when a key isn't cached, since None is a valid
+# result of a lookup
+MISSING = object()
+
+# The least number of ngrams or tokens a WordProb adds between packing its
+# pending observations into its store, which bounds the memory they use
+# while training. Every packing copies the whole store, so packings are also
+# spaced by as many ngrams or tokens as the store has entries, which keeps
+# the copying in proportion to the input rather than to the input times the
+# number of packings
+FREEZE_EVERY = 1 << 20
 
 
 # Top level handler that uses ngrams to suggest the next likely word in a
@@ -10,24 +27,172 @@ class WordGenerator:
     # Class Members:
     #   self.word_probs: The top level object that manages ngrams and converting
     #       ngram data into probabilities
+    #   self.scorer: A Scorer from scorers.py that ranks next words, or None
+    #       to rank them by the counts of the longest matched context
+    #   self.cache: An LRUCache of the results of GET_NEXT_WORDS, or None if
+    #       results are not cached. See SET_CACHE
+    #   self.cache_store: The store self.cache's results were found in. The
+    #       cache is cleared once self.word_probs has a different store
+    #   self.max_order: The largest order used by lookups, so that at most
+    #       self.max_order - 1 words of context are matched, or 0 for no
+    #       limit. See SET_MAX_ORDER
     
     # Creates a new WordGenerator using a given NG, which is of type 
     # NLTK.UTIL.NGRAMS. While the object is initialized with just one NG, 
     # more can be added later. An optional parameter is INCLUDE_SHORTER_GRAMS,
     # which if true, will include ngrams shorter than the original set of
     # ngrams (i.e., if a 5gram is included, 4gram, 3gram and 2grams will be
-    # saved too)
-    def __init__(self, ng, include_shorter_grams = True):
-        self.word_probs = WordProb()
+    # saved too). WORD_PROBS is the object the counts are kept in, a new
+    # WordProb by default; an ApproxWordProb from sketch.py can be passed
+    # instead to count in fixed memory
+    def __init__(self, ng, include_shorter_grams = True, word_probs = None):
+        if word_probs == None:
+            word_probs = WordProb()
+        self.word_probs = word_probs
+        self.scorer = None
+        self.cache = None
+        self.cache_store = None
+        self.max_order = 0
         self.add_list_of_ngrams(ng, include_shorter_grams)
 
-    # Adds an NG of type NLTK.UTIL.NGRAMS to the list of words in the master
-    # dictionary inside self.word_probs. An optional parameter is 
+    # Creates a WordGenerator around an existing WordProb object, WORD_PROBS,
+    # such as one read from a model file
+    @staticmethod
+    def from_word_probs(word_probs):
+        word_gen = WordGenerator([])
+        word_gen.word_probs = word_probs
+        return word_gen
+
+    # Returns a WordGenerator over the same store for another thread, with
+    # the same settings. It shares this generator's scorer and the word
+    # ranks of its prefix index, which lookups only read, but has its own
+    # WordProb, cache, sampler and context indexes, which lookups change.
+    # This generator must not be added to while the copy is in use
+    def copy(self):
+        word_probs = WordProb()
+        word_probs.vocab = self.word_probs.vocab
+        word_probs.store = self.word_probs.store
+        if self.word_probs.prefix_index != None:
+            word_probs.prefix_index = self.word_probs.prefix_index.copy()
+        word_gen = WordGenerator.from_word_probs(word_probs)
+        word_gen.scorer = self.scorer
+        word_gen.max_order = self.max_order
+        if self.cache != None:
+            word_gen.set_cache(self.cache.max_entries, self.cache.max_bytes)
+        return word_gen
+
+    # Adds an NG of type NLTK.UTIL.NGRAMS to the list of words observed by
+    # self.word_probs. An optional parameter is 
     # INCLUDE_SHORTER_GRAMS, which if true, will include ngrams shorter than the
     # original set of ngrams (i.e., if a 5gram is included, 4gram, 3gram and 
-    # 2grams will be saved too)
+    # 2grams will be saved too). The ngrams are frozen (see FREEZE) so that
+    # lookups see them; to add many batches, add them to self.word_probs
+    # and freeze once at the end instead
     def add_list_of_ngrams(self, ng, include_shorter_grams = True):
         self.word_probs.add_ngram_observations(ng, include_shorter_grams)
+        self.freeze()
+
+    # Adds the iterable TOKENS to the words observed by self.word_probs,
+    # counting every order from 1 to MAX_ORDER. The first SKIP tokens are
+    # only used as context. The tokens are frozen, as with
+    # ADD_LIST_OF_NGRAMS. See WordProb.add_token_observations
+    def add_list_of_tokens(self, tokens, max_order, skip = 0):
+        self.word_probs.add_token_observations(tokens, max_order, skip)
+        self.freeze()
+
+    # Packs every observation seen so far into ranked successor tables.
+    # Lookups only see the observations packed by the last call, and never
+    # pack or sort anything themselves. Adding more ngrams afterwards is
+    # allowed, and only the contexts that changed will be re-ranked when
+    # they are packed again
+    def freeze(self):
+        self.word_probs.freeze()
+        self.prepare_scorer()
+
+    # Rebuilds the scorer's tables if self.word_probs has a new store, so
+    # that lookups never have to. Called after anything that changes it
+    def prepare_scorer(self):
+        if self.scorer != None:
+            self.scorer.prepare()
+
+    # Returns the number of words in the longest context that has been seen,
+    # or that SET_MAX_ORDER allows if fewer. Only that many of the words
+    # passed to GET_NEXT_WORDS can ever match
+    def max_context_length(self):
+        length = self.word_probs.max_context_length()
+        if self.max_order > 0:
+            length = min(length, self.max_order - 1)
+        return length
+
+    # Only uses orders up to MAX_ORDER for lookups from now on, so that at
+    # most MAX_ORDER - 1 of the last words are matched as context, or every
+    # order that has been seen if MAX_ORDER is 0. A model trained with every
+    # order (see WordProb.add_token_observations) then gives the same
+    # results as one trained with ngrams of size MAX_ORDER, so a single
+    # model can serve every order up to the one it was trained with. A
+    # MAX_ORDER of 1 ranks words by their unigram counts alone
+    def set_max_order(self, max_order):
+        self.max_order = max(max_order, 0)
+        if self.scorer != None:
+            self.scorer.set_max_order(self.max_order)
+        if self.cache != None:
+            self.cache.clear()
+
+    # Returns the end of the list of strings WORDS that lookups can match,
+    # which is all of it unless SET_MAX_ORDER has limited the order
+    def cap_words(self, words):
+        if self.max_order < 1 or len(words) < self.max_order:
+            return words
+        return words[len(words) - self.max_order + 1:]
+
+    # Sets the thresholds used to drop rare observations while training. See
+    # WordProb.set_pruning
+    def set_pruning(self, pruning, prune_every = 0):
+        self.word_probs.set_pruning(pruning, prune_every)
+
+    # Drops the rare observations PRUNING says to, or the ones set with
+    # SET_PRUNING if PRUNING is None. See WordProb.prune
+    def prune(self, pruning = None):
+        self.word_probs.prune(pruning)
+        self.prepare_scorer()
+
+    # Ranks next words with SCORER, a Scorer built over self.word_probs, or
+    # by the counts of the longest matched context if SCORER is None. The
+    # scorer is limited to the same orders as this generator, and its tables
+    # are kept up to date by FREEZE, PRUNE and MERGE
+    def set_scorer(self, scorer):
+        self.scorer = scorer
+        if scorer != None:
+            scorer.set_max_order(self.max_order)
+            scorer.prepare()
+        if self.cache != None:
+            self.cache.clear()
+
+    # Caches the results of GET_NEXT_WORDS for the most recently used
+    # contexts, keeping at most MAX_ENTRIES results and at most MAX_BYTES
+    # bytes of them, where 0 means no limit. Caching is turned off if both
+    # are 0. Results are keyed on the words that can match, so seeds that
+    # end the same way share an entry. New observations, merges and pruning
+    # give self.word_probs a new store, which empties the cache on the next
+    # lookup
+    def set_cache(self, max_entries, max_bytes = 0):
+        self.cache = None
+        if max_entries > 0 or max_bytes > 0:
+            self.cache = LRUCache(max_entries, max_bytes)
+
+    # Returns a dictionary with the hits, misses, evictions and size of the
+    # cache, or None if results are not cached
+    def cache_stats(self):
+        if self.cache == None:
+            return None
+        return self.cache.stats()
+
+    # Adds every observation made by OTHER, another WordGenerator, to this
+    # one. The result is the same as if this generator had been trained on
+    # OTHER's ngrams directly
+    def merge(self, other):
+        self.word_probs.merge(other.word_probs)
+        self.prepare_scorer()
     
     # Returns a sorted list of the most likely words that will come after
     # the sequence of of strings in WORDS, according to the NGRAMS added with 
@@ -50,91 +215,420 @@ class WordGenerator:
     #
     #   3. If NUM_TO_RETURN is 1 (default), then only the best matched words
     #       are returned
+    #
+    #   4. If results are cached (see SET_CACHE), the same list is returned
+    #       for the same context, so it must not be changed
     def get_next_words(self, words, min_preceding_match = -1, 
         num_to_return = 1):
         
         if num_to_return < 0:
             num_to_return = 1
+        if self.cache == None:
+            return self.find_next_words(words, min_preceding_match,
+                num_to_return)
 
-        match = False
-        matches = None
-        while (match == False) and (min_preceding_match <= len(words)):
-            matches = self.word_probs.get_word_likelihood(words)
-            if matches != None:
-                match = True
-            else:
-                words = words[1:]
-                if len(words) == 0:
-                    break
-        if matches == None:
+        if self.cache_store is not self.word_probs.store:
+            self.cache.clear()
+            self.cache_store = self.word_probs.store
+        length = self.max_context_length()
+        key = (tuple(words[max(len(words) - length, 0):]),
+            min_preceding_match, num_to_return)
+        found = self.cache.get(key, MISSING)
+        if found is MISSING:
+            found = self.find_next_words(words, min_preceding_match,
+                num_to_return)
+            self.cache.put(key, found, deep_size(key) + deep_size(found))
+        return found
+
+    # Same as GET_NEXT_WORDS, but returns exactly the NUM_TO_RETURN most
+    # likely words, or fewer if there aren't that many, without the words
+    # tied with the last of them. Ties are broken the same way every time.
+    # Without a scorer, this is a slice of the successors of the matched
+    # context, which are stored ranked, so no context costs more than
+    # NUM_TO_RETURN words however many successors it has
+    def get_top_words(self, words, num_to_return, min_preceding_match = -1):
+        if self.scorer != None:
+            found = self.get_next_words(words, min_preceding_match,
+                num_to_return)
+            if found == None:
+                return None
+            return found[0:num_to_return]
+        found = self.find_context(words, min_preceding_match)
+        if found == None:
             return None
+        start, end, total = found
+        return self.word_probs.get_ranked_range(start,
+            min(end, start + num_to_return), total)
 
-        # now, filter out matches and return at least NUM_TO_RETURN elements,
-        # as specified in the comments for this method
-        min_match_set = matches[0:num_to_return]
-        matches = matches[num_to_return:]
-        while len(matches) > 0 and (min_match_set[-1][1] == matches[0][1]):
-            min_match_set.append(matches.pop(0))
-        return min_match_set
+    # Returns a list of (word, probability) tuples for the NUM_TO_RETURN most
+    # likely words starting with the string PREFIX that might come after the
+    # list of strings WORDS, most likely first, or None if there are none.
+    # PREFIX is the start of a word as it is being typed, normalized like
+    # the words of the model (see TextUtils.normalize_line). Words are
+    # ranked by their counts after the longest matching context, as for
+    # GET_TOP_WORDS but without a scorer, and found through
+    # WordProb.get_prefix_index without looking at every successor. If that
+    # context has fewer than NUM_TO_RETURN such words, the rest come from
+    # shorter matching contexts, each with its probability in the context
+    # it came from
+    def get_completions(self, words, prefix, num_to_return = 1,
+        min_preceding_match = -1):
+        word_probs = self.word_probs
+        index = word_probs.get_prefix_index()
+        lo, hi = index.rank_range(prefix)
+        if lo == hi:
+            return None
+        get_word = word_probs.vocab.get_word
+        successors = word_probs.store.successors
+        counts = word_probs.store.counts
+        completions = []
+        seen = set()
+        for start, end, total, k in word_probs.find_suffix_contexts(
+            self.cap_words(words), min_preceding_match):
+            for position in index.complete(start, end, lo, hi,
+                num_to_return):
+                word_id = successors[position]
+                if word_id not in seen:
+                    seen.add(word_id)
+                    completions.append((get_word(word_id),
+                        counts[position] / total))
+            if len(completions) >= num_to_return:
+                break
+        if len(completions) == 0:
+            return None
+        return completions[0:num_to_return]
+
+    # Same as GET_NEXT_WORDS, without the cache
+    def find_next_words(self, words, min_preceding_match, num_to_return):
+        if self.scorer != None:
+            return self.scorer.get_next_words(self.cap_words(words),
+                min_preceding_match, num_to_return)
+
+        found = self.find_context(words, min_preceding_match)
+        if found == None:
+            return None
+        # the ranked tables already group equally likely words together, so
+        # the top NUM_TO_RETURN elements plus ties can be sliced off directly
+        start, end, total = found
+        end = self.word_probs.store.top_end(start, end, num_to_return)
+        return self.word_probs.get_ranked_range(start, end, total)
+
+    # Returns a word drawn at random from the words that might come after
+    # WORDS, matched the same way as GET_NEXT_WORDS, or None if there is no
+    # match. Each word is drawn in proportion to its probability, reshaped by
+    # TEMPERATURE and cut down to the TOP_K most likely words and/or the
+    # most likely words covering TOP_P of the probability. See
+    # Sampler.sample. RNG is a random.Random object, so that a seeded one
+    # gives repeatable results, or the random module
+    def sample_next_word(self, words, rng = random, temperature = 1.0,
+        top_k = 0, top_p = 1.0, min_preceding_match = -1):
+        sampled = self.sample_next_words(words, 1, rng, temperature, top_k,
+            top_p, min_preceding_match)
+        if sampled == None:
+            return None
+        return sampled[0]
+
+    # Same as SAMPLE_NEXT_WORD, but returns a list of NUM_SAMPLES words drawn
+    # independently, looking up WORDS only once
+    def sample_next_words(self, words, num_samples, rng = random,
+        temperature = 1.0, top_k = 0, top_p = 1.0, min_preceding_match = -1):
+        found = self.find_context(words, min_preceding_match)
+        if found == None:
+            return None
+        start, end, total = found
+        sample = self.word_probs.get_sampler().sample
+        successors = self.word_probs.store.successors
+        get_word = self.word_probs.vocab.get_word
+        return [get_word(successors[sample(start, end, rng, temperature, top_k,
+            top_p)]) for i in range(num_samples)]
+
+    # Finds the longest run of words at the end of WORDS that has been seen
+    # as a context, as long as it is at least MIN_PRECEDING_MATCH words and
+    # no longer than SET_MAX_ORDER allows. Returns a tuple (start, end,
+    # total) as WordProb.find_context does, or None if nothing matches
+    def find_context(self, words, min_preceding_match = -1):
+        return self.word_probs.find_longest_context(self.cap_words(words),
+            min_preceding_match)
   
 # Maintains a list of probabilities associated with a set of ngrams.
 class WordProb:
 
     # Class Members:
-    #   self.master: The top-level dictionary that maintains access to the 
-    #       probabilities of each word associated with an ngram. For example,
-    #       if three ngrams are observed that have the first word = 'my' and
-    #       second word is 'name', self.master.get('my_name') gives access to 
-    #       the probabilities of the next word in the sequence    
+    #   self.vocab: A Vocabulary that maps every word seen to an integer id.
+    #       Contexts are tuples of these ids, so a word containing '_' can no
+    #       longer collide with two shorter words. After loading a model file
+    #       this is a read only MappedVocabulary until new words are added
+    #   self.store: An NgramStore holding the packed successor counts of every
+    #       context, as of the last call to FREEZE
+    #   self.pending: Observations added since the last call to FREEZE. Keys
+    #       are tuples of ids, values are dictionaries of {word id: count}.
+    #       They are packed into self.store by FREEZE, and while training
+    #       after every self.freeze_every ngrams. Lookups only read
+    #       self.store, so they don't see pending observations until then
+    #   self.freeze_every: The least number of ngrams or tokens added
+    #       between in-flight packings of self.pending, or 0 to only pack
+    #       when asked. See FREEZE_THRESHOLD
+    #   self.since_freeze: The number of ngrams or tokens added since the
+    #       last packing
+    #   self.sampler: A Sampler for drawing successors from self.store, made
+    #       when it is first needed
+    #   self.prefix_index: A PrefixIndex for completing partial words from
+    #       self.store, made when it is first needed
+    #   self.pruning: A Pruning object applied by PRUNE, or None
+    #   self.prune_every: The number of ngrams added between in-flight
+    #       prunings with self.pruning, or 0 to only prune when asked
+    #   self.since_prune: The number of ngrams added since the last pruning
 
     # Creates a WORDPROB object initialized with an ngram passed in as NG.
     # NG is of type NLTK.UTIL.NGRAMS. NG holds ngrams of size 2 or more
     def __init__(self):
-        self.master = dict()
+        self.vocab = Vocabulary()
+        self.store = NgramStore()
+        self.pending = dict()
+        self.freeze_every = FREEZE_EVERY
+        self.since_freeze = 0
+        self.sampler = None
+        self.prefix_index = None
+        self.pruning = None
+        self.prune_every = 0
+        self.since_prune = 0
+
+    # Sets the Pruning object PRUNING used by PRUNE. If PRUNE_EVERY is more
+    # than 0, ADD_NGRAM_OBSERVATIONS also prunes after every PRUNE_EVERY
+    # ngrams, which caps the memory used while training. Counts dropped in
+    # flight are gone for good, so a successor whose observations are spread
+    # thinly between prunings can be lost even if its final count would have
+    # passed, and PRUNE_EVERY should be large
+    def set_pruning(self, pruning, prune_every = 0):
+        self.pruning = pruning
+        self.prune_every = prune_every
+        self.since_prune = 0
     
     # Convert an ngram into a key and value pair, which is then stored in
-    # the master dictionary. An optional parameter is INCLUDE_SHORTER_GRAMS,
+    # the pending dictionary. An optional parameter is INCLUDE_SHORTER_GRAMS,
     # which if true, will include ngrams shorter than the original set of
     # ngrams (i.e., if a 5gram is included, 4gram, 3gram and 2grams will be
-    # saved too)
+    # saved too). The shorter ngrams end with the same word, so their
+    # contexts are the suffixes of the full context, which are exactly the
+    # contexts that backing off from it looks up
     def add_ngram_observations(self, ng, include_shorter_grams = True):
+        self.vocab = self.vocab.thaw()
+        add = self.vocab.add
+        pending = self.pending
+        freeze_at = self.freeze_threshold()
         for ng_tuple in ng:
+            if self.prune_every > 0:
+                self.since_prune += 1
+                if self.since_prune >= self.prune_every:
+                    self.prune()
+                    pending = self.pending
+                    freeze_at = self.freeze_threshold()
+            if self.freeze_every > 0:
+                self.since_freeze += 1
+                if self.since_freeze >= freeze_at:
+                    self.freeze()
+                    pending = self.pending
+                    freeze_at = self.freeze_threshold()
             num_keys = len(ng_tuple) - 1
             assert(num_keys) >= 1
-            observed_word = ng_tuple[-1]
+            ids = tuple(map(add, ng_tuple))
+            observed_id = ids[-1]
 
-            keys = []
-            append = keys.append
             if include_shorter_grams == True:
-                for i in range(num_keys):
-                    append('_'.join(ng_tuple[0:i + 1]))
+                keys = [ids[i:num_keys] for i in range(num_keys)]
             else:
-                append('_'.join(ng_tuple[0:num_keys]))
-            
+                keys = [ids[0:num_keys]]
+
             for key in keys:
-                try:
-                    self.master[key].add_word_observation(observed_word)
-                except:
-                    self.master[key] = NgramProb(key)
-                    self.master[key].add_word_observation(observed_word)
+                counts = pending.get(key)
+                if counts == None:
+                    counts = dict()
+                    pending[key] = counts
+                counts[observed_id] = counts.get(observed_id, 0) + 1
+
+    # Counts every token in the iterable TOKENS as the successor of each run
+    # of up to MAX_ORDER - 1 tokens before it, including the empty run, whose
+    # successors are the unigram counts. Unlike ADD_NGRAM_OBSERVATIONS, which
+    # only sees the shorter ngrams that end a full length one, this gives
+    # every order from 1 to MAX_ORDER the exact counts it would have if it
+    # had been trained on its own, from one pass over the tokens. The first
+    # SKIP tokens are only used as context, so a stream split into pieces
+    # can be counted exactly once by letting each piece start with the last
+    # MAX_ORDER - 1 tokens of the one before
+    def add_token_observations(self, tokens, max_order, skip = 0):
+        self.vocab = self.vocab.thaw()
+        add = self.vocab.add
+        pending = self.pending
+        freeze_at = self.freeze_threshold()
+        history = ()
+        for position, token in enumerate(tokens):
+            observed_id = add(token)
+            if position >= skip:
+                if self.prune_every > 0:
+                    self.since_prune += 1
+                    if self.since_prune >= self.prune_every:
+                        self.prune()
+                        pending = self.pending
+                        freeze_at = self.freeze_threshold()
+                if self.freeze_every > 0:
+                    self.since_freeze += 1
+                    if self.since_freeze >= freeze_at:
+                        self.freeze()
+                        pending = self.pending
+                        freeze_at = self.freeze_threshold()
+                for i in range(len(history) + 1):
+                    key = history[i:]
+                    counts = pending.get(key)
+                    if counts == None:
+                        counts = dict()
+                        pending[key] = counts
+                    counts[observed_id] = counts.get(observed_id, 0) + 1
+            if max_order > 1:
+                history = (history + (observed_id,))[1 - max_order:]
+
+    # Returns the number of ngrams or tokens to add before packing
+    # self.pending in flight: self.freeze_every, or the number of entries in
+    # self.store if that is more. Each packing copies the store, so this
+    # makes the total copied while training at most about as large as the
+    # input, however many packings there are
+    def freeze_threshold(self):
+        return max(self.freeze_every, self.store.num_entries())
+
+    # Packs every pending observation into self.store
+    def freeze(self):
+        self.since_freeze = 0
+        if len(self.pending) > 0:
+            self.store = self.store.merge(self.pending)
+            self.pending = dict()
+
+    # Packs every pending observation into self.store and drops the ones
+    # PRUNING says to, or self.pruning if PRUNING is None
+    def prune(self, pruning = None):
+        if pruning == None:
+            pruning = self.pruning
+        self.since_prune = 0
+        self.freeze()
+        if pruning != None and pruning.is_enabled():
+            self.store = self.store.prune(pruning)
+
+    # Returns a dictionary with the number of contexts, (context, successor)
+    # entries and bytes in self.store
+    def size(self):
+        return {'contexts': self.store.num_contexts(),
+            'entries': self.store.num_entries(),
+            'bytes': self.store.num_bytes()}
+
+    # Adds every observation made by OTHER, another WordProb, to this one.
+    # OTHER may have its own vocabulary, so its word ids are translated to
+    # ids in self.vocab first. Words new to this WordProb get ids in the
+    # order OTHER first saw them
+    def merge(self, other):
+        other.freeze()
+        self.vocab = self.vocab.thaw()
+        add = self.vocab.add
+        get_word = other.vocab.get_word
+        remap = [add(get_word(i)) for i in range(len(other.vocab))]
+
+        pending = self.pending
+        successors = other.store.successors
+        counts = other.store.counts
+        for context, start, end, total in other.store.iter_contexts():
+            key = tuple([remap[i] for i in context])
+            merged = pending.get(key)
+            if merged == None:
+                merged = dict()
+                pending[key] = merged
+            for pos in range(start, end):
+                word_id = remap[successors[pos]]
+                merged[word_id] = merged.get(word_id, 0) + counts[pos]
+        self.freeze()
+
+    # Returns the number of words in the longest context in self.store
+    def max_context_length(self):
+        return self.store.max_context_length()
+
+    # Returns the Sampler for the current self.store, making a new one if
+    # the store has changed since the last one was made
+    def get_sampler(self):
+        if self.sampler == None or self.sampler.store is not self.store:
+            self.sampler = Sampler(self.store)
+        return self.sampler
+
+    # Returns the PrefixIndex for the current self.store, making a new one if
+    # the store or the vocabulary has changed since the last one was made
+    def get_prefix_index(self):
+        index = self.prefix_index
+        if index == None or index.store is not self.store or \
+            index.vocab is not self.vocab:
+            self.prefix_index = PrefixIndex(self.store, self.vocab)
+        return self.prefix_index
+
+    # Returns a tuple (start, end, total) locating the successors of the
+    # list of strings PRECEDING_WORDS in self.store, or None if the context
+    # has never been seen
+    def find_context(self, preceding_words):
+        if len(preceding_words) == 0:
+            return None
+        context = self.vocab.get_ids(preceding_words)
+        if context == None:
+            return None
+        return self.store.find(context)
+
+    # Returns a tuple (start, end, total) locating the successors of the
+    # longest run of words at the end of the list of strings WORDS that has
+    # been seen as a context, or None if there is none or it is shorter than
+    # MIN_PRECEDING_MATCH words. The store's trie is walked from the last
+    # word backwards, so each word is looked up at most once
+    def find_longest_context(self, words, min_preceding_match = -1):
+        found = self.store.find_suffix(map(self.vocab.get_id,
+            reversed(words)))
+        if found == None or found[3] < min_preceding_match:
+            return None
+        return found[0:3]
+
+    # Same as FIND_LONGEST_CONTEXT, but returns a list of a tuple (start, end,
+    # total, k) for every run of words at the end of WORDS that has been seen
+    # as a context and is at least MIN_PRECEDING_MATCH words, where K is its
+    # length, longest first
+    def find_suffix_contexts(self, words, min_preceding_match = -1):
+        return [found for found in self.store.find_suffixes(
+            map(self.vocab.get_id, reversed(words)))
+            if found[3] >= min_preceding_match]
 
     # Get the likelihood of a particular word given a list of preceding words
-    # in the PRECEDING_WORDS list. Returns None if no key is matched in 
-    # self.master
+    # in the PRECEDING_WORDS list. Returns None if the preceding words have
+    # never been seen together
     def get_word_likelihood(self, preceding_words):
-        key = ""
-        for word in preceding_words:
-            key += word
-            key += '_'
-        key = key[0:-1]
-
-        if key in self.master:
-            return self.master[key].get_sorted_word_likelihood()
-        else:
+        found = self.find_context(preceding_words)
+        if found == None:
             return None
+        start, end, total = found
+        return self.get_ranked_range(start, end, total)
+
+    # Same as GET_WORD_LIKELIHOOD, but only the NUM_TO_RETURN most likely
+    # words are returned, plus any words that are tied with the last of them.
+    # Returns None if the preceding words have never been seen together
+    def get_top_word_likelihood(self, preceding_words, num_to_return):
+        found = self.find_context(preceding_words)
+        if found == None:
+            return None
+        start, end, total = found
+        end = self.store.top_end(start, end, num_to_return)
+        return self.get_ranked_range(start, end, total)
+
+    # Converts positions START to END of self.store into a list of
+    # (word, probability) tuples, where TOTAL is the context's total count
+    def get_ranked_range(self, start, end, total):
+        get_word = self.vocab.get_word
+        successors = self.store.successors
+        counts = self.store.counts
+        return [(get_word(successors[i]), counts[i]/total)
+            for i in range(start, end)]
         
 # Holds information about the count of 'next' words seen after some undefined
-# sequence of words
+# sequence of words. Models are no longer made of these; the class is kept as
+# a plain container so that pickles written by older versions still load
+# (see word_predictor.import_pickled_word_gen)
 class NgramProb:
     # Class Members:
     #   self.seen_next_words: A dictionary that holds information about which